@@ -0,0 +1,99 @@
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.db import database_sync_to_async  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from rides.models import Ride  # noqa: E402
+from rides.routing import websocket_urlpatterns  # noqa: E402
+
+# Bid -> passenger latency: a driver's POST /bid/ until the passenger's WebSocket
+# has the new top bids, vs the old 3 s poll of GET /rides/{id}/. Runs against a
+# throwaway test DB, in process, with the in-memory channel layer.
+RIDES = 50
+BIDS_PER_RIDE = 20
+POLL_INTERVAL_S = 3.0
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    User = get_user_model()
+    rng = random.Random(24)
+    rider = User.objects.create_user(username='rider', password='pw', role='rider')
+    drivers = [User.objects.create_user(username=f'driver{i}', password='pw', role='driver')
+               for i in range(BIDS_PER_RIDE)]
+    rides = [Ride.objects.create(passenger=rider, pickup_address='A', dropoff_address='B',
+                                 pickup_latitude=23.80, pickup_longitude=90.41,
+                                 dropoff_latitude=23.82, dropoff_longitude=90.41) for _ in range(RIDES)]
+    clients = []
+    for driver in drivers:
+        client = APIClient()
+        client.force_authenticate(driver)
+        clients.append(client)
+    token = str(AccessToken.for_user(rider))
+    application = URLRouter(websocket_urlpatterns)
+
+    async def run():
+        latencies = []
+        for ride in rides:
+            communicator = WebsocketCommunicator(application, f'/ws/rides/{ride.id}/bids/?token={token}')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            amount = 500
+            for client in clients:
+                amount -= rng.randint(1, 10)  # every bid undercuts, so every bid is pushed
+                start = time.perf_counter()
+                await database_sync_to_async(client.post)(f'/api/rides/{ride.id}/bid/', {'amount': amount},
+                                                          format='json')
+                await communicator.receive_json_from(timeout=5)
+                latencies.append(time.perf_counter() - start)
+            await communicator.disconnect()
+        return latencies
+
+    latencies = async_to_sync(run)()
+
+    # What a poll costs: the full ride with its bids, against the cheap bids poll
+    passenger = APIClient()
+    passenger.force_authenticate(rider)
+    ride = rides[0]
+    start = time.perf_counter()
+    for _ in range(100):
+        passenger.get(f'/api/rides/{ride.id}/')
+    detail_ms = (time.perf_counter() - start) * 10
+    cursor = passenger.get(f'/api/rides/{ride.id}/bids/').data['cursor']
+    start = time.perf_counter()
+    for _ in range(100):
+        passenger.get(f'/api/rides/{ride.id}/bids/', {'since': cursor})
+    unchanged_ms = (time.perf_counter() - start) * 10
+
+    print(f"{RIDES} rides x {BIDS_PER_RIDE} bids, one passenger subscribed per ride")
+    print(f"push:       p50 {percentile(latencies, 0.5) * 1000:7.2f} ms   p99 {percentile(latencies, 0.99) * 1000:7.2f} ms")
+    print(f"{POLL_INTERVAL_S:g} s poll:  p50 {POLL_INTERVAL_S * 500 + detail_ms:7.0f} ms   "
+          f"p99 {POLL_INTERVAL_S * 990 + detail_ms:7.0f} ms (interval wait + request)")
+    print(f"GET /rides/{{id}}/ with {BIDS_PER_RIDE} bids: {detail_ms:.2f} ms, "
+          f"unchanged GET /rides/{{id}}/bids/?since=: {unchanged_ms:.2f} ms (304)")
+
+
+if __name__ == "__main__":
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    try:
+        main()
+    finally:
+        teardown_databases(databases, verbosity=0)
@@ -0,0 +1,105 @@
+import os
+import random
+import time
+from datetime import timedelta
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+from django.db.models import Case, Value, When  # noqa: E402
+from django.test.utils import (  # noqa: E402
+    CaptureQueriesContext, override_settings, setup_databases, setup_test_environment, teardown_databases,
+)
+from django.utils import timezone  # noqa: E402
+
+from rides.bid_windows import BidWindowResolver  # noqa: E402
+from rides.location_store import ACTIVE_RIDE_STATUSES, location_store  # noqa: E402
+from rides.models import DriverLocation, Ride, RideBid  # noqa: E402
+from rides.state_machine import transition  # noqa: E402
+
+# Settling bid windows that all close within the same minute: the resolver's
+# chunked transactions vs one accept_bid-style transaction per ride. Runs
+# against a throwaway test DB.
+WINDOWS = 3000
+PER_RIDE_WINDOWS = 500
+BIDS_PER_RIDE = 5
+
+
+def book(rng, passenger, drivers, count, closes_at):
+    rides = Ride.objects.bulk_create([
+        Ride(passenger=passenger, pickup_address='A', dropoff_address='B', estimated_fare=100,
+             pickup_latitude=rng.uniform(23.70, 23.90), pickup_longitude=rng.uniform(90.33, 90.50),
+             dropoff_latitude=23.80, dropoff_longitude=90.41, bid_window_closes_at=closes_at)
+        for _ in range(count)
+    ])
+    # Each driver bids on a handful of rides, so drivers compete across windows
+    RideBid.objects.bulk_create([
+        RideBid(ride=ride, driver=driver, amount=rng.randint(60, 140))
+        for ride in rides for driver in rng.sample(drivers, BIDS_PER_RIDE)
+    ])
+    return [ride.id for ride in rides]
+
+
+def settle_one(ride_id):
+    # What settling a single window costs done the accept_bid way
+    with transaction.atomic():
+        bid = RideBid.objects.filter(ride_id=ride_id, status='pending') \
+            .exclude(driver__rides_driven__status__in=ACTIVE_RIDE_STATUSES).order_by('amount').first()
+        if bid is None:
+            return
+        transition(ride_id, 'accept', data={'bid_id': bid.id, 'amount': str(bid.amount)},
+                   driver_id=bid.driver_id, actual_fare=bid.amount)
+        RideBid.objects.filter(ride_id=ride_id).update(status=Case(
+            When(id=bid.id, then=Value('accepted')), default=Value('rejected')
+        ))
+
+
+def main():
+    User = get_user_model()
+    rng = random.Random(25)
+    passenger = User.objects.create_user(username='rider', password='pw', role='rider')
+    drivers = User.objects.bulk_create([
+        User(username=f'driver{i}', role='driver', rating=rng.uniform(3.5, 5.0))
+        for i in range(WINDOWS + PER_RIDE_WINDOWS)
+    ])
+    # Bidders are online, so the location store holds them
+    DriverLocation.objects.bulk_create([
+        DriverLocation(user=driver, latitude=rng.uniform(23.70, 23.90), longitude=rng.uniform(90.33, 90.50))
+        for driver in drivers
+    ])
+    closes_at = timezone.now() - timedelta(seconds=1)
+
+    resolver = BidWindowResolver()
+    book(rng, passenger, drivers[:WINDOWS], WINDOWS, closes_at)
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        settled = resolver.tick()
+        batch_s = time.perf_counter() - start
+
+    ride_ids = book(rng, passenger, drivers[WINDOWS:], PER_RIDE_WINDOWS, closes_at)
+    start = time.perf_counter()
+    for ride_id in ride_ids:
+        settle_one(ride_id)
+    single_s = time.perf_counter() - start
+
+    print(f"{WINDOWS} windows closing at once, {BIDS_PER_RIDE} bids each")
+    print(f"chunked settlement: {batch_s * 1000:8.1f} ms, {WINDOWS / batch_s:8.0f} windows/s "
+          f"({settled} accepted, {len(queries)} queries)")
+    print(f"one per ride:       {single_s * 1000 * WINDOWS / PER_RIDE_WINDOWS:8.1f} ms, "
+          f"{PER_RIDE_WINDOWS / single_s:8.0f} windows/s (timed on {PER_RIDE_WINDOWS})")
+
+
+if __name__ == "__main__":
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    try:
+        # Keep the location store's write-behind flusher out of the timings
+        with override_settings(RIDES_LOCATION_FLUSH_INTERVAL=3600):
+            main()
+            location_store.stop()
+    finally:
+        teardown_databases(databases, verbosity=0)
@@ -0,0 +1,87 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from rides.services import haversine_distance
+from rides.spatial import destination_point, motion_from_fixes, predict_position
+
+# How far can the map poll interval stretch when clients dead-reckon with the
+# feed's speed/heading, compared with just holding the last position?
+DRIVERS = 200
+DURATION_S = 1800
+PING_INTERVAL_S = 5
+POLL_INTERVALS_S = (5, 10, 15, 20, 30, 60)
+HORIZON_S = 30
+
+
+def simulate_truth(rng):
+    # 1 Hz ground truth: straight legs at rickshaw speed, turns at junctions, stops
+    lat, lon = rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50)
+    heading = rng.choice((0, 90, 180, 270))
+    truth = []
+    t = 0
+    while t < DURATION_S:
+        if rng.random() < 0.2:
+            for _ in range(rng.randint(10, 60)):
+                truth.append((lat, lon))
+                t += 1
+            continue
+        speed_kmh = rng.uniform(8, 15)
+        for _ in range(rng.randint(30, 120)):
+            lat, lon = destination_point(lat, lon, speed_kmh / 3600, heading)
+            truth.append((lat, lon))
+            t += 1
+        heading = (heading + rng.choice((-90, 0, 90))) % 360
+    return truth[:DURATION_S]
+
+
+def server_snapshots(truth, epoch):
+    # What the store holds after each ping: position plus velocity from the last two fixes
+    snapshots = {}
+    previous = None
+    speed, heading = 0.0, None
+    for t in range(0, len(truth), PING_INTERVAL_S):
+        lat, lon = truth[t]
+        at = epoch + timedelta(seconds=t)
+        if previous is not None:
+            motion = motion_from_fixes(*previous, lat, lon, at, prev_heading=heading)
+            if motion is not None:
+                speed, heading = motion
+        previous = (lat, lon, at)
+        snapshots[t] = (lat, lon, t, speed, heading)
+    return snapshots
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    rng = random.Random(3)
+    epoch = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    drivers = []
+    for _ in range(DRIVERS):
+        truth = simulate_truth(rng)
+        drivers.append((truth, server_snapshots(truth, epoch)))
+
+    print(f"{DRIVERS} drivers, pings every {PING_INTERVAL_S}s, error in metres")
+    print(f"{'poll':>6} | {'hold mean':>9} {'hold p95':>9} | {'DR mean':>9} {'DR p95':>9}")
+    for poll in POLL_INTERVALS_S:
+        hold_errors, dr_errors = [], []
+        for truth, snapshots in drivers:
+            latest = None
+            for t in range(len(truth)):
+                if t % poll == 0:
+                    # Client polls: sees the newest snapshot the server has
+                    latest = snapshots[t - t % PING_INTERVAL_S]
+                lat, lon, fixed_at, speed, heading = latest
+                true_lat, true_lon = truth[t]
+                hold_errors.append(haversine_distance(lat, lon, true_lat, true_lon) * 1000)
+                plat, plon = predict_position(lat, lon, speed, heading, t - fixed_at, HORIZON_S)
+                dr_errors.append(haversine_distance(plat, plon, true_lat, true_lon) * 1000)
+        print(f"{poll:>5}s | {sum(hold_errors) / len(hold_errors):9.1f} {percentile(hold_errors, 0.95):9.1f} | "
+              f"{sum(dr_errors) / len(dr_errors):9.1f} {percentile(dr_errors, 0.95):9.1f}")
+
+
+if __name__ == "__main__":
+    main()
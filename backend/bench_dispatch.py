@@ -0,0 +1,68 @@
+import os
+import random
+import time
+
+import django
+import numpy as np
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from rides.dispatch import haversine_matrix, match  # noqa: E402
+
+# Matcher throughput and pickup distance: first-come-first-served vs batch windows
+SIZES = ((1000, 1000), (10000, 10000))
+MAX_PICKUP_KM = 5.0
+HUNGARIAN_LIMIT = 1000 * 1000  # exact solve is only timed on the small window
+
+
+def random_points(rng, n):
+    return [(i, rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50)) for i in range(n)]
+
+
+def first_come_first_served(rides, drivers, rng):
+    # Each request goes to whichever free driver in range taps accept first
+    lat = np.array([d[1] for d in drivers])
+    lon = np.array([d[2] for d in drivers])
+    free = np.ones(len(drivers), dtype=bool)
+    total, matched = 0.0, 0
+    for _, rlat, rlon in rides:
+        distances = haversine_matrix([rlat], [rlon], lat, lon)[0]
+        in_range = np.flatnonzero(free & (distances <= MAX_PICKUP_KM))
+        if not len(in_range):
+            continue
+        pick = rng.choice(in_range.tolist())
+        free[pick] = False
+        total += distances[pick]
+        matched += 1
+    return matched, total
+
+
+def report(label, matched, total_km, seconds):
+    print(f"  {label:<14} {matched:6d} matched  {total_km / max(matched, 1):6.2f} km avg pickup  "
+          f"{seconds * 1000:9.1f} ms  {matched / seconds:10.0f} rides/s")
+
+
+def main():
+    rng = random.Random(12)
+    for n_rides, n_drivers in SIZES:
+        rides = random_points(rng, n_rides)
+        drivers = random_points(rng, n_drivers)
+        print(f"{n_rides} rides x {n_drivers} drivers, max pickup {MAX_PICKUP_KM} km")
+
+        start = time.perf_counter()
+        matched, total = first_come_first_served(rides, drivers, rng)
+        report("fcfs", matched, total, time.perf_counter() - start)
+
+        if n_rides * n_drivers <= HUNGARIAN_LIMIT:
+            start = time.perf_counter()
+            pairs = match(rides, drivers, MAX_PICKUP_KM, hungarian_max_cells=HUNGARIAN_LIMIT)
+            report("hungarian", len(pairs), sum(km for _, _, km in pairs), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        pairs = match(rides, drivers, MAX_PICKUP_KM, hungarian_max_cells=0)
+        report("greedy", len(pairs), sum(km for _, _, km in pairs), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
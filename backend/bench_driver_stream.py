@@ -0,0 +1,77 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from channels.layers import InMemoryChannelLayer
+
+from rides.driver_stream import DriverStreamHub
+
+# Load test for the viewport-subscribed driver stream, no server or DB needed:
+# thousands of simulated map clients, a few thousand drivers moving each tick.
+LAT_RANGE = (23.70, 23.90)
+LON_RANGE = (90.33, 90.50)
+SUBSCRIBERS = 3000
+DRIVERS = 5000
+MOVED_PER_TICK = 1000
+TICKS = 10
+VIEWPORT_DEG = 0.02  # ~2 km phone map
+
+
+def entry(i, lat, lon):
+    return {'username': f'driver{i}', 'latitude': lat, 'longitude': lon,
+            'vehicle_type': 'rickshaw', 'status': 'online', 'updated_at': None,
+            'recorded_at': None, 'speed_kmh': 0.0, 'heading': None}
+
+
+async def main():
+    rng = random.Random(7)
+    hub = DriverStreamHub()
+    layer = InMemoryChannelLayer(capacity=1000)
+    channels = []
+    for _ in range(SUBSCRIBERS):
+        channel = await layer.new_channel()
+        south = rng.uniform(LAT_RANGE[0], LAT_RANGE[1] - VIEWPORT_DEG)
+        west = rng.uniform(LON_RANGE[0], LON_RANGE[1] - VIEWPORT_DEG)
+        hub.subscribe(channel, (south, west, south + VIEWPORT_DEG, west + VIEWPORT_DEG))
+        channels.append(channel)
+
+    drivers = [entry(i, rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for i in range(DRIVERS)]
+    full_table_bytes = len(json.dumps(drivers))
+
+    route_s = send_s = 0.0
+    messages = pushed_bytes = 0
+    for _ in range(TICKS):
+        moved = rng.sample(drivers, MOVED_PER_TICK)
+        for d in moved:
+            d['latitude'] += rng.uniform(-0.0005, 0.0005)
+            d['longitude'] += rng.uniform(-0.0005, 0.0005)
+
+        start = time.perf_counter()
+        batches = hub.route(moved, [])
+        route_s += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for channel, batch in batches.items():
+            await layer.send(channel, {"type": "drivers.update", **batch})
+        for channel in batches:
+            message = await layer.receive(channel)
+            pushed_bytes += len(json.dumps(message))
+        send_s += time.perf_counter() - start
+        messages += len(batches)
+
+    print(f"{SUBSCRIBERS} subscribers, {DRIVERS} drivers, {MOVED_PER_TICK} moving per tick, {TICKS} ticks")
+    print(f"route:   {route_s * 1000 / TICKS:8.2f} ms/tick")
+    print(f"deliver: {send_s * 1000 / TICKS:8.2f} ms/tick ({messages / TICKS:.0f} messages/tick)")
+    print(f"pushed:  {pushed_bytes / TICKS / 1024:8.1f} KiB/tick")
+    print(f"polling: {SUBSCRIBERS * full_table_bytes / 1024:8.1f} KiB per 5s round of full-table polls")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
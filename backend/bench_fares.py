@@ -0,0 +1,44 @@
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from rides.services import VEHICLE_RATES, calculate_fare, calculate_fares  # noqa: E402
+
+# Fare estimation: calculate_fare in a loop vs one vectorized calculate_fares call
+SIZES = (1, 100, 10000)
+REPEAT_PAIRS = 100000  # each size is repeated until about this many pairs were priced
+
+
+def random_trips(rng, n):
+    return [(rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50), rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50))
+            for _ in range(n)]
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    rng = random.Random(18)
+    vehicle_types = list(VEHICLE_RATES)
+    for n in SIZES:
+        trips = random_trips(rng, n)
+        columns = list(zip(*trips))
+        repeat = max(1, REPEAT_PAIRS // n // 10)
+        for types in (['car'], vehicle_types):
+            loop_s = timed(lambda: [calculate_fare(*trip, v) for trip in trips for v in types], repeat)
+            batch_s = timed(lambda: calculate_fares(*columns, vehicle_types=types), repeat)
+            print(f"{n:6d} pairs x {len(types)} types: loop {loop_s * 1e6:10.1f} us, "
+                  f"vectorized {batch_s * 1e6:9.1f} us ({loop_s / batch_s:5.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
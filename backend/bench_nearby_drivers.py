@@ -0,0 +1,52 @@
+import random
+import time
+
+from rides.services import haversine_distance
+from rides.spatial import GridIndex
+
+# Roughly the Dhaka metro area
+LAT_RANGE = (23.70, 23.90)
+LON_RANGE = (90.33, 90.50)
+QUERIES = 200
+RADIUS_KM = 3.0
+LIMIT = 20
+
+
+def random_point(rng):
+    return rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)
+
+
+def full_scan(drivers, lat, lon):
+    # What the old endpoint did: every driver, distance to each, then sort
+    hits = []
+    for key, (dlat, dlon) in drivers.items():
+        distance = haversine_distance(lat, lon, dlat, dlon)
+        if distance <= RADIUS_KM:
+            hits.append((distance, key))
+    hits.sort()
+    return hits[:LIMIT]
+
+
+def run(num_drivers):
+    rng = random.Random(42)
+    drivers = {i: random_point(rng) for i in range(num_drivers)}
+    index = GridIndex(size=0.01)
+    for key, (lat, lon) in drivers.items():
+        index.upsert(key, lat, lon)
+    queries = [random_point(rng) for _ in range(QUERIES)]
+
+    start = time.perf_counter()
+    expected = [full_scan(drivers, lat, lon) for lat, lon in queries]
+    scan_ms = (time.perf_counter() - start) * 1000 / QUERIES
+
+    start = time.perf_counter()
+    got = [index.nearest(lat, lon, RADIUS_KM, LIMIT) for lat, lon in queries]
+    index_ms = (time.perf_counter() - start) * 1000 / QUERIES
+
+    assert got == expected, "index results differ from full scan"
+    print(f"{num_drivers:>7} drivers | full scan {scan_ms:8.3f} ms/query | grid index {index_ms:8.3f} ms/query | {scan_ms / index_ms:6.1f}x")
+
+
+if __name__ == "__main__":
+    for n in (10_000, 100_000):
+        run(n)
@@ -0,0 +1,81 @@
+import math
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from rides.pooling import RidePool, best_pooling  # noqa: E402
+from rides.services import haversine_distance  # noqa: E402
+
+# Pool candidate generation: corridor index vs checking every active ride
+ACTIVE_RIDES = 10000
+QUERIES = 1000
+MAX_DETOUR = 0.4
+
+
+def random_trip(rng):
+    lat, lon = rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50)
+    length_km = rng.uniform(2, 10)
+    bearing = rng.uniform(0, 2 * math.pi)
+    dlat = length_km * math.cos(bearing) / 111.32
+    dlon = length_km * math.sin(bearing) / (111.32 * math.cos(math.radians(lat)))
+    return (lat, lon), (lat + dlat, lon + dlon)
+
+
+def extra_km(host, pickup, dropoff):
+    # Extra vehicle km of the best pooling order, None if over the detour budget
+    host_pickup, host_dropoff = host
+    pooling = best_pooling(host_pickup, host_dropoff, haversine_distance(*host_pickup, *host_dropoff),
+                           pickup, dropoff, MAX_DETOUR)
+    return None if pooling is None else pooling[0]
+
+
+def best_offer(hosts, ride_ids, pickup, dropoff):
+    costs = [(extra_km(hosts[h], pickup, dropoff), h) for h in ride_ids]
+    costs = [c for c in costs if c[0] is not None]
+    return min(costs) if costs else None
+
+
+def main():
+    rng = random.Random(17)
+    pool = RidePool()
+    pool._loaded = True  # filled by hand below, no DB
+    hosts = {}
+    for ride_id in range(ACTIVE_RIDES):
+        hosts[ride_id] = random_trip(rng)
+        pool._add(ride_id, *hosts[ride_id])
+    queries = [random_trip(rng) for _ in range(QUERIES)]
+
+    start = time.perf_counter()
+    candidate_sets = [pool.candidates(pickup, dropoff) for pickup, dropoff in queries]
+    candidates_s = time.perf_counter() - start
+    start = time.perf_counter()
+    indexed = [best_offer(hosts, found, pickup, dropoff) for found, (pickup, dropoff) in zip(candidate_sets, queries)]
+    index_s = candidates_s + time.perf_counter() - start
+
+    sample = queries[:100]
+    start = time.perf_counter()
+    scanned = [best_offer(hosts, hosts, pickup, dropoff) for pickup, dropoff in sample]
+    scan_s = (time.perf_counter() - start) * QUERIES / len(sample)
+
+    poolable = sum(best is not None for best in scanned)
+    offered = sum(found is not None for found, best in zip(indexed, scanned) if best is not None)
+    # Within 100 m of the extra distance of the best pool anywhere
+    near_best = sum(found is not None and found[0] - best[0] < 0.1
+                    for found, best in zip(indexed, scanned) if best is not None)
+    candidates = sum(len(c) for c in candidate_sets) / QUERIES
+    print(f"{ACTIVE_RIDES} active rides, {QUERIES} new trips, detour budget {MAX_DETOUR:.0%}, "
+          f"corridor {pool.corridor_km} km")
+    print(f"all-pairs scan:   {scan_s * 1000 / QUERIES:8.3f} ms/trip")
+    print(f"corridor index:   {index_s * 1000 / QUERIES:8.3f} ms/trip "
+          f"({candidates_s * 1000 / QUERIES:.3f} ms candidate generation, {candidates:.0f} candidates checked)")
+    print(f"of {poolable}/{len(sample)} sampled trips with a pool: {offered} get an offer, "
+          f"{near_best} within 100 m of the best one")
+
+
+if __name__ == "__main__":
+    main()
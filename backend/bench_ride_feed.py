@@ -0,0 +1,68 @@
+import heapq
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from rides.ride_index import OpenRideIndex  # noqa: E402
+from rides.services import haversine_distance  # noqa: E402
+
+# Driver feed cost: pickup-cell index + bounded top-k vs scanning every open request
+OPEN_REQUESTS = 50000
+DRIVERS = 5000
+RADIUS_KM = 5.0
+LIMIT = 20
+FARE_WEIGHT = 0.5
+
+
+def random_point(rng):
+    return rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50)
+
+
+def scan(rides, lat, lon):
+    hits = []
+    for ride_id, (plat, plon, fare) in rides.items():
+        pickup_km = haversine_distance(lat, lon, plat, plon)
+        if pickup_km <= RADIUS_KM:
+            hits.append((pickup_km - FARE_WEIGHT * fare / 100, pickup_km, ride_id))
+    hits.sort()
+    return hits[:LIMIT]
+
+
+def main():
+    rng = random.Random(11)
+    rides = {}
+    index = OpenRideIndex()
+    index._loaded = True  # filled by hand below, no DB
+    for ride_id in range(OPEN_REQUESTS):
+        lat, lon = random_point(rng)
+        fare = rng.uniform(60, 600)
+        rides[ride_id] = (lat, lon, fare)
+        index._add(ride_id, lat, lon, fare)
+    drivers = [random_point(rng) for _ in range(DRIVERS)]
+
+    start = time.perf_counter()
+    for lat, lon in drivers:
+        index.ranked(lat, lon, RADIUS_KM, LIMIT, FARE_WEIGHT)
+    index_s = time.perf_counter() - start
+
+    sample = drivers[:200]
+    start = time.perf_counter()
+    for lat, lon in sample:
+        scan(rides, lat, lon)
+    scan_s = (time.perf_counter() - start) * DRIVERS / len(sample)
+
+    for lat, lon in sample[:20]:
+        assert index.ranked(lat, lon, RADIUS_KM, LIMIT, FARE_WEIGHT) == heapq.nsmallest(LIMIT, scan(rides, lat, lon))
+
+    print(f"{OPEN_REQUESTS} open requests, {DRIVERS} drivers polling, {RADIUS_KM} km radius, top {LIMIT}")
+    print(f"full scan:        {scan_s * 1000 / DRIVERS:8.3f} ms/poll  {scan_s:7.2f} s per round of polls")
+    print(f"grid + top-k:     {index_s * 1000 / DRIVERS:8.3f} ms/poll  {index_s:7.2f} s per round of polls")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import django
+import numpy as np
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from django.test import override_settings  # noqa: E402
+
+from rides.roads import RoadGraph, build_road_graph  # noqa: E402
+from rides.services import haversine_distance  # noqa: E402
+
+# Routing on a synthetic Dhaka-sized street grid: build, load, memory and query rates.
+# 240 x 240 intersections 150 m apart (~36 km square), arterials every 8th street,
+# every other residential street one-way, a tenth of residential blocks missing.
+GRID = 240
+SPACING_DEG = 0.00135
+ROUTES = 300
+MATRIX = (20, 200)
+
+
+def write_osm(path, rng):
+    def node_id(r, c):
+        return r * GRID + c + 1
+
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for r in range(GRID):
+            for c in range(GRID):
+                lat = 23.70 + r * SPACING_DEG + rng.uniform(-2e-4, 2e-4)
+                lon = 90.33 + c * SPACING_DEG + rng.uniform(-2e-4, 2e-4)
+                f.write(f'<node id="{node_id(r, c)}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n')
+        way = 0
+        for horizontal in (True, False):
+            for line in range(GRID):
+                arterial = line % 8 == 0
+                highway = 'primary' if line % 32 == 0 else 'secondary' if arterial else 'residential'
+                oneway = not arterial and line % 2 == 1
+                for start in range(0, GRID - 1, 6):
+                    if not arterial and rng.random() < 0.1:
+                        continue
+                    end = min(start + 6, GRID - 1)
+                    refs = [node_id(line, i) if horizontal else node_id(i, line) for i in range(start, end + 1)]
+                    way += 1
+                    tags = f'<tag k="highway" v="{highway}"/>' + ('<tag k="oneway" v="yes"/>' if oneway else '')
+                    f.write(f'<way id="{way}">' + ''.join(f'<nd ref="{ref}"/>' for ref in refs) + tags + '</way>\n')
+        f.write('</osm>\n')
+
+
+def random_point(rng):
+    span = GRID * SPACING_DEG
+    return 23.70 + rng.uniform(0, span), 90.33 + rng.uniform(0, span)
+
+
+def main():
+    rng = random.Random(22)
+    with tempfile.TemporaryDirectory() as directory:
+        osm_path, graph_path = os.path.join(directory, 'city.osm'), os.path.join(directory, 'graph.npz')
+        write_osm(osm_path, rng)
+        start = time.perf_counter()
+        nodes, edges = build_road_graph(osm_path, graph_path)
+        build_s = time.perf_counter() - start
+
+        with override_settings(RIDES_ROAD_GRAPH_PATH=graph_path):
+            tracemalloc.start()
+            start = time.perf_counter()
+            graph = RoadGraph()
+            graph._ensure_loaded()
+            load_ms = (time.perf_counter() - start) * 1000
+            _, peak = tracemalloc.get_traced_memory()
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            trips = [(*random_point(rng), *random_point(rng)) for _ in range(ROUTES)]
+            start = time.perf_counter()
+            routes = [graph.route(*trip) for trip in trips]
+            route_s = time.perf_counter() - start
+            detour = np.median([route[0] / haversine_distance(*trip) for trip, route in zip(trips, routes)
+                                if route and haversine_distance(*trip) > 1])
+
+            start = time.perf_counter()
+            for trip in trips:
+                haversine_distance(*trip)
+            haversine_s = time.perf_counter() - start
+
+            origins = [random_point(rng) for _ in range(MATRIX[0])]
+            destinations = [random_point(rng) for _ in range(MATRIX[1])]
+            start = time.perf_counter()
+            graph.matrix(origins, destinations)
+            matrix_s = time.perf_counter() - start
+
+            # Dispatch-style: pickups within 5 km of the driver only
+            near = [(lat + rng.uniform(-0.03, 0.03), lon + rng.uniform(-0.03, 0.03))
+                    for lat, lon in origins for _ in range(MATRIX[1] // MATRIX[0])]
+            start = time.perf_counter()
+            graph.matrix(origins, near, max_km=5)
+            bounded_s = time.perf_counter() - start
+
+    print(f"{nodes} nodes, {edges} directed edges; built from .osm in {build_s:.1f}s")
+    print(f"load: {load_ms:.0f} ms, {graph.nbytes / 1e6:.1f} MB arrays, "
+          f"{current / 1e6:.1f} MB resident after load ({peak / 1e6:.1f} MB peak)")
+    print(f"A* routes:   {ROUTES / route_s:8.1f} routes/s ({route_s * 1000 / ROUTES:.1f} ms each, "
+          f"median road/straight {detour:.2f}); haversine {ROUTES / haversine_s:,.0f}/s")
+    print(f"matrix {MATRIX[0]}x{MATRIX[1]}: {matrix_s * 1000:.0f} ms ({MATRIX[0] * MATRIX[1] / matrix_s:,.0f} pairs/s)")
+    print(f"matrix {MATRIX[0]}x{len(near)}, 5 km cutoff: {bounded_s * 1000:.0f} ms "
+          f"({MATRIX[0] * len(near) / bounded_s:,.0f} pairs/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from rides.services import haversine_distance  # noqa: E402
+from rides.spatial import GridIndex  # noqa: E402
+from rides.surge import SurgeMeter  # noqa: E402
+
+# Surge lookup per quote: windowed cell counters vs counting open rides and drivers around the pickup
+OPEN_RIDES = (1000, 10000, 100000)
+DRIVERS_PER_RIDE = 0.5
+QUERIES = 10000
+SCAN_QUERIES = 20
+RADIUS_KM = 1.5  # about the 3x3 neighbourhood the meter averages over
+
+
+class FakeIndex:
+    # Stands in for open_rides / location_store, both just expose GridIndex.cell_counts()
+    def __init__(self, points):
+        self.grid = GridIndex()
+        for i, (lat, lon) in enumerate(points):
+            self.grid.upsert(i, lat, lon)
+
+    def cell_counts(self):
+        return self.grid.cell_counts()
+
+    available_cell_counts = cell_counts
+
+
+def random_points(rng, n):
+    return [(rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50)) for _ in range(n)]
+
+
+def naive_multiplier(rides, drivers, lat, lon):
+    demand = sum(haversine_distance(lat, lon, *p) <= RADIUS_KM for p in rides)
+    supply = sum(haversine_distance(lat, lon, *p) <= RADIUS_KM for p in drivers)
+    if demand < settings.RIDES_SURGE_MIN_DEMAND:
+        return 1.0
+    return min(round(1 + settings.RIDES_SURGE_SENSITIVITY * max(demand / max(supply, 1) - 1, 0), 1),
+               settings.RIDES_SURGE_MAX)
+
+
+def main():
+    import rides.surge as surge
+
+    rng = random.Random(23)
+    queries = random_points(rng, QUERIES)
+    print(f"{QUERIES} surge lookups, {DRIVERS_PER_RIDE:g} online drivers per open ride")
+    for n in OPEN_RIDES:
+        rides, drivers = random_points(rng, n), random_points(rng, int(n * DRIVERS_PER_RIDE))
+        surge.open_rides, surge.location_store = FakeIndex(rides), FakeIndex(drivers)
+        meter = SurgeMeter()
+
+        start = time.perf_counter()
+        for i in range(30):  # a full window at the default tick
+            meter.sample(now=time.monotonic() + i * settings.RIDES_SURGE_TICK)
+        sample_ms = (time.perf_counter() - start) * 1000 / 30
+
+        start = time.perf_counter()
+        for lat, lon in queries:
+            meter.multiplier(lat, lon)
+        lookup_us = (time.perf_counter() - start) * 1e6 / QUERIES
+
+        start = time.perf_counter()
+        for lat, lon in queries[:SCAN_QUERIES]:
+            naive_multiplier(rides, drivers, lat, lon)
+        scan_us = (time.perf_counter() - start) * 1e6 / SCAN_QUERIES
+
+        print(f"{n:>7} open rides: counters {lookup_us:7.2f} us/quote, scan {scan_us / 1000:8.2f} ms/quote, "
+              f"snapshot {sample_ms:6.2f} ms every {settings.RIDES_SURGE_TICK:g} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import math
+import random
+import sqlite3
+import time
+
+from rides.polyline import decode_points, encode_points, simplify
+
+# Bytes per ride and read time: delta-encoded trace blob vs one row per fix
+RIDES = 200
+RIDE_MINUTES = 30
+FIX_INTERVAL_S = 5
+
+
+def simulate_ride(rng):
+    lat, lon = rng.uniform(23.70, 23.90), rng.uniform(90.33, 90.50)
+    heading = rng.uniform(0, 2 * math.pi)
+    points = []
+    for i in range(RIDE_MINUTES * 60 // FIX_INTERVAL_S):
+        heading += rng.gauss(0, 0.15)
+        step = rng.uniform(0, 15) / 111320  # rickshaw speed, up to ~11 km/h
+        lat += step * math.cos(heading)
+        lon += step * math.sin(heading)
+        points.append((round(lat, 6), round(lon, 6), i * FIX_INTERVAL_S))
+    return points
+
+
+def db_bytes(conn):
+    conn.commit()
+    conn.execute("VACUUM")
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+
+def main():
+    rng = random.Random(1)
+    rides = [simulate_ride(rng) for _ in range(RIDES)]
+
+    rows = sqlite3.connect(":memory:")
+    rows.execute("CREATE TABLE fix (id INTEGER PRIMARY KEY, ride_id INTEGER, latitude REAL, longitude REAL, t INTEGER)")
+    rows.execute("CREATE INDEX fix_ride ON fix (ride_id, t)")
+    for ride_id, points in enumerate(rides):
+        rows.executemany("INSERT INTO fix (ride_id, latitude, longitude, t) VALUES (?, ?, ?, ?)",
+                         [(ride_id, *p) for p in points])
+
+    blobs = sqlite3.connect(":memory:")
+    blobs.execute("CREATE TABLE trace (ride_id INTEGER PRIMARY KEY, encoded TEXT)")
+    simplified = sqlite3.connect(":memory:")
+    simplified.execute("CREATE TABLE trace (ride_id INTEGER PRIMARY KEY, encoded TEXT)")
+    kept = 0
+    for ride_id, points in enumerate(rides):
+        # Appended one fix at a time, like the live path with 5 s pings
+        encoded, last = "", (0, 0, 0)
+        for point in points:
+            chunk, last = encode_points([point], last)
+            encoded += chunk
+        blobs.execute("INSERT INTO trace VALUES (?, ?)", (ride_id, encoded))
+        reduced = simplify(list(decode_points(encoded)), 5.0)
+        kept += len(reduced)
+        simplified.execute("INSERT INTO trace VALUES (?, ?)", (ride_id, encode_points(reduced)[0]))
+
+    fixes = sum(len(p) for p in rides)
+    print(f"{RIDES} rides, {fixes // RIDES} fixes each")
+    print(f"row per fix:       {db_bytes(rows) / RIDES:9.0f} bytes/ride")
+    print(f"encoded trace:     {db_bytes(blobs) / RIDES:9.0f} bytes/ride")
+    print(f"after DP (5 m):    {db_bytes(simplified) / RIDES:9.0f} bytes/ride ({kept / RIDES:.0f} points)")
+
+    start = time.perf_counter()
+    for ride_id in range(RIDES):
+        rows.execute("SELECT latitude, longitude, t FROM fix WHERE ride_id = ? ORDER BY t", (ride_id,)).fetchall()
+    rows_ms = (time.perf_counter() - start) * 1000 / RIDES
+
+    start = time.perf_counter()
+    for ride_id in range(RIDES):
+        encoded = blobs.execute("SELECT encoded FROM trace WHERE ride_id = ?", (ride_id,)).fetchone()[0]
+        list(decode_points(encoded))
+    blob_ms = (time.perf_counter() - start) * 1000 / RIDES
+
+    print(f"read rows:         {rows_ms:9.3f} ms/ride")
+    print(f"read + decode:     {blob_ms:9.3f} ms/ride")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import random
+import tempfile
+import time
+
+import django
+import numpy as np
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from django.test import override_settings  # noqa: E402
+
+from rides.traffic import HOURS_PER_WEEK, TrafficModel, encode_factors  # noqa: E402
+
+# Traffic table: load time of the compressed file, and lookup cost vs the old coin flip
+ROWS, COLS = 40, 40  # RIDES_TRAFFIC_BOUNDS at 0.01 degree zones
+LOOKUPS = 200000
+LOADS = 20
+
+
+def main():
+    rng = np.random.default_rng(21)
+    factors = rng.uniform(0.8, 2.5, (HOURS_PER_WEEK, ROWS, COLS))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'traffic.npz')
+        np.savez_compressed(path, factors=encode_factors(factors), origin=np.array([23.60, 90.20]),
+                            cell=np.array(0.01))
+        with override_settings(RIDES_TRAFFIC_MODEL_PATH=path):
+            start = time.perf_counter()
+            for _ in range(LOADS):
+                model = TrafficModel()
+                model._ensure_loaded()
+            load_ms = (time.perf_counter() - start) * 1000 / LOADS
+            size_kb = os.path.getsize(path) / 1024
+
+            r = random.Random(21)
+            points = [(r.uniform(23.70, 23.90), r.uniform(90.33, 90.50), r.randrange(HOURS_PER_WEEK))
+                      for _ in range(LOOKUPS)]
+            start = time.perf_counter()
+            for lat, lon, bucket in points:
+                model.factor(lat, lon, bucket)
+            lookup_ns = (time.perf_counter() - start) * 1e9 / LOOKUPS
+
+            start = time.perf_counter()
+            for _ in points:
+                1.5 if r.random() < 0.2 else 1.0
+            coin_ns = (time.perf_counter() - start) * 1e9 / LOOKUPS
+
+            lat, lon, bucket = (np.array(column) for column in zip(*points))
+            start = time.perf_counter()
+            model.factors(lat, lon, bucket)
+            vector_ns = (time.perf_counter() - start) * 1e9 / LOOKUPS
+
+    print(f"table {HOURS_PER_WEEK}x{ROWS}x{COLS} uint8, {size_kb:.0f} KB compressed, "
+          f"{model._table.nbytes / 1024:.0f} KB in memory")
+    print(f"load:               {load_ms:8.2f} ms")
+    print(f"random coin flip:   {coin_ns:8.0f} ns/lookup")
+    print(f"factor():           {lookup_ns:8.0f} ns/lookup")
+    print(f"factors(), batched: {vector_ns:8.0f} ns/lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,7 @@ ALLOWED_HOSTS = ['*']
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne',  # ASGI runserver, serves the WebSocket routes too
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
     'rest_framework.authtoken',
     'rest_framework_simplejwt',
     'corsheaders',
+    'channels',
     # Local apps
     'users',
     'rides',
@@ -76,6 +78,14 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+ASGI_APPLICATION = 'config.asgi.application'
+
+# Channels (in-memory layer, no Redis needed for a single process)
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
 
 
 # Database
@@ -154,3 +164,60 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
 }
+
+# Rides
+RIDES_GRID_CELL_DEGREES = 0.01  # Spatial grid cell edge (~1.1 km in Dhaka)
+RIDES_LOCATION_BACKEND = 'rides.location_store.MemoryBackend'
+RIDES_LOCATION_FLUSH_INTERVAL = 2.0  # Seconds between DriverLocation flushes, 0 writes through
+RIDES_LOCATION_FLUSH_BATCH_SIZE = 500
+RIDES_DRIVER_STREAM_TICK = 1.0  # Seconds between WebSocket driver update batches
+RIDES_DRIVER_TTL = 120  # Seconds without a ping before a driver is swept offline
+RIDES_TRACE_SIMPLIFY_TOLERANCE_M = 5.0  # Douglas-Peucker tolerance applied to completed ride traces
+RIDES_ODOMETER_MIN_STEP_M = 10  # Shorter moves between fixes are treated as GPS jitter
+RIDES_ODOMETER_MAX_SPEED_KMH = 80  # Faster jumps between fixes are treated as glitches
+RIDES_PREDICTION_HORIZON = 30  # Seconds a driver position is extrapolated before it is held
+RIDES_PING_INTERVALS = {'trip': 5, 'pickup': 10, 'moving': 15, 'parked': 45}  # next_update_in per driver state, seconds
+RIDES_PING_CAPACITY = 500  # Location pings/s before idle drivers are backed off
+RIDES_DRIVER_FEED_RADIUS_KM = 5.0  # Pickup radius of the driver ride feed
+RIDES_DRIVER_FEED_MAX_RADIUS_KM = 20.0  # Largest radius_km a driver may ask the feed for
+RIDES_FEED_FARE_WEIGHT = 0.5  # Feed ranking: km of extra pickup distance worth 100 BDT of fare
+RIDES_DISPATCH_MODE = 'fcfs'  # 'fcfs': drivers accept requests themselves, 'batch': matched by the dispatcher
+RIDES_DISPATCH_INTERVAL = 5.0  # Seconds between in-process batch dispatch windows, 0 disables them
+RIDES_DISPATCH_MAX_PICKUP_KM = 5.0  # Dispatch never pairs a driver further than this from the pickup
+RIDES_DISPATCH_HUNGARIAN_MAX_CELLS = 250000  # Windows up to rides x drivers cells are solved exactly, larger ones greedily
+RIDES_REQUEST_TIMEOUT = 600  # Seconds a ride can stay requested before it expires
+RIDES_ABANDON_TIMEOUT = 1800  # Seconds without ride or driver location updates before an active ride is cancelled
+RIDES_EXPIRY_INTERVAL = 60  # Seconds between in-process expiry sweeps, 0 disables them
+RIDES_EXPIRY_CHUNK = 500  # Rides cancelled per UPDATE
+RIDES_SCHEDULE_LEAD_TIME = 900  # Seconds before pickup that a booked ride opens to drivers
+RIDES_SCHEDULE_HORIZON = 3600  # Seconds of upcoming releases the scheduler keeps in memory
+RIDES_SCHEDULE_TICK = 5.0  # Seconds between scheduler ticks, 0 disables them
+RIDES_SCHEDULE_MAX_DAYS = 30  # How far ahead rides can be booked
+RIDES_POOL_CORRIDOR_KM = 0.5  # Half-width of the route corridor a shared ride is searched in
+RIDES_POOL_MAX_DETOUR = 0.4  # Extra distance either passenger accepts, as a fraction of their direct trip
+RIDES_POOL_DISCOUNT = 0.3  # Shared fare discount off calculate_fare
+RIDES_POOL_MAX_RIDERS = 1  # Extra passengers a host ride can take
+RIDES_QUOTE_CACHE_BACKEND = 'rides.quotes.LRUBackend'  # or 'rides.quotes.DjangoCacheBackend' to share quotes through CACHES
+RIDES_QUOTE_CACHE_ALIAS = 'default'  # Django cache used by DjangoCacheBackend
+RIDES_QUOTE_CACHE_SIZE = 10000  # Quotes kept by LRUBackend
+RIDES_QUOTE_GRID_DEGREES = 0.001  # Quote coordinates are snapped to this grid (~110 m)
+RIDES_QUOTE_TOKEN_TTL = 300  # Seconds a signed estimate can be booked at its quoted fare
+RIDES_TRAFFIC_MODEL_PATH = BASE_DIR / 'data' / 'traffic_model.npz'  # Written by build_traffic_model, default profile until then
+RIDES_TRAFFIC_BOUNDS = (23.60, 90.20, 24.00, 90.60)  # Area the traffic model is built for, (min lat, min lon, max lat, max lon)
+RIDES_TRAFFIC_ZONE_DEGREES = 0.01  # Traffic zone cell edge
+RIDES_TRAFFIC_TIME_ZONE = 'Asia/Dhaka'  # Zone the hour-of-week traffic buckets are counted in
+RIDES_ROAD_GRAPH_PATH = BASE_DIR / 'data' / 'road_graph.npz'  # Written by build_road_graph, straight-line distances until then
+RIDES_ROUTING_SNAP_KM = 0.3  # Points further than this from any road node aren't routed
+RIDES_DISPATCH_ROAD_MAX_CELLS = 2500  # Dispatch windows up to rides x drivers cells are costed by road distance
+RIDES_SURGE_TICK = 10.0  # Seconds between surge snapshots of open rides and online drivers per cell
+RIDES_SURGE_WINDOW = 300  # Seconds of snapshots a cell's surge is averaged over
+RIDES_SURGE_SENSITIVITY = 0.5  # Surge added per unit of demand over supply beyond 1
+RIDES_SURGE_MAX = 2.5  # Surge multiplier cap
+RIDES_SURGE_MIN_DEMAND = 3  # Open rides around a cell below which it never surges
+RIDES_BID_BOOK_TOP_K = 10  # Cheapest bids a passenger is shown and pushed
+RIDES_BID_WINDOW_MIN = 15  # Shortest bid window a ride can be booked with, seconds
+RIDES_BID_WINDOW_MAX = 600  # Longest bid window, seconds
+RIDES_BID_WINDOW_POLICY = {'price': 1.0, 'rating': 0.5, 'pickup_km': 0.25}  # Weights bid_scores() ranks bids by
+RIDES_BID_WINDOW_MAX_PICKUP_KM = 5.0  # Pickup distance that scores worst, and the score of drivers with no position
+RIDES_BID_WINDOW_HORIZON = 600  # Seconds of upcoming window closings held in memory
+RIDES_BID_WINDOW_TICK = 1.0  # Seconds between bid window settlements, 0 disables them
@@ -0,0 +1,140 @@
+import bisect
+import logging
+import threading
+import uuid
+from decimal import Decimal
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .serializers import RideBidSerializer
+
+logger = logging.getLogger(__name__)
+
+
+def bids_group(ride_id):
+    # Channel layer group of a ride's bid subscribers
+    return f"ride-bids.{ride_id}"
+
+
+class RideBook:
+    # Pending bids of one ride, cheapest (then earliest) first
+
+    def __init__(self):
+        self.bids = {}  # bid_id -> serialized bid
+        self.order = []  # sorted [(amount, bid_id)]
+        self.version = 0
+
+    def upsert(self, data):
+        previous = self.bids.get(data['id'])
+        if previous is not None:
+            self.order.pop(bisect.bisect_left(self.order, (Decimal(previous['amount']), data['id'])))
+        self.bids[data['id']] = data
+        bisect.insort(self.order, (Decimal(data['amount']), data['id']))
+
+    def top(self, k):
+        return [self.bids[bid_id] for _, bid_id in self.order[:k]]
+
+
+class BidBook:
+    """
+    Live bid leaderboard per requested ride.
+
+    Each ride's pending bids are kept sorted by amount, with a version
+    that moves only when its top RIDES_BID_BOOK_TOP_K changes. A book is
+    loaded from the DB the first time its ride is read, then kept current
+    by `place` on every bid write and dropped by `close` once the ride
+    leaves 'requested'. Top-k changes are pushed to the ride's channel
+    layer group after the write commits, so passengers either hold a
+    WebSocket or poll with the last cursor and get a 304 until it moves.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._books = {}  # ride_id -> RideBook
+        self._epoch = uuid.uuid4().hex[:8]
+
+    @property
+    def top_k(self):
+        return getattr(settings, 'RIDES_BID_BOOK_TOP_K', 10)
+
+    def _book(self, ride_id):
+        book = self._books.get(ride_id)
+        if book is not None:
+            return book
+        from .models import RideBid
+
+        bids = RideBidSerializer(RideBid.objects.filter(ride_id=ride_id, status='pending').select_related('driver'),
+                                 many=True).data
+        with self._lock:
+            book = self._books.get(ride_id)
+            if book is None:
+                book = self._books[ride_id] = RideBook()
+                for data in bids:
+                    book.upsert(data)
+            return book
+
+    def cursor(self, book):
+        return f"{self._epoch}.{book.version}"
+
+    def snapshot(self, ride_id):
+        # (cursor, top bids, pending count)
+        book = self._book(ride_id)
+        with self._lock:
+            return self.cursor(book), book.top(self.top_k), len(book.bids)
+
+    def place(self, bid):
+        """
+        Records a created or re-priced RideBid once the transaction that
+        wrote it commits, and pushes the new top bids if they changed. A
+        rolled-back bid never reaches the book.
+        """
+        data = RideBidSerializer(bid).data
+        transaction.on_commit(lambda: self._place(bid.ride_id, data))
+
+    def _place(self, ride_id, data):
+        from .models import Ride
+
+        k = self.top_k
+        with self._lock:
+            # Checked under the lock close() takes after the settling commit,
+            # so a bid racing an accept can't bring a closed book back
+            if not Ride.objects.filter(id=ride_id, status='requested').exists():
+                return
+            book = self._book(ride_id)
+            before = [(b['id'], b['amount']) for b in book.top(k)]
+            book.upsert(data)
+            top = book.top(k)
+            if [(b['id'], b['amount']) for b in top] == before:
+                return
+            book.version += 1
+            message = {"type": "bids.top", "cursor": self.cursor(book), "bids": top, "count": len(book.bids)}
+        self._push(ride_id, message)
+
+    def close(self, ride_ids, status):
+        # Rides that left 'requested': books are dropped and their subscribers told.
+        # A ride nobody has read has no book, and no one to tell.
+        with self._lock:
+            closed = [ride_id for ride_id in ride_ids if self._books.pop(ride_id, None) is not None]
+        for ride_id in closed:
+            self._push(ride_id, {"type": "bids.closed", "status": status})
+
+    def _push(self, ride_id, message):
+        try:
+            async_to_sync(get_channel_layer().group_send)(bids_group(ride_id), message)
+        except Exception:
+            # Subscribers resync from the poll endpoint, a lost push isn't fatal
+            logger.exception("Bid push for ride %s failed", ride_id)
+
+    def __len__(self):
+        return len(self._books)
+
+    def reset(self):
+        with self._lock:
+            self._books = {}
+            self._epoch = uuid.uuid4().hex[:8]
+
+
+bid_book = BidBook()
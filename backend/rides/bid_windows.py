@@ -0,0 +1,250 @@
+import atexit
+import heapq
+import logging
+import threading
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Case, DecimalField, IntegerField, Value, When
+from django.utils import timezone
+
+from .bid_book import bid_book
+from .location_store import ACTIVE_RIDE_STATUSES, location_store
+from .pooling import board_pool_riders
+from .ride_index import open_rides
+from .services import haversine_distance
+from .state_machine import updated_ids
+
+logger = logging.getLogger(__name__)
+
+SETTLE_CHUNK = 500
+MAX_RATING = 5.0
+
+
+def bid_scores(amounts, reference_fares, ratings, pickup_kms, weights=None, max_pickup_km=None):
+    """
+    Policy score of each bid, lower is better. Each term is scaled to
+    about 0..1 before RIDES_BID_WINDOW_POLICY weighs it: the amount as a
+    fraction of the reference fare, the driver's rating shortfall from 5
+    stars, and the pickup distance over RIDES_BID_WINDOW_MAX_PICKUP_KM.
+    Drivers with no known position count as that far away.
+    """
+    weights = weights or getattr(settings, 'RIDES_BID_WINDOW_POLICY', {'price': 1.0, 'rating': 0.0, 'pickup_km': 0.0})
+    if max_pickup_km is None:
+        max_pickup_km = getattr(settings, 'RIDES_BID_WINDOW_MAX_PICKUP_KM', 5.0)
+    amounts = np.asarray(amounts, dtype=float)
+    pickup_kms = np.where(np.isnan(pickup_kms), max_pickup_km, np.minimum(pickup_kms, max_pickup_km))
+    return (weights.get('price', 0.0) * amounts / np.asarray(reference_fares, dtype=float)
+            + weights.get('rating', 0.0) * (MAX_RATING - np.asarray(ratings, dtype=float)) / MAX_RATING
+            + weights.get('pickup_km', 0.0) * pickup_kms / max_pickup_km)
+
+
+class BidWindowResolver:
+    """
+    Closes ride bid windows and accepts the best bid.
+
+    Rides booked with a bid window carry bid_window_closes_at. Windows
+    closing within RIDES_BID_WINDOW_HORIZON are held in a heap, reloaded
+    from the (status, bid_window_closes_at) index once half of it has
+    passed, the same way the ride scheduler holds bookings. Every
+    RIDES_BID_WINDOW_TICK seconds the due windows are popped and settled
+    SETTLE_CHUNK at a time, each chunk in one transaction: the rides, their
+    winning bids and their losing bids are written with one UPDATE each.
+    Bids are ranked by bid_scores(), and a driver wins at most one window
+    per chunk. Windows without a bid from a free driver stay requested for
+    a manual accept or the expiry sweep.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []  # (closes_at, ride_id)
+        self._queued = set()
+        self._loaded_until = None  # windows closing before this are in the heap
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def horizon(self):
+        return timedelta(seconds=getattr(settings, 'RIDES_BID_WINDOW_HORIZON', 600))
+
+    @property
+    def tick_interval(self):
+        return getattr(settings, 'RIDES_BID_WINDOW_TICK', 1.0)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, closes_at, ride_id):
+        if ride_id not in self._queued:
+            heapq.heappush(self._heap, (closes_at, ride_id))
+            self._queued.add(ride_id)
+
+    def _load(self, now):
+        from .models import Ride
+
+        until = now + self.horizon
+        # Scheduled bookings too, their windows run from their release
+        windows = Ride.objects.filter(status__in=('scheduled', 'requested'), bid_window_closes_at__lt=until)
+        if self._loaded_until is not None:
+            windows = windows.filter(bid_window_closes_at__gte=self._loaded_until)
+        for ride_id, closes_at in windows.values_list('id', 'bid_window_closes_at').iterator():
+            self._push(closes_at, ride_id)
+        self._loaded_until = until
+
+    def add(self, ride):
+        with self._lock:
+            if self._loaded_until is not None and ride.bid_window_closes_at < self._loaded_until:
+                self._push(ride.bid_window_closes_at, ride.id)
+
+    def tick(self, now=None):
+        # Settles every window that is due, returns how many got a driver
+        now = now or timezone.now()
+        with self._lock:
+            if self._loaded_until is None or now + self.horizon / 2 >= self._loaded_until:
+                self._load(now)
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                _, ride_id = heapq.heappop(self._heap)
+                self._queued.discard(ride_id)
+                due.append(ride_id)
+
+        settled = 0
+        for start in range(0, len(due), SETTLE_CHUNK):
+            chunk = due[start:start + SETTLE_CHUNK]
+            try:
+                settled += len(self.settle(chunk, now))
+            except IntegrityError:
+                # A winner took another ride in between, the chunk is tried again next tick
+                logger.warning("Bid window chunk collided with an accept, retrying")
+                with self._lock:
+                    for ride_id in chunk:
+                        self._push(now + timedelta(seconds=self.tick_interval), ride_id)
+        return settled
+
+    def settle(self, ride_ids, now):
+        """
+        Accepts the best bid of each of `ride_ids` whose window has closed,
+        in one transaction. Returns [(ride_id, driver_id, bid_id)].
+        """
+        from .models import Ride, RideBid, RideEvent
+
+        with transaction.atomic():
+            rides = {ride_id: (fare, lat, lon, status) for ride_id, fare, lat, lon, status in
+                     Ride.objects.select_for_update().filter(
+                         id__in=ride_ids, status__in=('scheduled', 'requested'), driver__isnull=True,
+                         pooled_with__isnull=True, bid_window_closes_at__lte=now,
+                     ).values_list('id', 'estimated_fare', 'pickup_latitude', 'pickup_longitude', 'status')}
+            # Released late by the scheduler, tried again next tick
+            for ride_id in [ride_id for ride_id, ride in rides.items() if ride[3] == 'scheduled']:
+                del rides[ride_id]
+                with self._lock:
+                    self._push(now + timedelta(seconds=self.tick_interval), ride_id)
+            # Non-positive amounts stored before bids were validated never win
+            bids = list(RideBid.objects.filter(ride_id__in=rides, status='pending', amount__gt=0)
+                        .values_list('id', 'ride_id', 'driver_id', 'amount', 'driver__rating'))
+            if not bids:
+                return []
+            busy = set(Ride.objects.filter(driver_id__in={bid[2] for bid in bids}, status__in=ACTIVE_RIDE_STATUSES)
+                       .values_list('driver_id', flat=True))
+
+            amounts = np.array([float(bid[3]) for bid in bids])
+            # Rides booked without a fare are judged against their cheapest bid
+            cheapest = {}
+            for bid, amount in zip(bids, amounts):
+                cheapest[bid[1]] = min(cheapest.get(bid[1], amount), amount)
+            reference = [float(rides[bid[1]][0] or cheapest[bid[1]]) or 1.0 for bid in bids]
+            pickup_kms = []
+            for _, ride_id, driver_id, _, _ in bids:
+                entry = location_store.get(driver_id)
+                pickup_kms.append(np.nan if entry is None else haversine_distance(
+                    entry['latitude'], entry['longitude'], rides[ride_id][1], rides[ride_id][2]))
+            scores = bid_scores(amounts, reference, [bid[4] for bid in bids], np.array(pickup_kms))
+
+            # Earliest window first, each ride's bids best first
+            position = {ride_id: i for i, ride_id in enumerate(ride_ids)}
+            order = np.lexsort((scores, [position[bid[1]] for bid in bids]))
+            winners, taken = {}, set(busy)
+            for i in order.tolist():
+                bid_id, ride_id, driver_id, amount, _ = bids[i]
+                if ride_id in winners or driver_id in taken:
+                    continue
+                winners[ride_id] = (driver_id, bid_id, amount)
+                taken.add(driver_id)
+            if not winners:
+                return []
+
+            cases = list(winners.items())
+            stamp = timezone.now()
+            # Re-checked in the UPDATE itself, select_for_update locks nothing on SQLite
+            updated = Ride.objects.filter(id__in=winners, status='requested', driver__isnull=True).update(
+                driver_id=Case(*[When(id=ride_id, then=Value(driver_id)) for ride_id, (driver_id, _, _) in cases],
+                               output_field=IntegerField()),
+                actual_fare=Case(*[When(id=ride_id, then=Value(amount)) for ride_id, (_, _, amount) in cases],
+                                 output_field=DecimalField(max_digits=10, decimal_places=2)),
+                status='accepted',
+                updated_at=stamp,
+            )
+            if updated < len(cases):
+                moved = updated_ids(list(winners), 'accepted', stamp)
+                winners = {ride_id: winner for ride_id, winner in winners.items() if ride_id in moved}
+                cases = list(winners.items())
+                if not cases:
+                    return []
+            RideBid.objects.filter(ride_id__in=winners).update(status=Case(
+                When(id__in=[bid_id for _, bid_id, _ in winners.values()], then=Value('accepted')),
+                default=Value('rejected'),
+            ))
+            RideEvent.objects.bulk_create([
+                RideEvent(ride_id=ride_id, event='accept', from_status='requested', to_status='accepted',
+                          data={'bid_id': bid_id, 'amount': str(amount), 'bid_window': True})
+                for ride_id, (_, bid_id, amount) in cases
+            ])
+            pairs = [(ride_id, driver_id) for ride_id, (driver_id, _, _) in cases]
+            board_pool_riders(pairs)
+            transaction.on_commit(lambda: self._after_commit(pairs))
+        return [(ride_id, driver_id, bid_id) for ride_id, (driver_id, bid_id, _) in cases]
+
+    def _after_commit(self, pairs):
+        for ride_id, driver_id in pairs:
+            open_rides.remove(ride_id)
+            location_store.set_status(driver_id, 'busy')
+        bid_book.close([ride_id for ride_id, _ in pairs], 'accepted')
+
+    def ensure_running(self):
+        if not self.tick_interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='bid-windows', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.tick_interval):
+            try:
+                settled = self.tick()
+                if settled:
+                    logger.info("Settled %d bid windows", settled)
+            except Exception:
+                logger.exception("Bid window settlement failed")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self._heap = []
+            self._queued = set()
+            self._loaded_until = None
+
+
+bid_windows = BidWindowResolver()
+atexit.register(bid_windows.stop)
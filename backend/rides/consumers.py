@@ -0,0 +1,103 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from .bid_book import bid_book, bids_group
+from .driver_stream import driver_stream
+from .location_store import location_store
+from .serializers import DriverSnapshotSerializer
+from .spatial import valid_bbox
+
+
+class DriverFeedConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Streams driver positions for a map viewport.
+
+    Send {"action": "subscribe", "bbox": [south, west, north, east]} to get a
+    snapshot of the drivers inside it, then batched "drivers" updates for
+    that box every tick. Subscribing again replaces the viewport.
+    """
+
+    async def connect(self):
+        await self.accept()
+
+    async def disconnect(self, code):
+        driver_stream.unsubscribe(self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        if content.get('action') != 'subscribe':
+            await self.send_json({"type": "error", "error": "Unknown action"})
+            return
+        try:
+            south, west, north, east = (float(v) for v in content.get('bbox'))
+        except (TypeError, ValueError):
+            await self.send_json({"type": "error", "error": "bbox must be [south, west, north, east]"})
+            return
+        if not valid_bbox(south, west, north, east):
+            await self.send_json({"type": "error", "error": "bbox must be [south, west, north, east]"})
+            return
+
+        bbox = (south, west, north, east)
+        cursor, snapshot = await database_sync_to_async(self.snapshot)(bbox)
+        driver_stream.subscribe(self.channel_name, bbox)
+        driver_stream.ensure_running(cursor)
+        await self.send_json({"type": "snapshot", "drivers": snapshot})
+
+    def snapshot(self, bbox):
+        cursor = location_store.cursor
+        return cursor, DriverSnapshotSerializer(location_store.in_bbox(bbox), many=True).data
+
+    async def drivers_update(self, event):
+        await self.send_json({"type": "drivers", "drivers": event['drivers'], "removed": event['removed']})
+
+
+class RideBidsConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Pushes a ride's cheapest bids to its passenger.
+
+    Connect to ws/rides/<id>/bids/?token=<access token>. The first message
+    is a "snapshot" of the top bids with its cursor, then every change to
+    them comes as "bids" with the new cursor, and "closed" once the ride
+    stops taking bids.
+    """
+
+    async def connect(self):
+        self.ride_id = int(self.scope['url_route']['kwargs']['ride_id'])
+        token = parse_qs(self.scope.get('query_string', b'').decode()).get('token', [''])[0]
+        if not await database_sync_to_async(self.authorized)(token):
+            await self.close(code=4403)
+            return
+        self.group = bids_group(self.ride_id)
+        # Joined before the snapshot is taken, pushes older than it are skipped by cursor
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+        self.cursor, bids, count = await database_sync_to_async(bid_book.snapshot)(self.ride_id)
+        await self.send_json({"type": "snapshot", "cursor": self.cursor, "bids": bids, "count": count})
+
+    def authorized(self, token):
+        from .models import Ride
+
+        auth = JWTAuthentication()
+        try:
+            user = auth.get_user(auth.get_validated_token(token))
+        except (InvalidToken, TokenError):
+            return False
+        return Ride.objects.filter(id=self.ride_id, passenger=user, status='requested').exists()
+
+    async def disconnect(self, code):
+        if hasattr(self, 'group'):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def bids_top(self, event):
+        if int(event['cursor'].rpartition('.')[2]) <= int(self.cursor.rpartition('.')[2]):
+            return
+        self.cursor = event['cursor']
+        await self.send_json({"type": "bids", "cursor": event['cursor'], "bids": event['bids'],
+                              "count": event['count']})
+
+    async def bids_closed(self, event):
+        await self.send_json({"type": "closed", "status": event['status']})
+        await self.close()
@@ -0,0 +1,316 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from .bid_book import bid_book
+from .location_store import ACTIVE_RIDE_STATUSES, location_store
+from .pooling import board_pool_riders
+from .ride_index import open_rides
+from .roads import road_graph
+from .state_machine import TRANSITIONS, record_accepts, updated_ids
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371
+MATRIX_CHUNK_ROWS = 1024
+GREEDY_CANDIDATES = 8
+COMMIT_CHUNK = 500
+
+
+def haversine_matrix(lat1, lon1, lat2, lon2):
+    # km from every (lat1, lon1) row point to every (lat2, lon2) column point
+    lat1, lon1 = np.radians(np.asarray(lat1, dtype=float))[:, None], np.radians(np.asarray(lon1, dtype=float))[:, None]
+    lat2, lon2 = np.radians(np.asarray(lat2, dtype=float))[None, :], np.radians(np.asarray(lon2, dtype=float))[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def hungarian(cost):
+    """
+    Minimum-cost assignment on a dense matrix, [(row, col)] with one pair
+    per row or column, whichever is fewer. Shortest augmenting path
+    (Jonker-Volgenant style potentials), O(n^2 m) with the inner scans
+    vectorized.
+    """
+    cost = np.asarray(cost, dtype=float)
+    if cost.shape[0] > cost.shape[1]:
+        return [(row, col) for col, row in hungarian(cost.T)]
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, dtype=int)  # owner[j]: 1-based row holding column j, 0 if free
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        owner[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+    return [(owner[j] - 1, j - 1) for j in range(1, m + 1) if owner[j]]
+
+
+def greedy_assign(ride_points, driver_points, max_km, candidates=GREEDY_CANDIDATES):
+    """
+    Approximate assignment for windows too big for hungarian(). Each ride
+    keeps its `candidates` nearest drivers, edges are taken cheapest first,
+    and rides whose candidates were all taken get another round against
+    the drivers that are left.
+    """
+    ride_points = np.asarray(ride_points, dtype=float).reshape(-1, 2)
+    driver_points = np.asarray(driver_points, dtype=float).reshape(-1, 2)
+    rides = np.arange(len(ride_points))
+    drivers = np.arange(len(driver_points))
+    pairs = []
+    while len(rides) and len(drivers):
+        k = min(candidates, len(drivers))
+        edge_rides, edge_drivers, edge_costs = [], [], []
+        for start in range(0, len(rides), MATRIX_CHUNK_ROWS):
+            chunk = rides[start:start + MATRIX_CHUNK_ROWS]
+            costs = haversine_matrix(ride_points[chunk, 0], ride_points[chunk, 1],
+                                     driver_points[drivers, 0], driver_points[drivers, 1])
+            nearest = np.argpartition(costs, k - 1, axis=1)[:, :k]
+            nearest_costs = np.take_along_axis(costs, nearest, axis=1)
+            ok = nearest_costs <= max_km
+            edge_rides.append(np.broadcast_to(chunk[:, None], nearest.shape)[ok])
+            edge_drivers.append(drivers[nearest[ok]])
+            edge_costs.append(nearest_costs[ok])
+        edge_costs = np.concatenate(edge_costs)
+        order = np.argsort(edge_costs, kind='stable')
+        edge_rides = np.concatenate(edge_rides)[order].tolist()
+        edge_drivers = np.concatenate(edge_drivers)[order].tolist()
+
+        taken_rides, taken_drivers = set(), set()
+        for ride, driver in zip(edge_rides, edge_drivers):
+            if ride in taken_rides or driver in taken_drivers:
+                continue
+            taken_rides.add(ride)
+            taken_drivers.add(driver)
+            pairs.append((ride, driver))
+        if not taken_rides:
+            break
+        # Only rides that still had a reachable driver are worth another round
+        rides = np.setdiff1d(np.unique(edge_rides), list(taken_rides))
+        drivers = np.setdiff1d(drivers, list(taken_drivers))
+    return pairs
+
+
+def match(rides, drivers, max_km, hungarian_max_cells=None, road_max_cells=None):
+    """
+    Pairs pending rides with available drivers, minimising total pickup
+    distance. rides and drivers are [(id, lat, lon)], returns
+    [(ride_id, driver_id, pickup_km)]. Pairs further apart than max_km are
+    never made. Windows up to road_max_cells use driving distance when the
+    road graph is loaded, larger ones straight-line distance.
+    """
+    if not rides or not drivers:
+        return []
+    if hungarian_max_cells is None:
+        hungarian_max_cells = getattr(settings, 'RIDES_DISPATCH_HUNGARIAN_MAX_CELLS', 250000)
+    if road_max_cells is None:
+        road_max_cells = getattr(settings, 'RIDES_DISPATCH_ROAD_MAX_CELLS', 2500)
+    ride_points = np.array([(lat, lon) for _, lat, lon in rides], dtype=float)
+    driver_points = np.array([(lat, lon) for _, lat, lon in drivers], dtype=float)
+
+    if len(rides) * len(drivers) <= hungarian_max_cells:
+        costs = haversine_matrix(ride_points[:, 0], ride_points[:, 1], driver_points[:, 0], driver_points[:, 1])
+        if len(rides) * len(drivers) <= road_max_cells and road_graph.available:
+            # Driver -> pickup by road, straight line where either end is off the network
+            road_km, _ = road_graph.matrix(driver_points, ride_points, max_km=max_km)
+            costs = np.where(np.isnan(road_km.T), costs, road_km.T)
+        # Out-of-range pairs cost more than any set of in-range ones, so the
+        # solver matches as many rides as it can before it minimises distance
+        penalty = max_km * min(len(rides), len(drivers)) + 1
+        pairs = hungarian(np.where(costs <= max_km, costs, penalty))
+        pairs = [(r, d) for r, d in pairs if costs[r, d] <= max_km]
+    else:
+        pairs = greedy_assign(ride_points, driver_points, max_km)
+        costs = None
+
+    out = []
+    for r, d in pairs:
+        if costs is not None:
+            pickup_km = float(costs[r, d])
+        else:
+            pickup_km = float(haversine_matrix(ride_points[r:r + 1, 0], ride_points[r:r + 1, 1],
+                                               driver_points[d:d + 1, 0], driver_points[d:d + 1, 1])[0, 0])
+        out.append((rides[r][0], drivers[d][0], pickup_km))
+    return out
+
+
+class Dispatcher:
+    """
+    Batch matching of requested rides to online drivers.
+
+    With RIDES_DISPATCH_MODE = 'batch', a background thread runs a matching
+    window every RIDES_DISPATCH_INTERVAL seconds. The window collects the
+    pending rides and the free drivers, solves the assignment for the least
+    total pickup distance, and commits it in one transaction. The
+    `dispatch` management command runs the same windows on demand; it
+    has no live location store, so it reads and busies drivers through
+    their DriverLocation rows instead (from_db=True).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'RIDES_DISPATCH_MODE', 'fcfs') == 'batch'
+
+    @property
+    def interval(self):
+        return getattr(settings, 'RIDES_DISPATCH_INTERVAL', 5.0)
+
+    @property
+    def max_pickup_km(self):
+        return getattr(settings, 'RIDES_DISPATCH_MAX_PICKUP_KM', 5.0)
+
+    def run_window(self, from_db=False):
+        # One matching window, returns its counts and timings
+        from .models import Ride
+
+        started = time.perf_counter()
+        # Rides still taking bids are left to their bid window
+        rides = list(Ride.objects.filter(status='requested', driver__isnull=True, pooled_with__isnull=True)
+                     .filter(Q(bid_window_closes_at__isnull=True) | Q(bid_window_closes_at__lte=timezone.now()))
+                     .values_list('id', 'pickup_latitude', 'pickup_longitude'))
+        drivers = self.online_drivers(from_db)
+        collected = time.perf_counter()
+        pairs = match(rides, drivers, self.max_pickup_km)
+        matched = time.perf_counter()
+        assigned = self.commit(pairs, from_db)
+        return {
+            'rides': len(rides),
+            'drivers': len(drivers),
+            'matched': len(assigned),
+            'pickup_km': round(sum(km for _, _, km in assigned), 3),
+            'collect_ms': round((collected - started) * 1000, 1),
+            'match_ms': round((matched - collected) * 1000, 1),
+            'commit_ms': round((time.perf_counter() - matched) * 1000, 1),
+        }
+
+    @staticmethod
+    def online_drivers(from_db=False):
+        # [(driver_id, lat, lon)] of the free drivers
+        if not from_db:
+            return [(entry['user_id'], entry['latitude'], entry['longitude'])
+                    for entry in location_store.all() if entry['status'] == 'online']
+        from .models import DriverLocation
+
+        # Rows only go offline when the web process sweeps them, skip the silent ones here too
+        cutoff = timezone.now() - timedelta(seconds=location_store.ttl)
+        return list(DriverLocation.objects.filter(status='online', updated_at__gte=cutoff)
+                    .values_list('user_id', 'latitude', 'longitude'))
+
+    def commit(self, pairs, from_db=False):
+        """
+        Writes [(ride_id, driver_id, pickup_km)] as accepted rides in one
+        transaction. Rides taken and drivers busied since the window was
+        collected are skipped. Returns the pairs that were applied.
+        """
+        from .models import DriverLocation, Ride, RideBid
+
+        if not pairs:
+            return []
+        with transaction.atomic():
+            sources, target = TRANSITIONS['accept']
+            still_open = set(Ride.objects.select_for_update()
+                             .filter(id__in=[ride_id for ride_id, _, _ in pairs], status__in=sources, driver__isnull=True)
+                             .values_list('id', flat=True))
+            busy = set(Ride.objects.filter(driver_id__in=[driver_id for _, driver_id, _ in pairs],
+                                           status__in=ACTIVE_RIDE_STATUSES)
+                       .values_list('driver_id', flat=True))
+            pairs = [p for p in pairs if p[0] in still_open and p[1] not in busy]
+            now = timezone.now()
+            applied = []
+            for start in range(0, len(pairs), COMMIT_CHUNK):
+                chunk = pairs[start:start + COMMIT_CHUNK]
+                ride_ids = [ride_id for ride_id, _, _ in chunk]
+                # Re-checked in the UPDATE itself, select_for_update locks nothing on SQLite
+                updated = Ride.objects.filter(id__in=ride_ids, status__in=sources, driver__isnull=True).update(
+                    driver_id=Case(*[When(id=ride_id, then=Value(driver_id)) for ride_id, driver_id, _ in chunk],
+                                   output_field=IntegerField()),
+                    status=target,
+                    updated_at=now,
+                )
+                if updated < len(chunk):
+                    moved = updated_ids(ride_ids, target, now)
+                    chunk = [p for p in chunk if p[0] in moved]
+                    ride_ids = [ride_id for ride_id, _, _ in chunk]
+                RideBid.objects.filter(ride_id__in=ride_ids, status='pending').update(status='rejected')
+                applied += chunk
+            pairs = applied
+            record_accepts(pairs)
+            board_pool_riders([(ride_id, driver_id) for ride_id, driver_id, _ in pairs])
+            if from_db:
+                DriverLocation.objects.filter(user_id__in=[driver_id for _, driver_id, _ in pairs]).update(status='busy')
+            transaction.on_commit(lambda: self._after_commit(pairs, from_db))
+        return pairs
+
+    def _after_commit(self, pairs, from_db=False):
+        for ride_id, driver_id, _ in pairs:
+            open_rides.remove(ride_id)
+            if not from_db:
+                location_store.set_status(driver_id, 'busy')
+        bid_book.close([ride_id for ride_id, _, _ in pairs], 'accepted')
+
+    def ensure_running(self):
+        if not (self.enabled and self.interval) or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ride-dispatch', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                stats = self.run_window()
+                if stats['matched']:
+                    logger.info("Dispatch window: %s", stats)
+            except Exception:
+                logger.exception("Dispatch window failed")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+dispatcher = Dispatcher()
+atexit.register(dispatcher.stop)
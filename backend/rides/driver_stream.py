@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .location_store import location_store
+from .serializers import DriverSnapshotSerializer
+from .spatial import bbox_cell_count, cells_in_bbox, grid_cell, grid_cell_size, in_bbox
+
+logger = logging.getLogger(__name__)
+
+# Viewports wider than this many cells are matched by bbox only, not indexed per cell
+MAX_SUBSCRIPTION_CELLS = 2500
+
+
+class DriverStreamHub:
+    """
+    Fans driver position changes out to WebSocket subscribers.
+
+    Subscribers are indexed by the grid cells their viewport covers, so a
+    changed driver only reaches the subscribers of its own cell. Changes are
+    pulled from the location store's change log once per tick.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self._lock = threading.RLock()
+        self._subscribers = {}  # channel_name -> bbox
+        self._cells = {}  # cell -> set of channel_names
+        self._wide = set()
+        self._cursor = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    @property
+    def tick_interval(self):
+        return getattr(settings, 'RIDES_DRIVER_STREAM_TICK', 1.0)
+
+    def subscribe(self, channel_name, bbox):
+        with self._lock:
+            self.unsubscribe(channel_name)
+            self._subscribers[channel_name] = bbox
+            size = self.size or grid_cell_size()
+            if bbox_cell_count(*bbox, size=size) > MAX_SUBSCRIPTION_CELLS:
+                self._wide.add(channel_name)
+                return
+            for cell in cells_in_bbox(*bbox, size=size):
+                self._cells.setdefault(cell, set()).add(channel_name)
+
+    def unsubscribe(self, channel_name):
+        with self._lock:
+            bbox = self._subscribers.pop(channel_name, None)
+            if bbox is None:
+                return
+            if channel_name in self._wide:
+                self._wide.discard(channel_name)
+                return
+            for cell in cells_in_bbox(*bbox, size=self.size or grid_cell_size()):
+                channels = self._cells.get(cell)
+                if channels is not None:
+                    channels.discard(channel_name)
+                    if not channels:
+                        del self._cells[cell]
+
+    def _subscribers_for(self, lat, lon):
+        cell = grid_cell(lat, lon, self.size)
+        for channel_name in self._cells.get(cell, ()):
+            if in_bbox(lat, lon, self._subscribers[channel_name]):
+                yield channel_name
+        for channel_name in self._wide:
+            if in_bbox(lat, lon, self._subscribers[channel_name]):
+                yield channel_name
+
+    def route(self, changed, removed):
+        # {channel_name: {"drivers": [...], "removed": [...]}} for this batch of changes
+        with self._lock:
+            return self._route(changed, removed)
+
+    def _route(self, changed, removed):
+        batches = {}
+        for entry in changed:
+            data = None
+            for channel_name in self._subscribers_for(entry['latitude'], entry['longitude']):
+                if data is None:
+                    data = DriverSnapshotSerializer(entry).data
+                batch = batches.setdefault(channel_name, {"drivers": [], "removed": []})
+                batch["drivers"].append(data)
+        for entry in removed:
+            for channel_name in self._subscribers_for(entry['latitude'], entry['longitude']):
+                batch = batches.setdefault(channel_name, {"drivers": [], "removed": []})
+                batch["removed"].append(entry['username'])
+        return batches
+
+    def collect(self):
+        # Changes since the previous tick, routed to subscribers
+        cursor = location_store.cursor
+        changes = location_store.changes_since(self._cursor)
+        self._cursor = cursor
+        if changes is None:
+            return {}
+        return self.route(*changes)
+
+    async def tick(self):
+        batches = await database_sync_to_async(self.collect)()
+        layer = get_channel_layer()
+        for channel_name, batch in batches.items():
+            try:
+                await layer.send(channel_name, {"type": "drivers.update", **batch})
+            except ChannelFull:
+                # Slow client, it will catch up on the next tick
+                logger.debug("Dropped driver update for %s", channel_name)
+
+    def ensure_running(self, cursor):
+        # cursor: store cursor taken before the subscriber's snapshot
+        if self._task is None or self._task.done():
+            self._cursor = cursor
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._subscribers:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Driver stream tick failed")
+            await asyncio.sleep(self.tick_interval)
+
+
+driver_stream = DriverStreamHub()
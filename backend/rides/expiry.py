@@ -0,0 +1,123 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .bid_book import bid_book
+from .location_store import ACTIVE_RIDE_STATUSES, location_store
+from .ride_index import open_rides
+from .state_machine import transition_many
+
+logger = logging.getLogger(__name__)
+
+
+class ExpirySweeper:
+    """
+    Cancels rides nobody is going to finish.
+
+    Requested rides older than RIDES_REQUEST_TIMEOUT seconds expire.
+    Accepted and in-progress rides are abandoned when neither the ride nor
+    the driver's location has been updated for RIDES_ABANDON_TIMEOUT
+    seconds. Both are range scans on the (status, created_at/updated_at)
+    indexes, cancelled RIDES_EXPIRY_CHUNK rows per UPDATE.
+
+    Runs every RIDES_EXPIRY_INTERVAL seconds in a background thread, or
+    through the `expire_rides` management command.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def interval(self):
+        return getattr(settings, 'RIDES_EXPIRY_INTERVAL', 60)
+
+    @property
+    def chunk_size(self):
+        return getattr(settings, 'RIDES_EXPIRY_CHUNK', 500)
+
+    def sweep(self, now=None):
+        # One pass, returns how many rides it cancelled and how long it took
+        from .models import Ride, RideBid
+
+        started = time.perf_counter()
+        now = now or timezone.now()
+        request_cutoff = now - timedelta(seconds=getattr(settings, 'RIDES_REQUEST_TIMEOUT', 600))
+        abandon_cutoff = now - timedelta(seconds=getattr(settings, 'RIDES_ABANDON_TIMEOUT', 1800))
+
+        # Released bookings count from their pickup time, not from when they were made
+        expired = self._drain(
+            Ride.objects.filter(status='requested', created_at__lt=request_cutoff).filter(
+                Q(scheduled_for__isnull=True) | Q(scheduled_for__lt=request_cutoff)
+            ),
+            'expire',
+        )
+        for ride_id, _, _ in expired:
+            open_rides.remove(ride_id)
+        bid_book.close([ride_id for ride_id, _, _ in expired], 'cancelled')
+        for start in range(0, len(expired), self.chunk_size):
+            RideBid.objects.filter(ride_id__in=[ride_id for ride_id, _, _ in expired[start:start + self.chunk_size]],
+                                   status='pending').update(status='rejected')
+
+        abandoned = self._drain(
+            Ride.objects.filter(status__in=ACTIVE_RIDE_STATUSES, updated_at__lt=abandon_cutoff).filter(
+                Q(driver__location__isnull=True) | Q(driver__location__updated_at__lt=abandon_cutoff)
+            ),
+            'abandon',
+        )
+        for ride_id, _, driver_id in abandoned:
+            location_store.end_trip(driver_id, ride_id)
+
+        return {
+            'expired': len(expired),
+            'abandoned': len(abandoned),
+            'ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    def _drain(self, queryset, event):
+        # Chunked bulk transitions until nothing matches
+        moved = []
+        while True:
+            rows = transition_many(queryset, event, self.chunk_size)
+            moved.extend(rows)
+            if len(rows) < self.chunk_size:
+                return moved
+
+    def ensure_running(self):
+        if not self.interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ride-expiry', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                stats = self.sweep()
+                if stats['expired'] or stats['abandoned']:
+                    logger.info("Ride expiry sweep: %s", stats)
+            except Exception:
+                logger.exception("Ride expiry sweep failed")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+expiry_sweeper = ExpirySweeper()
+atexit.register(expiry_sweeper.stop)
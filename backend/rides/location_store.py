@@ -0,0 +1,512 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .spatial import GridIndex, grid_cell_key, motion_from_fixes, predict_position
+from .traces import trace_buffer
+
+logger = logging.getLogger(__name__)
+
+FLUSH_FIELDS = ['latitude', 'longitude', 'vehicle_type', 'grid_cell', 'status', 'updated_at']
+ACTIVE_RIDE_STATUSES = ['accepted', 'in_progress']
+MAX_TOMBSTONES = 10000
+
+
+class MemoryBackend:
+    """Keeps the latest entry per driver in a dict. No server needed."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, user_id):
+        return self._entries.get(user_id)
+
+    def set(self, user_id, entry):
+        self._entries[user_id] = entry
+
+    def delete(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def values(self):
+        return list(self._entries.values())
+
+    def clear(self):
+        self._entries.clear()
+
+
+class RateMeter:
+    """Events per second over a sliding window of two buckets."""
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self._bucket_start = time.monotonic()
+        self._current = 0
+        self._previous = 0
+
+    def _roll(self, now):
+        elapsed = now - self._bucket_start
+        if elapsed >= self.window:
+            self._previous = self._current if elapsed < 2 * self.window else 0
+            self._current = 0
+            self._bucket_start = now - elapsed % self.window
+
+    def hit(self):
+        self._roll(time.monotonic())
+        self._current += 1
+
+    def rate(self):
+        now = time.monotonic()
+        self._roll(now)
+        # Weight the previous bucket by how much of it is still inside the window
+        weight = 1 - (now - self._bucket_start) / self.window
+        return (self._current + self._previous * weight) / self.window
+
+
+DEFAULT_PING_INTERVALS = {
+    'trip': 5,  # on an in-progress ride, never backed off
+    'pickup': 10,  # busy, heading to the pickup
+    'moving': 15,  # online and moving
+    'parked': 45,  # online and standing still
+}
+
+
+class LocationStore:
+    """
+    Write-behind store for driver location pings.
+
+    Pings land in the backend and the grid index, reads are answered from
+    memory, and dirty drivers are written to DriverLocation in batches every
+    RIDES_LOCATION_FLUSH_INTERVAL seconds. An interval of 0 writes through.
+
+    Every change bumps a sequence number, which is what feed cursors and
+    ETags are built from.
+
+    Drivers are online, busy (on a ride) or offline. Offline drivers leave
+    the store; drivers that stop pinging for RIDES_DRIVER_TTL seconds are
+    swept offline. Online drivers get their own grid index, so "free
+    drivers near here" never looks at busy ones.
+
+    Pings from a driver on an in-progress ride are also buffered for that
+    ride's trace and appended on the same flush.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._index = GridIndex()
+        self._available = GridIndex()
+        self._last_ping = OrderedDict()  # user_id -> updated_at, oldest first
+        self._trips = {}  # driver user_id -> {in-progress ride_id}, several when pooling
+        self._last_sweep = 0.0
+        self._pings = RateMeter()
+        self._dirty = set()
+        self._loaded = False
+        self._flusher = None
+        self._stop = threading.Event()
+        self._new_epoch()
+
+    def _new_epoch(self):
+        # Cursors from another epoch (restart, reset) force a full snapshot
+        self._epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._horizon = 0
+        self._changes = OrderedDict()  # user_id -> seq of last change, oldest first
+        self._tombstones = {}  # user_id -> last entry of drivers that left the feed
+
+    def _touch(self, user_id):
+        self._seq += 1
+        self._changes[user_id] = self._seq
+        self._changes.move_to_end(user_id)
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            path = getattr(settings, 'RIDES_LOCATION_BACKEND', 'rides.location_store.MemoryBackend')
+            self._backend = import_string(path)()
+        return self._backend
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'RIDES_LOCATION_FLUSH_INTERVAL', 2.0)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'RIDES_LOCATION_FLUSH_BATCH_SIZE', 500)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'RIDES_DRIVER_TTL', 120)
+
+    def _index_entry(self, entry):
+        # Indexed first, so an entry that can't be bucketed never reaches the backend
+        user_id = entry['user_id']
+        self._index.upsert(user_id, entry['latitude'], entry['longitude'])
+        if entry['status'] == 'online':
+            self._available.upsert(user_id, entry['latitude'], entry['longitude'])
+        else:
+            self._available.remove(user_id)
+        self.backend.set(user_id, entry)
+        self._tombstones.pop(user_id, None)
+        self._touch(user_id)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        from .models import DriverLocation, Ride
+
+        with self._lock:
+            if self._loaded:
+                return
+            rows = DriverLocation.objects.exclude(status='offline').order_by('updated_at').values(
+                'id', 'user_id', 'user__username', 'latitude', 'longitude', 'vehicle_type', 'status', 'updated_at'
+            )
+            for row in rows:
+                entry = {
+                    'pk': row['id'],
+                    'user_id': row['user_id'],
+                    'username': row['user__username'],
+                    'latitude': row['latitude'],
+                    'longitude': row['longitude'],
+                    'vehicle_type': row['vehicle_type'],
+                    'status': row['status'],
+                    'updated_at': row['updated_at'],
+                    'recorded_at': row['updated_at'],
+                    'speed_kmh': 0.0,
+                    'heading': None,
+                }
+                self._index_entry(entry)
+                self._last_ping[entry['user_id']] = entry['updated_at']
+            self._trips = {}
+            for driver_id, ride_id in Ride.objects.filter(status='in_progress').values_list('driver_id', 'id'):
+                self._trips.setdefault(driver_id, set()).add(ride_id)
+            trace_buffer.restore([ride_id for ride_ids in self._trips.values() for ride_id in ride_ids])
+            self._loaded = True
+
+    def _reconnect_status(self, user_id):
+        # Only hit on offline -> online, a driver coming back mid-ride is still busy
+        from .models import Ride
+
+        if Ride.objects.filter(driver_id=user_id, status__in=ACTIVE_RIDE_STATUSES).exists():
+            return 'busy'
+        return 'online'
+
+    def update(self, user, latitude, longitude, vehicle_type='car', recorded_at=None, previous_fix=None):
+        # recorded_at is the device time of the fix, defaults to now. previous_fix
+        # (lat, lon, recorded_at) overrides the live entry as the base for velocity.
+        self._ensure_loaded()
+        status = None
+        if self.backend.get(user.id) is None:
+            status = self._reconnect_status(user.id)
+        with self._lock:
+            previous = self.backend.get(user.id)
+            now = timezone.now()
+            recorded_at = recorded_at or now
+            speed_kmh, heading = 0.0, None
+            if previous is not None:
+                speed_kmh, heading = previous['speed_kmh'], previous['heading']
+                previous_fix = previous_fix or (previous['latitude'], previous['longitude'], previous['recorded_at'])
+            if previous_fix is not None:
+                # Velocity from the last two fixes, for client-side dead reckoning
+                motion = motion_from_fixes(*previous_fix, latitude, longitude, recorded_at, prev_heading=heading)
+                if motion is not None:
+                    speed_kmh, heading = motion
+            entry = {
+                'pk': previous['pk'] if previous else None,
+                'user_id': user.id,
+                'username': user.username,
+                'latitude': latitude,
+                'longitude': longitude,
+                'vehicle_type': vehicle_type,
+                'status': previous['status'] if previous else status or 'online',
+                'updated_at': now,
+                'recorded_at': recorded_at,
+                'speed_kmh': speed_kmh,
+                'heading': heading,
+            }
+            self._index_entry(entry)
+            self._last_ping[user.id] = now
+            self._last_ping.move_to_end(user.id)
+            self._dirty.add(user.id)
+            self._pings.hit()
+        self.trip_point(user.id, latitude, longitude, entry['recorded_at'])
+
+        self._schedule_flush()
+        return entry
+
+    def _schedule_flush(self):
+        if self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def set_status(self, user_id, status):
+        # Availability change from a ride transition or the driver going offline
+        from .models import DriverLocation
+
+        self._ensure_loaded()
+        with self._lock:
+            entry = self.backend.get(user_id)
+            if entry is not None and status == 'offline':
+                self._remove(user_id)
+            elif entry is not None:
+                self._index_entry(dict(entry, status=status))
+                self._dirty.add(user_id)
+
+        if entry is None or status == 'offline':
+            # Not held in memory (or leaving it), so write the row directly
+            DriverLocation.objects.filter(user_id=user_id).update(status=status)
+        else:
+            self._schedule_flush()
+
+    def next_update_in(self, entry):
+        """
+        Seconds the driver app should wait before its next ping.
+
+        Based on the driver's state and movement. Everything but in-trip
+        pings is stretched when the ping rate goes over
+        RIDES_PING_CAPACITY, and capped well inside the offline TTL.
+        """
+        intervals = {**DEFAULT_PING_INTERVALS, **getattr(settings, 'RIDES_PING_INTERVALS', {})}
+        if entry['user_id'] in self._trips:
+            return intervals['trip']
+        if entry['status'] == 'busy':
+            interval = intervals['pickup']
+        elif entry['speed_kmh']:
+            interval = intervals['moving']
+        else:
+            interval = intervals['parked']
+        pressure = self._pings.rate() / getattr(settings, 'RIDES_PING_CAPACITY', 500)
+        if pressure > 1:
+            interval *= pressure
+        return int(min(interval, self.ttl / 2))
+
+    def begin_trip(self, user_id, ride_id, started_at):
+        self._ensure_loaded()
+        trace_buffer.start(ride_id, started_at)
+        with self._lock:
+            self._trips.setdefault(user_id, set()).add(ride_id)
+
+    def trip_point(self, user_id, latitude, longitude, recorded_at):
+        # Feeds the traces and odometers of the driver's in-progress rides, if any
+        for ride_id in self._trips.get(user_id, ()):
+            trace_buffer.append(ride_id, latitude, longitude, recorded_at)
+
+    def end_trip(self, user_id, ride_id):
+        # Stops tracing the ride, writes its remaining fixes and returns its odometer
+        self._ensure_loaded()
+        with self._lock:
+            ride_ids = self._trips.get(user_id, set())
+            if ride_id not in ride_ids:
+                return None
+            ride_ids.discard(ride_id)
+            if not ride_ids:
+                del self._trips[user_id]
+        return trace_buffer.finish(ride_id)
+
+    def sweep(self):
+        # Marks drivers that stopped pinging more than ttl seconds ago offline
+        from .models import DriverLocation
+
+        self._ensure_loaded()
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        with self._lock:
+            # Oldest pings first, so this stops at the first live driver
+            while self._last_ping:
+                user_id, pinged_at = next(iter(self._last_ping.items()))
+                if pinged_at >= cutoff:
+                    break
+                self._remove(user_id)
+        # The rows, including drivers that pinged through other processes,
+        # via the (status, updated_at) index
+        expired = DriverLocation.objects.filter(
+            status__in=['online', 'busy'], updated_at__lt=cutoff
+        ).update(status='offline')
+        self._last_sweep = time.monotonic()
+        return expired
+
+    def _remove(self, user_id):
+        # Drops a driver from the feed, clients see it under "removed". Caller holds the lock.
+        entry = self.backend.get(user_id)
+        if entry is None:
+            return None
+        self.backend.delete(user_id)
+        self._index.remove(user_id)
+        self._available.remove(user_id)
+        self._last_ping.pop(user_id, None)
+        self._dirty.discard(user_id)
+        self._tombstones[user_id] = entry
+        self._touch(user_id)
+        if len(self._tombstones) > MAX_TOMBSTONES:
+            for tombstone in self._tombstones:
+                self._changes.pop(tombstone, None)
+            self._tombstones = {}
+            self._horizon = self._seq
+        return entry
+
+    @property
+    def prediction_horizon(self):
+        return getattr(settings, 'RIDES_PREDICTION_HORIZON', 30)
+
+    def predict(self, entry, at):
+        # Where the driver should be at `at`, same model clients extrapolate with
+        elapsed = (at - entry['recorded_at']).total_seconds()
+        return predict_position(
+            entry['latitude'], entry['longitude'], entry['speed_kmh'], entry['heading'],
+            elapsed, self.prediction_horizon,
+        )
+
+    def in_bbox(self, bbox):
+        self._ensure_loaded()
+        with self._lock:
+            return [self.backend.get(user_id) for user_id in self._index.in_bbox(bbox)]
+
+    @property
+    def cursor(self):
+        self._ensure_loaded()
+        return f"{self._epoch}.{self._seq}"
+
+    def changes_since(self, cursor):
+        # (changed entries, removed entries), or None when the cursor can't be served
+        self._ensure_loaded()
+        epoch, _, seq = str(cursor).partition('.')
+        try:
+            seq = int(seq)
+        except ValueError:
+            return None
+        with self._lock:
+            if epoch != self._epoch or not self._horizon <= seq <= self._seq:
+                return None
+            changed, removed = [], []
+            for user_id, changed_seq in reversed(self._changes.items()):
+                if changed_seq <= seq:
+                    break
+                entry = self.backend.get(user_id)
+                if entry is not None:
+                    changed.append(entry)
+                else:
+                    removed.append(self._tombstones[user_id])
+            return changed, removed
+
+    def get(self, user_id):
+        self._ensure_loaded()
+        return self.backend.get(user_id)
+
+    def all(self):
+        self._ensure_loaded()
+        return self.backend.values()
+
+    def available_cell_counts(self):
+        # Online drivers per grid cell
+        self._ensure_loaded()
+        with self._lock:
+            return self._available.cell_counts()
+
+    def nearest(self, lat, lon, radius_km, limit=None, available_only=False):
+        # [(distance_km, entry)] closest first
+        self._ensure_loaded()
+        with self._lock:
+            index = self._available if available_only else self._index
+            hits = index.nearest(lat, lon, radius_km, limit)
+            return [(distance, self.backend.get(user_id)) for distance, user_id in hits]
+
+    def flush(self):
+        # Writes every dirty driver to the DB, returns how many rows were written
+        from .models import DriverLocation
+
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                entries = [self.backend.get(user_id) for user_id in dirty]
+            entries = [entry for entry in entries if entry is not None]
+
+            written = 0
+            try:
+                for start in range(0, len(entries), self.batch_size):
+                    batch = entries[start:start + self.batch_size]
+                    existing, new = [], []
+                    for entry in batch:
+                        location = DriverLocation(
+                            pk=entry['pk'],
+                            user_id=entry['user_id'],
+                            latitude=entry['latitude'],
+                            longitude=entry['longitude'],
+                            vehicle_type=entry['vehicle_type'],
+                            status=entry['status'],
+                            grid_cell=grid_cell_key(entry['latitude'], entry['longitude']),
+                            updated_at=entry['updated_at'],
+                        )
+                        (existing if entry['pk'] else new).append((entry, location))
+
+                    with transaction.atomic():
+                        if existing:
+                            DriverLocation.objects.bulk_update([loc for _, loc in existing], FLUSH_FIELDS)
+                        if new:
+                            # Upsert, another process may have created the row already
+                            DriverLocation.objects.bulk_create(
+                                [loc for _, loc in new],
+                                update_conflicts=True,
+                                unique_fields=['user'],
+                                update_fields=FLUSH_FIELDS,
+                            )
+                    for entry, location in new:
+                        entry['pk'] = location.pk
+                    written += len(batch)
+            except Exception:
+                # Keep the unwritten drivers dirty so the next flush retries them
+                with self._lock:
+                    self._dirty.update(entry['user_id'] for entry in entries[written:])
+                raise
+            trace_buffer.flush()
+            return written
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._run_flusher, name='location-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.monotonic() - self._last_sweep >= self.ttl / 4:
+                    self.sweep()
+            except Exception:
+                logger.exception("Driver location flush failed")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        # Stops the flusher and writes whatever is still pending
+        self._stop.set()
+        if self._dirty:
+            self.flush()
+
+    def reset(self):
+        with self._lock:
+            self.backend.clear()
+            self._index = GridIndex()
+            self._available = GridIndex()
+            self._last_ping = OrderedDict()
+            self._trips = {}
+            self._dirty = set()
+            self._loaded = False
+            self._new_epoch()
+
+
+location_store = LocationStore()
+atexit.register(location_store.stop)
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rides.roads import build_road_graph, road_graph
+
+
+class Command(BaseCommand):
+    help = "Builds the routing graph from an OpenStreetMap .osm (XML) extract."
+
+    def add_arguments(self, parser):
+        parser.add_argument('osm', help="Path to the .osm extract")
+        parser.add_argument('--output', default=None, help="Graph path (default RIDES_ROAD_GRAPH_PATH)")
+
+    def handle(self, *args, **options):
+        path = options['output'] or road_graph.path
+        started = time.perf_counter()
+        nodes, edges = build_road_graph(options['osm'], path)
+        # Servers load the graph once, they pick up the new one on restart
+        self.stdout.write(f"Road graph written to {path}: {nodes} nodes, {edges} edges "
+                          f"in {time.perf_counter() - started:.1f}s")
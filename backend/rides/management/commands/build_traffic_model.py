@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from rides.traffic import build_traffic_model, traffic_model
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the zone x hour-of-week traffic table from completed ride durations."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=56, help="Completed rides of this many days are used")
+        parser.add_argument('--min-samples', type=int, default=5,
+                            help="Rides a cell needs before its own measurements outweigh the city-wide hour")
+        parser.add_argument('--output', default=None, help="Table path (default RIDES_TRAFFIC_MODEL_PATH)")
+
+    def handle(self, *args, **options):
+        path = options['output'] or traffic_model.path
+        used = build_traffic_model(path, days=options['days'], min_samples=options['min_samples'])
+        # Servers load the table once, they pick up the new one on restart
+        self.stdout.write(f"Traffic model written to {path} from {used} completed rides")
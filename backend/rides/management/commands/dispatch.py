@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rides.dispatch import dispatcher
+
+
+class Command(BaseCommand):
+    help = "Runs batch dispatch windows: matches requested rides to online drivers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run a single window and exit")
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Seconds between windows (default RIDES_DISPATCH_INTERVAL)")
+
+    def handle(self, *args, **options):
+        interval = options['interval'] if options['interval'] is not None else dispatcher.interval
+        while True:
+            # Outside the web process the in-memory location store is empty or stale
+            stats = dispatcher.run_window(from_db=True)
+            self.stdout.write(
+                f"{stats['matched']}/{stats['rides']} rides matched with {stats['drivers']} drivers, "
+                f"{stats['pickup_km']} km total pickup "
+                f"(collect {stats['collect_ms']} ms, match {stats['match_ms']} ms, commit {stats['commit_ms']} ms)"
+            )
+            if options['once'] or not interval:
+                return
+            time.sleep(interval)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rides.expiry import expiry_sweeper
+
+
+class Command(BaseCommand):
+    help = "Expires stale ride requests and cancels rides abandoned by their driver."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run a single sweep and exit")
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Seconds between sweeps (default RIDES_EXPIRY_INTERVAL)")
+
+    def handle(self, *args, **options):
+        interval = options['interval'] if options['interval'] is not None else expiry_sweeper.interval
+        while True:
+            stats = expiry_sweeper.sweep()
+            self.stdout.write(
+                f"{stats['expired']} requests expired, {stats['abandoned']} abandoned rides cancelled "
+                f"in {stats['ms']} ms"
+            )
+            if options['once'] or not interval:
+                return
+            time.sleep(interval)
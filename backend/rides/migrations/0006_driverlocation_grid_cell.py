@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def fill_grid_cells(apps, schema_editor):
+    from rides.spatial import grid_cell_key
+
+    DriverLocation = apps.get_model('rides', 'DriverLocation')
+    locations = list(DriverLocation.objects.all())
+    for location in locations:
+        location.grid_cell = grid_cell_key(location.latitude, location.longitude)
+    DriverLocation.objects.bulk_update(locations, ['grid_cell'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0005_ridebid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driverlocation',
+            name='grid_cell',
+            field=models.CharField(blank=True, db_index=True, max_length=24),
+        ),
+        migrations.RunPython(fill_grid_cells, migrations.RunPython.noop),
+    ]
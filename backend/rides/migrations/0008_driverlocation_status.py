@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0007_driverlocation_updated_at_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driverlocation',
+            name='status',
+            field=models.CharField(choices=[('online', 'Online'), ('busy', 'Busy'), ('offline', 'Offline')], default='online', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='driverlocation',
+            index=models.Index(fields=['status', 'grid_cell'], name='driverloc_status_cell_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='driverlocation',
+            index=models.Index(fields=['status', 'updated_at'], name='driverloc_status_updated_idx'),
+        ),
+    ]
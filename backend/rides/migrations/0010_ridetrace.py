@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0009_locationfix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RideTrace',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField()),
+                ('encoded', models.TextField(blank=True, default='')),
+                ('point_count', models.IntegerField(default=0)),
+                ('last_lat_e5', models.IntegerField(default=0)),
+                ('last_lon_e5', models.IntegerField(default=0)),
+                ('last_t', models.IntegerField(default=0)),
+                ('simplified', models.BooleanField(default=False)),
+                ('ride', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='trace', to='rides.ride')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0010_ridetrace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ridetrace',
+            name='distance_km',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:26
+
+import logging
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+
+def cancel_duplicate_active_rides(apps, schema_editor):
+    # Drivers the old accept race gave several active rides keep one of them,
+    # the in-progress one if any, else the newest. There's no RideEvent table
+    # yet, so the cancellations are logged.
+    Ride = apps.get_model('rides', 'Ride')
+    active = Ride.objects.filter(status__in=['accepted', 'in_progress'], driver__isnull=False)
+    drivers = active.values('driver_id').annotate(rides=Count('id')).filter(rides__gt=1).values_list('driver_id', flat=True)
+    for driver_id in drivers:
+        rides = list(active.filter(driver_id=driver_id).order_by('-updated_at', '-id'))
+        keep = next((ride for ride in rides if ride.status == 'in_progress'), rides[0])
+        cancelled = [ride.id for ride in rides if ride.id != keep.id]
+        Ride.objects.filter(id__in=cancelled).update(status='cancelled')
+        logger.warning("Driver %s held %d active rides, kept ride %s and cancelled %s",
+                       driver_id, len(rides), keep.id, cancelled)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0011_ridetrace_distance_km'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_duplicate_active_rides, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='ride',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['accepted', 'in_progress'])), fields=('driver',), name='ride_one_active_per_driver'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0013_rideevent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['status', 'created_at'], name='ride_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['status', 'updated_at'], name='ride_status_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0014_ride_expiry_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='scheduled_for',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ride',
+            name='status',
+            field=models.CharField(choices=[('scheduled', 'Scheduled'), ('requested', 'Requested'), ('accepted', 'Accepted'), ('in_progress', 'In Progress'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='requested', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['status', 'scheduled_for'], name='ride_status_scheduled_idx'),
+        ),
+    ]
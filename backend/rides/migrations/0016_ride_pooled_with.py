@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0015_ride_scheduled_for'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='ride',
+            name='ride_one_active_per_driver',
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='pooled_with',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='pool_riders', to='rides.ride'),
+        ),
+        migrations.AddConstraint(
+            model_name='ride',
+            constraint=models.UniqueConstraint(condition=models.Q(('pooled_with__isnull', True), ('status__in', ['accepted', 'in_progress'])), fields=('driver',), name='ride_one_active_per_driver'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0016_ride_pooled_with'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='surge_multiplier',
+            field=models.FloatField(default=1.0, help_text='Demand surge the fare was quoted with'),
+        ),
+    ]
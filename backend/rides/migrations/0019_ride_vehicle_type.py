@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0018_ride_bid_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='vehicle_type',
+            field=models.CharField(choices=[('car', 'Car'), ('bike', 'Bike'), ('rickshaw', 'Rickshaw')], default='car', max_length=20),
+        ),
+    ]
@@ -1,18 +1,60 @@
 from django.db import models
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .polyline import decode_points
+from .spatial import grid_cell_key
 
 class DriverLocation(models.Model):
+    STATUS_CHOICES = (
+        ('online', 'Online'),
+        ('busy', 'Busy'),
+        ('offline', 'Offline'),
+    )
+
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='location')
     latitude = models.FloatField()
     longitude = models.FloatField()
     vehicle_type = models.CharField(max_length=20, default='car', choices=[('car', 'Car'), ('bike', 'Bike'), ('rickshaw', 'Rickshaw')])
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Grid cell of the current position, see rides.spatial
+    grid_cell = models.CharField(max_length=24, blank=True, db_index=True)
+    # Availability, kept up to date by ride transitions and the TTL sweep
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='online')
+
+    class Meta:
+        indexes = [
+            # "online drivers in these cells" and the TTL sweep are single index scans
+            models.Index(fields=['status', 'grid_cell'], name='driverloc_status_cell_idx'),
+            models.Index(fields=['status', 'updated_at'], name='driverloc_status_updated_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.grid_cell = grid_cell_key(float(self.latitude), float(self.longitude))
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'grid_cell'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.user.username} - {self.vehicle_type} ({self.latitude}, {self.longitude})"
 
+class LocationFix(models.Model):
+    # Driver position history, older fixes from batched uploads
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='location_fixes')
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    recorded_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'recorded_at'])]
+
+    def __str__(self):
+        return f"{self.user.username} ({self.latitude}, {self.longitude}) @ {self.recorded_at}"
+
 class Ride(models.Model):
     STATUS_CHOICES = (
+        ('scheduled', 'Scheduled'),
         ('requested', 'Requested'),
         ('accepted', 'Accepted'),
         ('in_progress', 'In Progress'),
@@ -32,20 +74,68 @@ class Ride(models.Model):
     dropoff_address = models.CharField(max_length=255)
     
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='requested')
+    # Advance bookings stay 'scheduled' until RIDES_SCHEDULE_LEAD_TIME before this
+    scheduled_for = models.DateTimeField(null=True, blank=True)
+    # Bidding closes here and the best bid is accepted, see rides.bid_windows
+    bid_window_closes_at = models.DateTimeField(null=True, blank=True)
+    # Shared rides: the host ride whose vehicle this passenger joins
+    pooled_with = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='pool_riders')
     
     # Fare and Trip Details
+    vehicle_type = models.CharField(max_length=20, default='car', choices=[('car', 'Car'), ('bike', 'Bike'), ('rickshaw', 'Rickshaw')])
     estimated_fare = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     actual_fare = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     distance_km = models.FloatField(null=True, blank=True)
     duration_minutes = models.IntegerField(null=True, blank=True)
     traffic_factor = models.FloatField(default=1.0, help_text="e.g. 1.0 for normal, 1.5 for heavy")
+    surge_multiplier = models.FloatField(default=1.0, help_text="Demand surge the fare was quoted with")
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Range scans for the expiry sweep
+            models.Index(fields=['status', 'created_at'], name='ride_status_created_idx'),
+            models.Index(fields=['status', 'updated_at'], name='ride_status_updated_idx'),
+            # Loading the scheduler's next window of bookings
+            models.Index(fields=['status', 'scheduled_for'], name='ride_status_scheduled_idx'),
+            # Loading the bid window resolver's next window of closings
+            models.Index(fields=['status', 'bid_window_closes_at'], name='ride_status_bid_window_idx'),
+        ]
+        constraints = [
+            # A driver holds at most one accepted/in-progress ride, plus its pool riders
+            models.UniqueConstraint(
+                fields=['driver'],
+                condition=models.Q(status__in=['accepted', 'in_progress'], pooled_with__isnull=True),
+                name='ride_one_active_per_driver',
+            ),
+        ]
+
     def __str__(self):
         return f"Ride #{self.id} ({self.status}) - {self.passenger.username}"
 
+class RideTrace(models.Model):
+    # GPS trace of a ride as one delta-encoded string, see rides.polyline
+    ride = models.OneToOneField(Ride, on_delete=models.CASCADE, related_name='trace')
+    started_at = models.DateTimeField()
+    encoded = models.TextField(blank=True, default='')
+    point_count = models.IntegerField(default=0)
+    # Encoder state after the last point, so appending never decodes the trace
+    last_lat_e5 = models.IntegerField(default=0)
+    last_lon_e5 = models.IntegerField(default=0)
+    last_t = models.IntegerField(default=0)
+    # Odometer reading from the raw fixes, jitter filtered
+    distance_km = models.FloatField(default=0.0)
+    simplified = models.BooleanField(default=False)
+
+    def points(self):
+        # (lat, lon, seconds since started_at), decoded lazily
+        return decode_points(self.encoded)
+
+    def __str__(self):
+        return f"Trace for Ride #{self.ride_id} ({self.point_count} points)"
+
 class Message(models.Model):
     ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -76,3 +166,26 @@ class RideBid(models.Model):
 
     def __str__(self):
         return f"Bid {self.amount} by {self.driver.username} for Ride #{self.ride.id}"
+
+
+class RideEvent(models.Model):
+    """Append-only log of ride status transitions, read incrementally by id."""
+    ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='events')
+    event = models.CharField(max_length=20)
+    from_status = models.CharField(max_length=20, blank=True)
+    to_status = models.CharField(max_length=20)
+    actor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    data = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [models.Index(fields=['ride', 'id'], name='rideevent_ride_id_idx')]
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("RideEvent rows are append-only")
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"Ride #{self.ride_id} {self.event}: {self.from_status or '-'} -> {self.to_status}"
@@ -0,0 +1,88 @@
+import math
+
+# Google encoded-polyline style delta coding, extended to (lat, lon, t) triples.
+# Coordinates are stored at 1e-5 degrees (~1 m), t in whole seconds.
+PRECISION = 1e5
+EARTH_RADIUS_M = 6371000
+
+
+def _encode_value(value, out):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_points(points, last=(0, 0, 0)):
+    """
+    Encodes (lat, lon, t) points as deltas from `last`, the encoder state
+    after the previous chunk. Returns (encoded, new_last) so traces can be
+    appended to without decoding what is already stored.
+    """
+    out = []
+    last_lat, last_lon, last_t = last
+    for lat, lon, t in points:
+        lat_e5 = int(round(lat * PRECISION))
+        lon_e5 = int(round(lon * PRECISION))
+        t = int(round(t))
+        _encode_value(lat_e5 - last_lat, out)
+        _encode_value(lon_e5 - last_lon, out)
+        _encode_value(t - last_t, out)
+        last_lat, last_lon, last_t = lat_e5, lon_e5, t
+    return ''.join(out), (last_lat, last_lon, last_t)
+
+
+def decode_points(encoded):
+    # Lazily yields (lat, lon, t)
+    index, length = 0, len(encoded)
+    values = [0, 0, 0]
+    while index < length:
+        for i in range(3):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            values[i] += ~(result >> 1) if result & 1 else result >> 1
+        yield values[0] / PRECISION, values[1] / PRECISION, values[2]
+
+
+def _offset_m(origin, point):
+    # Local equirectangular projection, fine at city scale
+    x = math.radians(point[1] - origin[1]) * math.cos(math.radians(origin[0])) * EARTH_RADIUS_M
+    y = math.radians(point[0] - origin[0]) * EARTH_RADIUS_M
+    return x, y
+
+
+def simplify(points, tolerance_m):
+    """Douglas-Peucker on (lat, lon, t) points, keeps the first and last point."""
+    if len(points) < 3:
+        return list(points)
+    origin = points[0]
+    xy = [_offset_m(origin, p) for p in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = xy[first], xy[last]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = math.hypot(dx, dy)
+        max_dist, max_index = 0.0, None
+        for i in range(first + 1, last):
+            px, py = xy[i]
+            if seg_len == 0:
+                dist = math.hypot(px - x1, py - y1)
+            else:
+                dist = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / seg_len
+            if dist > max_dist:
+                max_dist, max_index = dist, i
+        if max_index is not None and max_dist > tolerance_m:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [p for p, kept in zip(points, keep) if kept]
@@ -0,0 +1,229 @@
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+from .location_store import location_store
+from .services import haversine_distance
+from .spatial import cells_in_radius, grid_cell, grid_cell_size
+
+POOL_HOST_STATUSES = ('requested', 'accepted', 'in_progress')
+
+
+def corridor_cells(pickup, dropoff, width_km, size):
+    # Grid cells within width_km of the straight pickup -> dropoff segment
+    length_km = haversine_distance(*pickup, *dropoff)
+    steps = max(1, int(length_km / (size * 111.32 / 2)))
+    cells = set()
+    for i in range(steps + 1):
+        f = i / steps
+        lat = pickup[0] + (dropoff[0] - pickup[0]) * f
+        lon = pickup[1] + (dropoff[1] - pickup[1]) * f
+        cells.update(cells_in_radius(lat, lon, width_km, size))
+    return cells
+
+
+def route_km(*points):
+    return sum(haversine_distance(*a, *b) for a, b in zip(points, points[1:]))
+
+
+def best_pooling(origin, host_dropoff, host_direct_km, pickup, dropoff, max_detour):
+    """
+    Cheapest way for a vehicle at `origin` carrying the host to also carry a
+    pickup -> dropoff rider, as (extra_km, host_detour, rider_detour), or
+    None when every order breaks the detour budget. Detours are fractions
+    of each passenger's direct distance.
+    """
+    rider_direct_km = haversine_distance(*pickup, *dropoff)
+    if rider_direct_km == 0 or host_direct_km == 0:
+        return None
+    base_km = haversine_distance(*origin, *host_dropoff)
+    best = None
+    # Host is already in (or waiting for) the vehicle, so it is picked up first
+    for stops, host_km, rider_km in (
+        ((origin, pickup, dropoff, host_dropoff),
+         route_km(origin, pickup, dropoff, host_dropoff), route_km(pickup, dropoff)),
+        ((origin, pickup, host_dropoff, dropoff),
+         route_km(origin, pickup, host_dropoff), route_km(pickup, host_dropoff, dropoff)),
+    ):
+        host_detour = (host_km - base_km) / host_direct_km
+        rider_detour = rider_km / rider_direct_km - 1
+        if host_detour > max_detour or rider_detour > max_detour:
+            continue
+        extra_km = route_km(*stops) - base_km
+        if best is None or extra_km < best[0]:
+            best = (extra_km, host_detour, rider_detour)
+    return best
+
+
+def shared_fare(fare):
+    discount = Decimal(str(getattr(settings, 'RIDES_POOL_DISCOUNT', 0.3)))
+    return (Decimal(fare) * (1 - discount)).quantize(Decimal('0.01'))
+
+
+class RidePool:
+    """
+    Corridor index of rides that can take a second passenger.
+
+    Each host ride is indexed under the grid cells within
+    RIDES_POOL_CORRIDOR_KM of its pickup -> dropoff line, and under its
+    pickup and dropoff cells. A new trip's candidates are the hosts whose
+    corridor holds its pickup, or whose pickup lies in its corridor, and
+    likewise for the dropoff. Only those get the exact detour check.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._reset_index()
+
+    def _reset_index(self):
+        self._corridors = {}  # cell -> {ride_id}
+        self._pickups = {}  # cell -> {ride_id}
+        self._dropoffs = {}  # cell -> {ride_id}
+        self._rides = {}  # ride_id -> (pickup, dropoff, cells)
+
+    @property
+    def corridor_km(self):
+        return getattr(settings, 'RIDES_POOL_CORRIDOR_KM', 0.5)
+
+    @property
+    def max_detour(self):
+        return getattr(settings, 'RIDES_POOL_MAX_DETOUR', 0.4)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        from .models import Ride
+
+        with self._lock:
+            if self._loaded:
+                return
+            rows = Ride.objects.filter(status__in=POOL_HOST_STATUSES, pooled_with__isnull=True).values_list(
+                'id', 'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude'
+            )
+            for ride_id, plat, plon, dlat, dlon in rows:
+                self._add(ride_id, (plat, plon), (dlat, dlon))
+            self._loaded = True
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._rides)
+
+    def _add(self, ride_id, pickup, dropoff):
+        size = grid_cell_size()
+        cells = corridor_cells(pickup, dropoff, self.corridor_km, size)
+        for cell in cells:
+            self._corridors.setdefault(cell, set()).add(ride_id)
+        self._pickups.setdefault(grid_cell(*pickup, size), set()).add(ride_id)
+        self._dropoffs.setdefault(grid_cell(*dropoff, size), set()).add(ride_id)
+        self._rides[ride_id] = (pickup, dropoff, cells)
+
+    def add(self, ride):
+        self._ensure_loaded()
+        with self._lock:
+            self._add(ride.id, (ride.pickup_latitude, ride.pickup_longitude),
+                      (ride.dropoff_latitude, ride.dropoff_longitude))
+
+    def remove(self, ride_id):
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._rides.pop(ride_id, None)
+            if entry is None:
+                return
+            pickup, dropoff, cells = entry
+            size = grid_cell_size()
+            for index, keys in ((self._corridors, cells), (self._pickups, [grid_cell(*pickup, size)]),
+                                (self._dropoffs, [grid_cell(*dropoff, size)])):
+                for cell in keys:
+                    bucket = index.get(cell)
+                    if bucket is not None:
+                        bucket.discard(ride_id)
+                        if not bucket:
+                            del index[cell]
+
+    def candidates(self, pickup, dropoff):
+        # Host ride ids worth an exact detour check for a pickup -> dropoff trip
+        self._ensure_loaded()
+        size = grid_cell_size()
+        with self._lock:
+            near_pickup = set(self._corridors.get(grid_cell(*pickup, size), ()))
+            near_dropoff = set(self._corridors.get(grid_cell(*dropoff, size), ()))
+            for cell in corridor_cells(pickup, dropoff, self.corridor_km, size):
+                near_pickup.update(self._pickups.get(cell, ()))
+                near_dropoff.update(self._dropoffs.get(cell, ()))
+            return near_pickup & near_dropoff
+
+    def offers(self, pickup, dropoff, fare, limit=3, ride_ids=None, passenger=None):
+        """
+        Pooling offers for a new pickup -> dropoff trip, least extra distance
+        first. Hosts are re-read from the DB: full ones are skipped, finished
+        ones leave the index. `ride_ids` checks specific hosts instead of
+        searching, `passenger` excludes that passenger's own rides.
+        """
+        from .models import Ride
+
+        candidate_ids = self.candidates(pickup, dropoff) if ride_ids is None else set(ride_ids)
+        if not candidate_ids:
+            return []
+        hosts = Ride.objects.filter(id__in=candidate_ids, status__in=POOL_HOST_STATUSES, pooled_with__isnull=True) \
+            .annotate(riders=Count('pool_riders', filter=Q(pool_riders__status__in=POOL_HOST_STATUSES)))
+        found = set()
+        offers = []
+        for host in hosts:
+            found.add(host.id)
+            if host.passenger_id == getattr(passenger, 'id', None) or host.riders >= getattr(settings, 'RIDES_POOL_MAX_RIDERS', 1):
+                continue
+            host_pickup = (host.pickup_latitude, host.pickup_longitude)
+            host_dropoff = (host.dropoff_latitude, host.dropoff_longitude)
+            origin = host_pickup
+            if host.status == 'in_progress' and host.driver_id is not None:
+                entry = location_store.get(host.driver_id)
+                if entry is not None:
+                    origin = (entry['latitude'], entry['longitude'])
+            pooling = best_pooling(origin, host_dropoff, haversine_distance(*host_pickup, *host_dropoff),
+                                   pickup, dropoff, self.max_detour)
+            if pooling is None:
+                continue
+            extra_km, host_detour, rider_detour = pooling
+            offers.append({
+                "ride_id": host.id,
+                "status": host.status,
+                "shared_fare": shared_fare(fare),
+                "extra_km": round(extra_km, 2),
+                "detour": round(rider_detour, 3),
+                "host_detour": round(host_detour, 3),
+            })
+        if ride_ids is None:
+            for stale in candidate_ids - found:
+                self.remove(stale)
+        offers.sort(key=lambda offer: offer['extra_km'])
+        return offers[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._reset_index()
+            self._loaded = False
+
+
+ride_pool = RidePool()
+
+
+def board_pool_riders(pairs):
+    """
+    Accepts the waiting pool riders of freshly accepted hosts,
+    [(host_id, driver_id)], onto the host's driver. Call inside the
+    transaction that accepted the hosts.
+    """
+    from .models import Ride
+    from .state_machine import transition_many
+
+    drivers = dict(pairs)
+    waiting = {}
+    for ride_id, host_id in Ride.objects.filter(pooled_with__in=drivers, status='requested') \
+            .values_list('id', 'pooled_with_id'):
+        waiting.setdefault(host_id, []).append(ride_id)
+    for host_id, ride_ids in waiting.items():
+        transition_many(Ride.objects.filter(id__in=ride_ids), 'accept', len(ride_ids),
+                        data={'pooled_with': host_id}, driver_id=drivers[host_id])
@@ -0,0 +1,192 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .services import apply_surge, calculate_fare
+from .surge import surge_meter
+from .traffic import traffic_bucket, traffic_status
+
+QUOTE_TOKEN_SALT = 'rides.quote'
+
+
+def quote_grid():
+    return getattr(settings, 'RIDES_QUOTE_GRID_DEGREES', 0.001)
+
+
+def snap_route(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+    # Grid cell indices of a route's coordinates
+    grid = quote_grid()
+    return [round(value / grid) for value in (pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)]
+
+
+class LRUBackend:
+    """Per-process quotes in an OrderedDict, least recently used evicted first."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, quote)
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'RIDES_QUOTE_CACHE_SIZE', 10000)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, quote, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, quote)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.evictions = self.expirations = 0
+
+
+class DjangoCacheBackend:
+    """
+    Quotes in the RIDES_QUOTE_CACHE_ALIAS Django cache, shared by every
+    process on that cache. Eviction is the cache's own (LocMemCache: LRU up
+    to its MAX_ENTRIES) and isn't counted.
+    """
+
+    evictions = 0
+    expirations = 0
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'RIDES_QUOTE_CACHE_ALIAS', 'default')]
+
+    def get(self, key):
+        return self.cache.get(f'quote:{key}')
+
+    def set(self, key, quote, ttl):
+        self.cache.set(f'quote:{key}', quote, timeout=max(1, int(ttl)))
+
+    def __len__(self):
+        return 0
+
+    def clear(self):
+        self.cache.clear()
+
+
+class QuoteCache:
+    """
+    Caches calculate_fare quotes for repeated routes, surge applied per
+    lookup from the live surge meter.
+
+    Pickup and dropoff are snapped to a RIDES_QUOTE_GRID_DEGREES grid and
+    the quote is computed at the snapped points, so it depends on nothing
+    but the key: snapped coordinates, vehicle type and traffic bucket.
+    Entries live until their traffic bucket ends. The backend is
+    RIDES_QUOTE_CACHE_BACKEND, per-process LRU by default.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            path = getattr(settings, 'RIDES_QUOTE_CACHE_BACKEND', 'rides.quotes.LRUBackend')
+            self._backend = import_string(path)()
+        return self._backend
+
+    def quote(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, vehicle_type='car', now=None):
+        cells = snap_route(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+        bucket, ttl = traffic_bucket(now)
+        key = f"{vehicle_type}:{bucket}:{':'.join(map(str, cells))}"
+        quote = self.backend.get(key)
+        with self._lock:
+            if quote is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if quote is None:
+            grid = quote_grid()
+            quote = calculate_fare(*(cell * grid for cell in cells), vehicle_type, when=now)
+            self.backend.set(key, quote, ttl)
+        # Surge moves faster than the traffic bucket, so it isn't part of the cached quote
+        return apply_surge(quote, surge_meter.multiplier(pickup_lat, pickup_lon))
+
+    def stats(self):
+        backend = self.backend
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": backend.evictions,
+            "expirations": backend.expirations,
+            "size": len(backend),
+        }
+
+    def reset(self):
+        with self._lock:
+            self.backend.clear()
+            self.hits = self.misses = 0
+
+
+quote_cache = QuoteCache()
+
+
+def quote_token_ttl():
+    return getattr(settings, 'RIDES_QUOTE_TOKEN_TTL', 300)
+
+
+def sign_quote(quote, user, route, vehicle_type='car'):
+    """
+    Signed token for a quote, bound to the passenger, the snapped route and
+    the vehicle type. Valid for RIDES_QUOTE_TOKEN_TTL seconds. Returns
+    (token, expires_at).
+    """
+    payload = [user.id, snap_route(*route), vehicle_type, str(quote['estimated_fare']),
+               quote['distance_km'], quote['duration_minutes'], quote['traffic_factor'], quote['surge_multiplier']]
+    token = signing.dumps(payload, salt=QUOTE_TOKEN_SALT, compress=True)
+    return token, timezone.now() + timedelta(seconds=quote_token_ttl())
+
+
+def read_quote(token, user, route, vehicle_type='car'):
+    # The quote a token was issued for, or None if it's forged, expired or for another ride
+    try:
+        payload = signing.loads(token, salt=QUOTE_TOKEN_SALT, max_age=quote_token_ttl())
+        user_id, cells, token_vehicle, fare, distance_km, duration_minutes, traffic_factor, surge = payload
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if user_id != user.id or cells != snap_route(*route) or token_vehicle != vehicle_type:
+        return None
+    return {
+        "estimated_fare": Decimal(fare),
+        "distance_km": distance_km,
+        "duration_minutes": duration_minutes,
+        "traffic_factor": traffic_factor,
+        "traffic_status": traffic_status(traffic_factor),
+        "surge_multiplier": surge,
+    }
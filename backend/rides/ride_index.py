@@ -0,0 +1,103 @@
+import heapq
+import threading
+
+from django.conf import settings
+
+from .services import haversine_distance
+from .spatial import GridIndex
+
+
+class OpenRideIndex:
+    """
+    Requested rides bucketed by pickup grid cell, for the driver feed.
+
+    Warmed from the DB on first use, then kept current by ride creation and
+    by the transitions that take a ride out of 'requested'.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index = GridIndex()
+        self._fares = {}  # ride_id -> estimated fare
+        self._max_fare = 0.0  # high-water mark, bounds the fare bonus when pruning cells
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        from .models import Ride
+
+        with self._lock:
+            if self._loaded:
+                return
+            rows = Ride.objects.filter(status='requested').values_list(
+                'id', 'pickup_latitude', 'pickup_longitude', 'estimated_fare'
+            )
+            for ride_id, lat, lon, fare in rows:
+                self._add(ride_id, lat, lon, fare)
+            self._loaded = True
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._fares)
+
+    def _add(self, ride_id, lat, lon, fare):
+        self._index.upsert(ride_id, lat, lon)
+        self._fares[ride_id] = float(fare or 0)
+        self._max_fare = max(self._max_fare, self._fares[ride_id])
+
+    def add(self, ride):
+        self._ensure_loaded()
+        with self._lock:
+            self._add(ride.id, ride.pickup_latitude, ride.pickup_longitude, ride.estimated_fare)
+
+    def remove(self, ride_id):
+        self._ensure_loaded()
+        with self._lock:
+            self._index.remove(ride_id)
+            self._fares.pop(ride_id, None)
+
+    def cell_counts(self):
+        # Open requests per grid cell
+        self._ensure_loaded()
+        with self._lock:
+            return self._index.cell_counts()
+
+    def ranked(self, lat, lon, radius_km, limit, fare_weight=None):
+        """
+        Top `limit` open rides within radius_km of (lat, lon) as
+        [(score, pickup_km, ride_id)], best first. Lower score is better:
+        pickup distance minus fare_weight km per 100 BDT of fare.
+
+        Cells are walked nearest first and the walk stops once even the
+        best-paid ride in the next cell couldn't make the top `limit`.
+        """
+        self._ensure_loaded()
+        if fare_weight is None:
+            fare_weight = getattr(settings, 'RIDES_FEED_FARE_WEIGHT', 0.5)
+        top = []  # max-heap of the best `limit` so far, as negated tuples
+        with self._lock:
+            max_bonus = fare_weight * self._max_fare / 100
+            for min_km, bucket in self._index.buckets_by_distance(lat, lon, radius_km):
+                if len(top) == limit and min_km - max_bonus > -top[0][0]:
+                    break
+                for ride_id, (plat, plon) in bucket.items():
+                    pickup_km = haversine_distance(lat, lon, plat, plon)
+                    if pickup_km > radius_km:
+                        continue
+                    item = (-(pickup_km - fare_weight * self._fares[ride_id] / 100), -pickup_km, -ride_id)
+                    if len(top) < limit:
+                        heapq.heappush(top, item)
+                    elif item > top[0]:
+                        heapq.heapreplace(top, item)
+        return sorted((-score, -pickup_km, -ride_id) for score, pickup_km, ride_id in top)
+
+    def reset(self):
+        with self._lock:
+            self._index = GridIndex()
+            self._fares = {}
+            self._max_fare = 0.0
+            self._loaded = False
+
+
+open_rides = OpenRideIndex()
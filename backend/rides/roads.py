@@ -0,0 +1,444 @@
+import heapq
+import math
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from django.conf import settings
+
+M_PER_DEGREE = 111320
+ACCESS_SPEED_KMH = 15  # between a point and the road node it snapped to
+
+# Drivable highway types and their default speeds, km/h
+HIGHWAY_SPEEDS = {
+    'motorway': 60, 'trunk': 50, 'primary': 40, 'secondary': 35, 'tertiary': 30,
+    'unclassified': 20, 'residential': 20, 'living_street': 10, 'service': 15, 'road': 20,
+    'motorway_link': 40, 'trunk_link': 35, 'primary_link': 30, 'secondary_link': 25, 'tertiary_link': 20,
+}
+ONEWAY_TAGS = {'yes': 1, 'true': 1, '1': 1, '-1': -1, 'reverse': -1, 'no': 0, 'false': 0, '0': 0}
+
+
+def way_speed(tags):
+    speed = HIGHWAY_SPEEDS[tags['highway']]
+    try:
+        return float(tags.get('maxspeed', '').split()[0])
+    except (IndexError, ValueError):
+        return speed
+
+
+def way_direction(tags):
+    # 1 forward only, -1 backward only, 0 both ways
+    if tags.get('oneway') in ONEWAY_TAGS:
+        return ONEWAY_TAGS[tags['oneway']]
+    if tags.get('junction') in ('roundabout', 'circular') or tags['highway'] == 'motorway':
+        return 1
+    return 0
+
+
+def parse_osm(path):
+    """
+    Drivable ways of an .osm XML extract, as (node coordinates {osm id:
+    (lat, lon)}, [(node refs, speed km/h, direction)]). Two passes, so only
+    the nodes the roads use are kept in memory.
+    """
+    ways = []
+    needed = set()
+    for _, elem in ET.iterparse(path):
+        if elem.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            if tags.get('highway') in HIGHWAY_SPEEDS and tags.get('access') not in ('no', 'private'):
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                ways.append((refs, way_speed(tags), way_direction(tags)))
+                needed.update(refs)
+            elem.clear()
+        elif elem.tag == 'node':
+            elem.clear()
+
+    nodes = {}
+    for _, elem in ET.iterparse(path):
+        if elem.tag == 'node':
+            osm_id = int(elem.get('id'))
+            if osm_id in needed:
+                nodes[osm_id] = (float(elem.get('lat')), float(elem.get('lon')))
+        if elem.tag in ('node', 'way', 'relation'):
+            elem.clear()
+    return nodes, ways
+
+
+def largest_component(n, sources, targets):
+    # Node mask of the largest weakly connected component, union-find with path halving
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(sources.tolist(), targets.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[ra] = rb
+    roots = np.array([find(x) for x in range(n)])
+    return roots == np.bincount(roots).argmax()
+
+
+def shortest_costs(indptr, indices, costs, source):
+    # Dijkstra from source over a whole CSR graph, cost to every node (inf if unreachable)
+    indptr, indices, costs = indptr.tolist(), indices.tolist(), costs.tolist()
+    best = [math.inf] * (len(indptr) - 1)
+    best[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        g, u = heapq.heappop(heap)
+        if g > best[u]:
+            continue
+        for e in range(indptr[u], indptr[u + 1]):
+            v = indices[e]
+            cost = g + costs[e]
+            if cost < best[v]:
+                best[v] = cost
+                heapq.heappush(heap, (cost, v))
+    return np.array(best, dtype=np.float32)
+
+
+def pick_landmarks(lat, lon, count):
+    # The node furthest from the centre in each of `count` equal sectors around it
+    if count <= 0:
+        return []
+    dy, dx = lat - lat.mean(), (lon - lon.mean()) * math.cos(math.radians(lat.mean()))
+    sector = ((np.arctan2(dy, dx) + math.pi) / (2 * math.pi) * count).astype(int) % count
+    radius = np.hypot(dx, dy)
+    landmarks = []
+    for k in range(count):
+        members = np.flatnonzero(sector == k)
+        if len(members):
+            landmarks.append(int(members[radius[members].argmax()]))
+    return landmarks
+
+
+def build_road_graph(osm_path, path, landmarks=8):
+    """
+    Converts an .osm extract into the CSR arrays RoadGraph loads and writes
+    them to `path`. Only the largest connected road network is kept, so
+    every snapped point can reach every other. Travel times from and to
+    `landmarks` nodes on the edge of the network are stored for the A*
+    heuristic. Returns (nodes, edges).
+    """
+    from .services import haversine_array
+
+    nodes, ways = parse_osm(osm_path)
+    ids = {}
+    sources, targets, speeds = [], [], []
+    for refs, speed, direction in ways:
+        refs = [ref for ref in refs if ref in nodes]
+        for a, b in zip(refs, refs[1:]):
+            a, b = ids.setdefault(a, len(ids)), ids.setdefault(b, len(ids))
+            if direction >= 0:
+                sources.append(a), targets.append(b), speeds.append(speed)
+            if direction <= 0:
+                sources.append(b), targets.append(a), speeds.append(speed)
+    coords = np.array([nodes[osm_id] for osm_id in ids], dtype=float).reshape(-1, 2)
+    sources, targets, speeds = np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64), np.array(speeds)
+
+    keep = largest_component(len(coords), sources, targets) if len(coords) else np.zeros(0, dtype=bool)
+    renumber = np.cumsum(keep) - 1
+    edges = keep[sources] & keep[targets] & (sources != targets)
+    sources, targets, speeds = renumber[sources[edges]], renumber[targets[edges]], speeds[edges]
+    coords = coords[keep]
+
+    length_m = haversine_array(coords[sources, 0], coords[sources, 1], coords[targets, 0], coords[targets, 1]) * 1000
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(len(coords) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(coords)), out=indptr[1:])
+
+    time_s = (length_m / (speeds / 3.6)).astype(np.float32)
+
+    # Landmark times on the graph and on its reverse
+    reverse = np.argsort(targets, kind='stable')
+    reverse_indptr = np.zeros_like(indptr)
+    np.cumsum(np.bincount(targets, minlength=len(coords)), out=reverse_indptr[1:])
+    chosen = pick_landmarks(coords[:, 0], coords[:, 1], landmarks) if len(coords) else []
+    landmark_from = np.array([shortest_costs(indptr, targets[order], time_s[order], node) for node in chosen],
+                             dtype=np.float32).reshape(-1, len(coords))
+    landmark_to = np.array([shortest_costs(reverse_indptr, sources[reverse], time_s[reverse], node) for node in chosen],
+                           dtype=np.float32).reshape(-1, len(coords))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        # Uncompressed, loading is a straight read
+        np.savez(
+            f, lat=coords[:, 0], lon=coords[:, 1], indptr=indptr, indices=targets[order].astype(np.int32),
+            length_m=length_m[order].astype(np.float32), time_s=time_s[order],
+            landmark_from=landmark_from, landmark_to=landmark_to,
+        )
+    os.replace(tmp, path)
+    return len(coords), len(sources)
+
+
+class RoadGraph:
+    """
+    Road network as CSR adjacency: the out-edges of node u are
+    indices[indptr[u]:indptr[u + 1]], with length_m and time_s alongside.
+
+    Loaded once from RIDES_ROAD_GRAPH_PATH, written offline by the
+    `build_road_graph` command from an OSM extract. Points snap to the
+    nearest node within RIDES_ROUTING_SNAP_KM. Point-to-point routes are
+    fastest paths by A* with landmark (ALT) bounds, matrices are one
+    Dijkstra per distinct origin.
+    Without a graph file `available` is False and callers use haversine.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._n = 0
+
+    @property
+    def path(self):
+        return getattr(settings, 'RIDES_ROAD_GRAPH_PATH', None)
+
+    @property
+    def snap_km(self):
+        return getattr(settings, 'RIDES_ROUTING_SNAP_KM', 0.3)
+
+    @property
+    def available(self):
+        self._ensure_loaded()
+        return self._n > 0
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            path = self.path
+            if path and os.path.exists(path):
+                with np.load(path) as data:
+                    self._load(**{name: data[name] for name in data.files})
+            self._loaded = True
+
+    def _load(self, lat, lon, indptr, indices, length_m, time_s, landmark_from, landmark_to):
+        self._n = len(lat)
+        self.arrays = {'lat': lat, 'lon': lon, 'indptr': indptr, 'indices': indices,
+                       'length_m': length_m, 'time_s': time_s,
+                       'landmark_from': landmark_from, 'landmark_to': landmark_to}
+        # The search loops index memoryviews, which hand back plain Python numbers
+        self._lat, self._lon = memoryview(lat), memoryview(lon)
+        self._indptr, self._indices = memoryview(indptr), memoryview(indices)
+        # Source node of every edge, for walking paths back
+        self._tails = memoryview(np.repeat(np.arange(len(lat), dtype=np.int32), np.diff(indptr)))
+        self._weights = {'length': memoryview(length_m), 'time': memoryview(time_s)}
+        self._cos_lat = math.cos(math.radians(float(lat.mean()))) if self._n else 1.0
+        # Zero-length edges between repeated OSM positions take no time, and don't bound the speed
+        moving = time_s > 0
+        self._max_speed = float((length_m[moving] / time_s[moving]).max()) if moving.any() else 1.0
+
+        # Snapping grid: node ids sorted by cell, cell -> (start, end) into that order
+        self._cell = self.snap_km * 1000 / M_PER_DEGREE
+        keys = self._cell_keys(lat, lon)
+        self._snap_order = np.argsort(keys, kind='stable').astype(np.int32)
+        cells, starts, counts = np.unique(keys[self._snap_order], return_index=True, return_counts=True)
+        self._snap_cells = dict(zip(cells.tolist(), zip(starts.tolist(), (starts + counts).tolist())))
+
+    def _cell_keys(self, lat, lon):
+        return (np.floor(np.asarray(lat) / self._cell).astype(np.int64) * 100000
+                + np.floor(np.asarray(lon) / self._cell).astype(np.int64))
+
+    @property
+    def nbytes(self):
+        self._ensure_loaded()
+        return sum(array.nbytes for array in self.arrays.values()) + self._snap_order.nbytes if self._n else 0
+
+    def _straight_m(self, lat1, lon1, lat2, lon2):
+        # Equirectangular, plenty at city scale
+        return math.hypot((lat2 - lat1) * M_PER_DEGREE, (lon2 - lon1) * M_PER_DEGREE * self._cos_lat)
+
+    def nearest(self, lat, lon):
+        # (node, metres away) of the closest node within the snap radius, or None
+        self._ensure_loaded()
+        if not self._n:
+            return None
+        row, col = math.floor(lat / self._cell), math.floor(lon / self._cell)
+        best = None
+        for r in (row - 1, row, row + 1):
+            for c in (col - 1, col, col + 1):
+                span = self._snap_cells.get(r * 100000 + c)
+                if span is None:
+                    continue
+                for node in self._snap_order[span[0]:span[1]].tolist():
+                    d = self._straight_m(lat, lon, self._lat[node], self._lon[node])
+                    if best is None or d < best[1]:
+                        best = (node, d)
+        if best is None or best[1] > self.snap_km * 1000:
+            return None
+        return best
+
+    def _path_totals(self, pred, node):
+        # (length_m, time_s) summed back along the predecessor edges
+        lengths, times = self._weights['length'], self._weights['time']
+        length_m = time_s = 0.0
+        edge = pred[node]
+        while edge >= 0:
+            length_m += lengths[edge]
+            time_s += times[edge]
+            edge = pred[self._tails[edge]]
+        return length_m, time_s
+
+    def _time_bounds(self, source, target, landmarks=4):
+        """
+        Lower bounds on the travel time from every node to `target`, by the
+        triangle inequality over the `landmarks` landmarks that bound
+        source -> target best, and the straight line at the fastest road
+        speed. One vectorized pass per route.
+        """
+        arrays = self.arrays
+        lat, lon = arrays['lat'], arrays['lon']
+        bounds = np.hypot((lat - lat[target]) * M_PER_DEGREE,
+                          (lon - lon[target]) * M_PER_DEGREE * self._cos_lat) * (0.995 / self._max_speed)
+        from_l, to_l = arrays['landmark_from'], arrays['landmark_to']
+        if len(from_l):
+            with np.errstate(invalid='ignore'):
+                at_source = np.fmax(from_l[:, target] - from_l[:, source], to_l[:, source] - to_l[:, target])
+                for k in np.argsort(-np.nan_to_num(at_source, nan=-np.inf))[:landmarks]:
+                    bounds = np.fmax(bounds, from_l[k, target] - from_l[k])
+                    bounds = np.fmax(bounds, to_l[k] - to_l[k, target])
+        return bounds
+
+    def _astar(self, source, target, weight):
+        # (length_m, time_s) of the cheapest source -> target path by `weight`, or None
+        indptr, indices, costs = self._indptr, self._indices, self._weights[weight]
+        if weight == 'time':
+            h = memoryview(self._time_bounds(source, target))
+        else:
+            arrays = self.arrays
+            h = memoryview(np.hypot((arrays['lat'] - arrays['lat'][target]) * M_PER_DEGREE,
+                                    (arrays['lon'] - arrays['lon'][target]) * M_PER_DEGREE * self._cos_lat) * 0.995)
+        push, pop = heapq.heappush, heapq.heappop
+
+        best = {source: 0.0}
+        pred = {source: -1}  # node -> edge it was reached by
+        heap = [(0.0, 0.0, source)]
+        while heap:
+            _, g, u = pop(heap)
+            if u == target:
+                return self._path_totals(pred, u)
+            if g > best[u]:
+                continue
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                cost = g + costs[e]
+                if cost < best.get(v, math.inf):
+                    best[v] = cost
+                    pred[v] = e
+                    push(heap, (cost + h[v], cost, v))
+        return None
+
+    def _dijkstra(self, source, targets, weight, max_cost=math.inf):
+        # {target: (length_m, time_s)} for the targets reachable within max_cost
+        indptr, indices, costs = self._indptr, self._indices, self._weights[weight]
+        push, pop = heapq.heappush, heapq.heappop
+        remaining = set(targets)
+        settled = []
+        best = {source: 0.0}
+        pred = {source: -1}
+        heap = [(0.0, source)]
+        while heap and remaining:
+            g, u = pop(heap)
+            if g > best[u]:
+                continue
+            if g > max_cost:
+                break
+            if u in remaining:
+                remaining.discard(u)
+                settled.append(u)
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                cost = g + costs[e]
+                if cost < best.get(v, math.inf):
+                    best[v] = cost
+                    pred[v] = e
+                    push(heap, (cost, v))
+        return {node: self._path_totals(pred, node) for node in settled}
+
+    @staticmethod
+    def _with_access(length_m, time_s, *snap_m):
+        # Adds the straight legs to and from the snapped nodes, returns (km, minutes)
+        access_m = sum(snap_m)
+        return (length_m + access_m) / 1000, (time_s + access_m / (ACCESS_SPEED_KMH / 3.6)) / 60
+
+    def route(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+        # (km, free-flow minutes) of the fastest route, None when either end is off the network
+        start = self.nearest(pickup_lat, pickup_lon)
+        end = self.nearest(dropoff_lat, dropoff_lon)
+        if start is None or end is None:
+            return None
+        found = self._astar(start[0], end[0], 'time')
+        if found is None:
+            return None
+        return self._with_access(*found, start[1], end[1])
+
+    def matrix(self, origins, destinations, weight='length', max_km=None):
+        """
+        Road km and free-flow minutes from every origin to every destination,
+        [(lat, lon)] each, as two (origins, destinations) arrays. Paths are
+        the shortest by `weight` ('length' or 'time'). Points off the network
+        are NaN, pairs beyond max_km (searched by length) or unreachable inf.
+        """
+        self._ensure_loaded()
+        km = np.full((len(origins), len(destinations)), np.nan)
+        minutes = np.full_like(km, np.nan)
+        starts = [self.nearest(lat, lon) for lat, lon in origins]
+        ends = [self.nearest(lat, lon) for lat, lon in destinations]
+        targets = {end[0] for end in ends if end is not None}
+        max_cost = max_km * 1000 if max_km is not None and weight == 'length' else math.inf
+        searched = {}
+        for i, start in enumerate(starts):
+            if start is None:
+                continue
+            if start[0] not in searched:
+                searched[start[0]] = self._dijkstra(start[0], targets, weight, max_cost)
+            found = searched[start[0]]
+            for j, end in enumerate(ends):
+                if end is None:
+                    continue
+                if end[0] in found:
+                    km[i, j], minutes[i, j] = self._with_access(*found[end[0]], start[1], end[1])
+                else:
+                    km[i, j] = minutes[i, j] = np.inf
+        if max_km is not None:
+            over = km > max_km
+            km[over] = minutes[over] = np.inf
+        return km, minutes
+
+    def trips(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+        # route() for arrays of trips, NaN where a trip can't be routed. Trips
+        # that share a pickup node share one search.
+        self._ensure_loaded()
+        n = len(pickup_lat)
+        km, minutes = np.full(n, np.nan), np.full(n, np.nan)
+        by_start = {}
+        for i in range(n):
+            start = self.nearest(pickup_lat[i], pickup_lon[i])
+            end = self.nearest(dropoff_lat[i], dropoff_lon[i])
+            if start is not None and end is not None:
+                by_start.setdefault(start[0], []).append((i, start[1], end))
+        for node, group in by_start.items():
+            found = self._dijkstra(node, {end[0] for _, _, end in group}, 'time')
+            for i, start_m, (end_node, end_m) in group:
+                if end_node in found:
+                    km[i], minutes[i] = self._with_access(*found[end_node], start_m, end_m)
+        return km, minutes
+
+    def reload(self):
+        with self._lock:
+            self._loaded = False
+            self._n = 0
+
+
+road_graph = RoadGraph()
@@ -0,0 +1,8 @@
+from django.urls import re_path
+
+from .consumers import DriverFeedConsumer, RideBidsConsumer
+
+websocket_urlpatterns = [
+    re_path(r'^ws/drivers/$', DriverFeedConsumer.as_asgi()),
+    re_path(r'^ws/rides/(?P<ride_id>\d+)/bids/$', RideBidsConsumer.as_asgi()),
+]
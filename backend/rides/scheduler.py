@@ -0,0 +1,146 @@
+import atexit
+import heapq
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .pooling import ride_pool
+from .ride_index import open_rides
+from .state_machine import transition_many
+
+logger = logging.getLogger(__name__)
+
+RELEASE_CHUNK = 500
+
+
+class RideScheduler:
+    """
+    Releases advance bookings into the open-ride feed and dispatch.
+
+    A scheduled ride becomes 'requested' RIDES_SCHEDULE_LEAD_TIME seconds
+    before its pickup. Only bookings due within RIDES_SCHEDULE_HORIZON are
+    held in memory, in a heap keyed by release time. The next window is
+    read from the (status, scheduled_for) index once half the current one
+    has passed, so a tick costs O(log n) per released ride no matter how
+    many bookings lie further out, and a restart only reloads the near
+    window.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []  # (release_at, ride_id)
+        self._queued = set()
+        self._loaded_until = None  # bookings releasing before this are in the heap
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def lead_time(self):
+        return timedelta(seconds=getattr(settings, 'RIDES_SCHEDULE_LEAD_TIME', 900))
+
+    @property
+    def horizon(self):
+        return timedelta(seconds=getattr(settings, 'RIDES_SCHEDULE_HORIZON', 3600))
+
+    @property
+    def tick_interval(self):
+        return getattr(settings, 'RIDES_SCHEDULE_TICK', 5.0)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, release_at, ride_id):
+        if ride_id not in self._queued:
+            heapq.heappush(self._heap, (release_at, ride_id))
+            self._queued.add(ride_id)
+
+    def _load(self, now):
+        # Reads bookings releasing between the loaded window and now + horizon
+        from .models import Ride
+
+        until = now + self.horizon
+        bookings = Ride.objects.filter(status='scheduled', scheduled_for__lt=until + self.lead_time)
+        if self._loaded_until is not None:
+            bookings = bookings.filter(scheduled_for__gte=self._loaded_until + self.lead_time)
+        for ride_id, scheduled_for in bookings.values_list('id', 'scheduled_for').iterator():
+            self._push(scheduled_for - self.lead_time, ride_id)
+        self._loaded_until = until
+
+    def add(self, ride):
+        # New bookings inside the loaded window go straight onto the heap,
+        # later ones are picked up when their window loads
+        with self._lock:
+            release_at = ride.scheduled_for - self.lead_time
+            if self._loaded_until is not None and release_at < self._loaded_until:
+                self._push(release_at, ride.id)
+
+    def tick(self, now=None):
+        # Releases every booking that is due, returns how many were released
+        from .models import Ride
+
+        now = now or timezone.now()
+        with self._lock:
+            if self._loaded_until is None or now + self.horizon / 2 >= self._loaded_until:
+                self._load(now)
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                _, ride_id = heapq.heappop(self._heap)
+                self._queued.discard(ride_id)
+                due.append(ride_id)
+
+        released = []
+        for start in range(0, len(due), RELEASE_CHUNK):
+            chunk = due[start:start + RELEASE_CHUNK]
+            # Bookings cancelled meanwhile are no longer 'scheduled' and are skipped
+            rows = transition_many(Ride.objects.filter(id__in=chunk), 'release', len(chunk))
+            released.extend(ride_id for ride_id, _, _ in rows)
+        if released:
+            for ride in Ride.objects.filter(id__in=released).only(
+                'id', 'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude',
+                'estimated_fare', 'pooled_with',
+            ):
+                open_rides.add(ride)
+                if ride.pooled_with_id is None:
+                    ride_pool.add(ride)
+        return len(released)
+
+    def ensure_running(self):
+        if not self.tick_interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ride-scheduler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.tick_interval):
+            try:
+                released = self.tick()
+                if released:
+                    logger.info("Released %d scheduled rides", released)
+            except Exception:
+                logger.exception("Scheduled ride release failed")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self._heap = []
+            self._queued = set()
+            self._loaded_until = None
+
+
+ride_scheduler = RideScheduler()
+atexit.register(ride_scheduler.stop)
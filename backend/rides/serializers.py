@@ -1,5 +1,9 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
-from .models import DriverLocation, Ride, Message, RideBid
+from .models import DriverLocation, Ride, RideEvent, Message, RideBid
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = serializers.CharField(source='sender.username', read_only=True)
@@ -20,19 +24,63 @@ class DriverLocationSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = DriverLocation
-        fields = ['username', 'latitude', 'longitude', 'vehicle_type', 'updated_at']
+        fields = ['username', 'latitude', 'longitude', 'vehicle_type', 'status', 'updated_at']
+
+class DriverSnapshotSerializer(serializers.Serializer):
+    # Serializes entries from the in-memory location store
+    username = serializers.CharField()
+    latitude = serializers.FloatField()
+    longitude = serializers.FloatField()
+    vehicle_type = serializers.CharField()
+    status = serializers.CharField()
+    updated_at = serializers.DateTimeField()
+    # Motion at recorded_at, for dead reckoning between updates
+    recorded_at = serializers.DateTimeField()
+    speed_kmh = serializers.FloatField()
+    heading = serializers.FloatField(allow_null=True)
 
 class RideSerializer(serializers.ModelSerializer):
     passenger = serializers.StringRelatedField(read_only=True)
     driver = serializers.StringRelatedField(read_only=True)
     bids = RideBidSerializer(many=True, read_only=True)
+    # Optional bidding deadline in seconds, the best bid is accepted when it passes
+    bid_window_seconds = serializers.IntegerField(write_only=True, required=False, allow_null=True)
     
     class Meta:
         model = Ride
         fields = '__all__'
-        read_only_fields = ('passenger', 'driver', 'status', 'created_at', 'updated_at', 'bids')
+        read_only_fields = ('passenger', 'driver', 'status', 'pooled_with', 'created_at', 'updated_at', 'bids',
+                            'bid_window_closes_at', 'vehicle_type')
+
+    def validate_scheduled_for(self, value):
+        if value is None:
+            return value
+        if self.instance is not None and value != self.instance.scheduled_for:
+            raise serializers.ValidationError("Pickup time can't be changed after booking")
+        now = timezone.now()
+        if value <= now:
+            raise serializers.ValidationError("Pickup time must be in the future")
+        if value > now + timedelta(days=getattr(settings, 'RIDES_SCHEDULE_MAX_DAYS', 30)):
+            raise serializers.ValidationError("Pickup time is too far ahead")
+        return value
+
+    def validate_bid_window_seconds(self, value):
+        if value is None:
+            return value
+        low, high = getattr(settings, 'RIDES_BID_WINDOW_MIN', 15), getattr(settings, 'RIDES_BID_WINDOW_MAX', 600)
+        if not low <= value <= high:
+            raise serializers.ValidationError(f"Bid window must be between {low} and {high} seconds")
+        return value
 
     def create(self, validated_data):
         # Assign current user as passenger
         validated_data['passenger'] = self.context['request'].user
+        validated_data.pop('bid_window_seconds', None)
         return super().create(validated_data)
+
+class RideEventSerializer(serializers.ModelSerializer):
+    actor = serializers.StringRelatedField(read_only=True)
+
+    class Meta:
+        model = RideEvent
+        fields = ['id', 'ride', 'event', 'from_status', 'to_status', 'actor', 'data', 'created_at']
@@ -1,7 +1,11 @@
 import math
-import random
 from decimal import Decimal
 
+import numpy as np
+
+from .roads import road_graph
+from .traffic import BASE_SPEED_KMH, traffic_bucket, traffic_model, traffic_status
+
 def haversine_distance(lat1, lon1, lat2, lon2):
     R = 6371  # Earth radius in km
     dlat = math.radians(lat2 - lat1)
@@ -13,35 +17,107 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     distance = R * c
     return distance
 
-def calculate_fare(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
-    # 1. Calculate Distance
+def haversine_array(lat1, lon1, lat2, lon2):
+    # Element-wise haversine_distance over equal-length arrays, km
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def trip_distance(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+    # (km, free-flow minutes) by road when the road graph covers the trip, else straight line at 20 km/h
+    route = road_graph.route(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon) if road_graph.available else None
+    if route is not None:
+        return route
     distance_km = haversine_distance(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+    return distance_km, distance_km / BASE_SPEED_KMH * 60
+
+def trip_distances(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+    # trip_distance over arrays of trips
+    distance_km = haversine_array(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+    minutes = distance_km / BASE_SPEED_KMH * 60
+    if road_graph.available:
+        road_km, road_minutes = road_graph.trips(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+        routed = ~np.isnan(road_km)
+        distance_km[routed], minutes[routed] = road_km[routed], road_minutes[routed]
+    return distance_km, minutes
+
+BASE_FARE = 50.0
+PER_KM_RATE = 25.0
+PER_MINUTE_RATE = 3.0
+# vehicle type -> (base fare, per km, per minute)
+VEHICLE_RATES = {
+    'car': (BASE_FARE, PER_KM_RATE, PER_MINUTE_RATE),
+    'bike': (25.0, 12.0, 1.5),
+    'rickshaw': (30.0, 16.0, 2.0),
+}
+
+def trip_fare(distance_km, duration_minutes, vehicle_type='car'):
+    # Fare for a measured trip, real duration already reflects traffic
+    base_fare, per_km_rate, per_minute_rate = VEHICLE_RATES[vehicle_type]
+    total_fare = base_fare + distance_km * per_km_rate + duration_minutes * per_minute_rate
+    return round(Decimal(total_fare), 2)
+
+def calculate_fare(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, vehicle_type='car', when=None, surge_multiplier=1.0):
+    base_fare, per_km_rate, per_minute_rate = VEHICLE_RATES[vehicle_type]
+
+    # 1. Calculate Distance, by road where we have the road network
+    distance_km, free_flow_minutes = trip_distance(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
     
-    # 2. Simulate Traffic (For MVP, randomized slightly for variety)
-    # 20% chance of heavy traffic
-    is_heavy_traffic = random.random() < 0.2
-    traffic_factor = 1.5 if is_heavy_traffic else 1.0
+    # 2. Traffic: mean of the pickup and dropoff zones at this hour of the week
+    bucket, _ = traffic_bucket(when)
+    traffic_factor = round((traffic_model.factor(pickup_lat, pickup_lon, bucket)
+                            + traffic_model.factor(dropoff_lat, dropoff_lon, bucket)) / 2, 2)
     
     # 3. Calculate Parameters
-    # Assume avg speed 20 km/h in city
-    avg_speed_kmh = 20 / traffic_factor 
-    duration_hours = distance_km / avg_speed_kmh
-    duration_minutes = int(duration_hours * 60)
+    # Free-flow time slowed down by traffic
+    duration_minutes = int(free_flow_minutes * traffic_factor)
     
     # 4. Price Logic
-    base_fare = 50.0
-    per_km_rate = 25.0
-    per_minute_rate = 3.0
-    
     distance_cost = distance_km * per_km_rate
     time_cost = duration_minutes * per_minute_rate
     
     total_fare = (base_fare + distance_cost + time_cost) * traffic_factor
     
-    return {
+    # 5. Surge on top, see apply_surge
+    return apply_surge({
         "estimated_fare": round(Decimal(total_fare), 2),
         "distance_km": round(distance_km, 2),
         "duration_minutes": duration_minutes,
         "traffic_factor": traffic_factor,
-        "traffic_status": "Heavy" if is_heavy_traffic else "Normal"
+        "traffic_status": traffic_status(traffic_factor)
+    }, surge_multiplier)
+
+def apply_surge(quote, surge_multiplier):
+    # Surge scales the whole fare, so it can go on top of a cached surge-free quote
+    return dict(quote, estimated_fare=round(quote['estimated_fare'] * Decimal(str(surge_multiplier)), 2),
+                surge_multiplier=surge_multiplier)
+
+def calculate_fares(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, vehicle_types=('car',), when=None,
+                    surge_multiplier=1.0):
+    """
+    calculate_fare for n trips at once, priced for every type in
+    `vehicle_types`. Coordinates are length-n arrays. Distances, traffic
+    and durations are computed once per trip and the fares as one
+    (n, vehicle types) array. `surge_multiplier` is a scalar or one per
+    trip. Returns a dict of arrays in input order, "estimated_fare" holding
+    one column per vehicle type.
+    """
+    rates = np.array([VEHICLE_RATES[vehicle_type] for vehicle_type in vehicle_types], dtype=float).reshape(-1, 3)
+    distance_km, free_flow_minutes = trip_distances(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+    bucket, _ = traffic_bucket(when)
+    traffic_factor = np.round((traffic_model.factors(pickup_lat, pickup_lon, bucket)
+                               + traffic_model.factors(dropoff_lat, dropoff_lon, bucket)) / 2, 2)
+    duration_minutes = np.floor(free_flow_minutes * traffic_factor)
+
+    total_fare = (rates[:, 0] + distance_km[:, None] * rates[:, 1]
+                  + duration_minutes[:, None] * rates[:, 2]) * traffic_factor[:, None]
+
+    surge_multiplier = np.broadcast_to(np.asarray(surge_multiplier, dtype=float), distance_km.shape)
+
+    return {
+        "estimated_fare": np.round(np.round(total_fare, 2) * surge_multiplier[:, None], 2),
+        "distance_km": np.round(distance_km, 2),
+        "duration_minutes": duration_minutes.astype(int),
+        "traffic_factor": traffic_factor,
+        "surge_multiplier": surge_multiplier,
     }
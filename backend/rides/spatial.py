@@ -0,0 +1,197 @@
+import heapq
+import math
+
+from django.conf import settings
+
+from .services import haversine_distance
+
+KM_PER_DEGREE_LAT = 111.32
+EARTH_RADIUS_KM = 6371
+
+
+def grid_cell_size():
+    # Cell edge in degrees. 0.01 deg is roughly 1.1 km in Dhaka.
+    return getattr(settings, 'RIDES_GRID_CELL_DEGREES', 0.01)
+
+
+def grid_cell(lat, lon, size=None):
+    size = size or grid_cell_size()
+    return (math.floor(lat / size), math.floor(lon / size))
+
+
+def valid_coordinates(lat, lon):
+    # Finite and on the globe, anything else can't be bucketed or serialized
+    return math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180
+
+
+def grid_cell_key(lat, lon, size=None):
+    x, y = grid_cell(lat, lon, size)
+    return f"{x}:{y}"
+
+
+def cells_in_radius(lat, lon, radius_km, size=None):
+    # All cells overlapping the bounding box of the search circle
+    size = size or grid_cell_size()
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    dlon = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+    min_x, min_y = grid_cell(lat - dlat, lon - dlon, size)
+    max_x, max_y = grid_cell(lat + dlat, lon + dlon, size)
+    return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def cells_in_bbox(south, west, north, east, size=None):
+    size = size or grid_cell_size()
+    min_x, min_y = grid_cell(south, west, size)
+    max_x, max_y = grid_cell(north, east, size)
+    return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def bbox_cell_count(south, west, north, east, size=None):
+    # len(cells_in_bbox(...)) without building the list
+    size = size or grid_cell_size()
+    min_x, min_y = grid_cell(south, west, size)
+    max_x, max_y = grid_cell(north, east, size)
+    return (max_x - min_x + 1) * (max_y - min_y + 1)
+
+
+def valid_bbox(south, west, north, east):
+    return valid_coordinates(south, west) and valid_coordinates(north, east) and south <= north and west <= east
+
+
+def in_bbox(lat, lon, bbox):
+    south, west, north, east = bbox
+    return south <= lat <= north and west <= lon <= east
+
+
+def initial_bearing(lat1, lon1, lat2, lon2):
+    # Degrees clockwise from north
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dlon = math.radians(lon2 - lon1)
+    x = math.sin(dlon) * math.cos(phi2)
+    y = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(dlon)
+    return (math.degrees(math.atan2(x, y)) + 360) % 360
+
+
+def destination_point(lat, lon, distance_km, bearing_deg):
+    phi1, lambda1 = math.radians(lat), math.radians(lon)
+    theta = math.radians(bearing_deg)
+    delta = distance_km / EARTH_RADIUS_KM
+    phi2 = math.asin(math.sin(phi1) * math.cos(delta) + math.cos(phi1) * math.sin(delta) * math.cos(theta))
+    lambda2 = lambda1 + math.atan2(
+        math.sin(theta) * math.sin(delta) * math.cos(phi1),
+        math.cos(delta) - math.sin(phi1) * math.sin(phi2),
+    )
+    return math.degrees(phi2), math.degrees(lambda2)
+
+
+def motion_from_fixes(prev_lat, prev_lon, prev_at, lat, lon, at, prev_heading=None,
+                      min_step_m=5, max_speed_kmh=80):
+    """
+    (speed_kmh, heading) between two consecutive fixes. Moves under
+    min_step_m read as standing still and keep the previous heading.
+    """
+    seconds = (at - prev_at).total_seconds()
+    if seconds <= 0:
+        return None
+    distance_km = haversine_distance(prev_lat, prev_lon, lat, lon)
+    if distance_km * 1000 < min_step_m:
+        return 0.0, prev_heading
+    speed_kmh = distance_km / (seconds / 3600)
+    if speed_kmh > max_speed_kmh:
+        return None
+    return speed_kmh, initial_bearing(prev_lat, prev_lon, lat, lon)
+
+
+def predict_position(lat, lon, speed_kmh, heading, elapsed_s, horizon_s):
+    # Dead reckoning: straight line at constant speed, capped at horizon_s
+    if not speed_kmh or heading is None or elapsed_s <= 0:
+        return lat, lon
+    elapsed_s = min(elapsed_s, horizon_s)
+    return destination_point(lat, lon, speed_kmh * elapsed_s / 3600, heading)
+
+
+class GridIndex:
+    """In-memory point index bucketed by grid cell."""
+
+    def __init__(self, size=None):
+        self.size = size or grid_cell_size()
+        self._cells = {}
+        self._where = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def upsert(self, key, lat, lon):
+        cell = grid_cell(lat, lon, self.size)
+        old = self._where.get(key)
+        if old is not None and old != cell:
+            self._discard(old, key)
+        self._cells.setdefault(cell, {})[key] = (lat, lon)
+        self._where[key] = cell
+
+    def remove(self, key):
+        cell = self._where.pop(key, None)
+        if cell is not None:
+            self._discard(cell, key)
+
+    def _discard(self, cell, key):
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self._cells[cell]
+
+    def within(self, lat, lon, radius_km):
+        # Yields (distance_km, key) for every point inside the radius
+        for cell in cells_in_radius(lat, lon, radius_km, self.size):
+            bucket = self._cells.get(cell)
+            if not bucket:
+                continue
+            for key, (plat, plon) in bucket.items():
+                distance = haversine_distance(lat, lon, plat, plon)
+                if distance <= radius_km:
+                    yield distance, key
+
+    def buckets_by_distance(self, lat, lon, radius_km):
+        """
+        [(min_km, bucket)] for the occupied cells in the radius, nearest cell
+        first. min_km is a lower bound on the distance to any point in the
+        cell, so callers can stop walking once it can't improve their result.
+        """
+        out = []
+        for cell in cells_in_radius(lat, lon, radius_km, self.size):
+            bucket = self._cells.get(cell)
+            if not bucket:
+                continue
+            x, y = cell
+            south, west = x * self.size, y * self.size
+            closest_lat = min(max(lat, south), south + self.size)
+            closest_lon = min(max(lon, west), west + self.size)
+            out.append((haversine_distance(lat, lon, closest_lat, closest_lon) * 0.999, cell, bucket))
+        out.sort(key=lambda item: item[:2])
+        return [(min_km, bucket) for min_km, _, bucket in out]
+
+    def nearest(self, lat, lon, radius_km, limit=None):
+        hits = self.within(lat, lon, radius_km)
+        if limit is None:
+            return sorted(hits)
+        return heapq.nsmallest(limit, hits)
+
+    def cell_counts(self):
+        # {cell: points in it}, read off the bucket sizes
+        return {cell: len(bucket) for cell, bucket in self._cells.items()}
+
+    def in_bbox(self, bbox):
+        # Keys of every point inside (south, west, north, east). Boxes spanning
+        # more cells than are occupied walk the occupied cells instead.
+        if bbox_cell_count(*bbox, size=self.size) > len(self._cells):
+            buckets = list(self._cells.values())
+        else:
+            buckets = [self._cells.get(cell, {}) for cell in cells_in_bbox(*bbox, size=self.size)]
+        for bucket in buckets:
+            for key, (lat, lon) in bucket.items():
+                if in_bbox(lat, lon, bbox):
+                    yield key
@@ -0,0 +1,103 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Ride, RideEvent
+
+# event -> (statuses it can leave from, status it moves to)
+TRANSITIONS = {
+    'accept': (('requested',), 'accepted'),
+    'start': (('accepted',), 'in_progress'),
+    'complete': (('in_progress',), 'completed'),
+    'release': (('scheduled',), 'requested'),  # booking reached its lead time
+    'cancel': (('scheduled', 'requested', 'accepted'), 'cancelled'),
+    'expire': (('requested',), 'cancelled'),  # nobody took it in time
+    'abandon': (('accepted', 'in_progress'), 'cancelled'),  # driver went silent
+}
+
+
+class TransitionError(Exception):
+    """The ride wasn't in a status the event can leave from, or changed underneath us."""
+
+
+def transition(ride, event, actor=None, where=None, data=None, **changes):
+    """
+    Moves a ride through `event` with a compare-and-set UPDATE and logs a
+    RideEvent in the same transaction.
+
+    `ride` is a Ride instance or a pk. With an instance, the update is
+    conditioned on the status it was read with, and the instance is updated
+    in place. With a pk, it is conditioned on the event's source statuses,
+    which saves the read. Only the status, updated_at and `changes` columns
+    are written. `where` adds extra filter conditions, e.g. the passenger.
+
+    Raises TransitionError when no row matched. IntegrityErrors from the
+    ride constraints propagate.
+    """
+    sources, target = TRANSITIONS[event]
+    if isinstance(ride, Ride):
+        if ride.status not in sources:
+            raise TransitionError(f"Can't {event} a {ride.status} ride")
+        pk, expected = ride.pk, (ride.status,)
+    else:
+        pk, expected = ride, sources
+    changes = dict(changes, status=target, updated_at=timezone.now())
+
+    with transaction.atomic():
+        updated = Ride.objects.filter(pk=pk, status__in=expected, **(where or {})).update(**changes)
+        if not updated:
+            raise TransitionError(f"Can't {event} ride {pk}")
+        RideEvent.objects.create(
+            ride_id=pk, event=event, from_status=expected[0] if len(expected) == 1 else '',
+            to_status=target, actor=actor, data=data or {},
+        )
+
+    if isinstance(ride, Ride):
+        for field, value in changes.items():
+            setattr(ride, field, value)
+    return ride
+
+
+def updated_ids(ride_ids, status, stamp):
+    # Which of `ride_ids` a bulk UPDATE to `status` at updated_at=`stamp` actually changed
+    return set(Ride.objects.filter(id__in=ride_ids, status=status, updated_at=stamp).values_list('id', flat=True))
+
+
+def record_accepts(pairs):
+    # Event rows for rides the dispatcher accepted in bulk, [(ride_id, driver_id, pickup_km)]
+    RideEvent.objects.bulk_create([
+        RideEvent(ride_id=ride_id, event='accept', from_status='requested', to_status='accepted',
+                  data={'driver_id': driver_id, 'pickup_km': round(pickup_km, 3), 'dispatch': True})
+        for ride_id, driver_id, pickup_km in pairs
+    ])
+
+
+def transition_many(queryset, event, limit, data=None, **changes):
+    """
+    Moves up to `limit` rides from `queryset` through `event` with one
+    UPDATE, logging an event per ride. `changes` are written alongside the
+    status. Returns [(ride_id, from_status, driver_id)] for the rides that
+    moved, driver_id as it was before the update.
+    """
+    sources, target = TRANSITIONS[event]
+    with transaction.atomic():
+        rows = list(queryset.select_for_update().filter(status__in=sources).order_by()
+                    .values_list('id', 'status', 'driver_id')[:limit])
+        if not rows:
+            return []
+        # Each row is only moved from the status it was read with, select_for_update
+        # locks nothing on SQLite
+        now = timezone.now()
+        by_status = {}
+        for ride_id, from_status, _ in rows:
+            by_status.setdefault(from_status, []).append(ride_id)
+        updated = sum(Ride.objects.filter(id__in=ride_ids, status=from_status).update(
+            status=target, updated_at=now, **changes
+        ) for from_status, ride_ids in by_status.items())
+        if updated < len(rows):
+            moved = updated_ids([ride_id for ride_id, _, _ in rows], target, now)
+            rows = [row for row in rows if row[0] in moved]
+        RideEvent.objects.bulk_create([
+            RideEvent(ride_id=ride_id, event=event, from_status=from_status, to_status=target, data=data or {})
+            for ride_id, from_status, _ in rows
+        ])
+    return rows
@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .location_store import location_store
+from .ride_index import open_rides
+from .spatial import grid_cell, grid_cell_size
+
+NEIGHBOURHOOD = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+class SurgeMeter:
+    """
+    Surge multiplier per grid cell from open requests vs online drivers.
+
+    Demand and supply are read off the bucket sizes of the open-ride index
+    and the location store's online-driver index, which ride creation,
+    transitions and location pings keep current. Every RIDES_SURGE_TICK
+    seconds a snapshot of those counts joins a RIDES_SURGE_WINDOW sliding
+    window, with running per-cell sums updated as snapshots enter and
+    leave. A cell's multiplier compares the window averages over it and
+    its 8 neighbours, so a quote costs nine dict lookups however many
+    rides are open. Snapshots are taken by whichever read finds the
+    current one stale.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset_window()
+
+    def _reset_window(self):
+        self._samples = deque()  # (taken_at, {cell: (demand, supply)})
+        self._sums = {}  # cell -> [demand, supply] summed over the window
+        self._sampled_at = None
+
+    @property
+    def tick(self):
+        return getattr(settings, 'RIDES_SURGE_TICK', 10.0)
+
+    @property
+    def window(self):
+        return getattr(settings, 'RIDES_SURGE_WINDOW', 300)
+
+    def _add(self, sample, sign):
+        for cell, counts in sample.items():
+            sums = self._sums.setdefault(cell, [0, 0])
+            sums[0] += sign * counts[0]
+            sums[1] += sign * counts[1]
+            if not sums[0] and not sums[1]:
+                del self._sums[cell]
+
+    def sample(self, now=None):
+        # Adds a snapshot of the live counts and drops the ones that left the window
+        now = time.monotonic() if now is None else now
+        demand, supply = open_rides.cell_counts(), location_store.available_cell_counts()
+        snapshot = {cell: (demand.get(cell, 0), supply.get(cell, 0)) for cell in demand.keys() | supply.keys()}
+        with self._lock:
+            self._samples.append((now, snapshot))
+            self._add(snapshot, 1)
+            while self._samples and self._samples[0][0] <= now - self.window:
+                self._add(self._samples.popleft()[1], -1)
+            self._sampled_at = now
+
+    def _ensure_fresh(self):
+        sampled_at = self._sampled_at
+        if sampled_at is None or time.monotonic() - sampled_at >= self.tick:
+            self.sample()
+
+    def _cell_surge(self, cell):
+        # (demand, supply, multiplier) for a cell and its neighbours, window averages
+        samples = len(self._samples) or 1
+        x, y = cell
+        demand = supply = 0
+        for dx, dy in NEIGHBOURHOOD:
+            sums = self._sums.get((x + dx, y + dy))
+            if sums is not None:
+                demand += sums[0]
+                supply += sums[1]
+        demand, supply = demand / samples, supply / samples
+        if demand < getattr(settings, 'RIDES_SURGE_MIN_DEMAND', 3):
+            return demand, supply, 1.0
+        pressure = demand / max(supply, 1.0) - 1
+        multiplier = 1 + getattr(settings, 'RIDES_SURGE_SENSITIVITY', 0.5) * max(pressure, 0.0)
+        # Tenth steps, so quotes don't jitter with every snapshot
+        multiplier = min(round(multiplier, 1), getattr(settings, 'RIDES_SURGE_MAX', 2.5))
+        return demand, supply, multiplier
+
+    def multiplier(self, lat, lon):
+        self._ensure_fresh()
+        with self._lock:
+            return self._cell_surge(grid_cell(lat, lon))[2]
+
+    def multipliers(self, lats, lons):
+        self._ensure_fresh()
+        with self._lock:
+            return [self._cell_surge(grid_cell(lat, lon))[2] for lat, lon in zip(lats, lons)]
+
+    def heatmap(self, bbox=None):
+        # Window-averaged demand, supply and surge of every cell with any, optionally inside a bbox
+        self._ensure_fresh()
+        size = grid_cell_size()
+        cells = []
+        with self._lock:
+            for cell in list(self._sums):
+                lat, lon = (cell[0] + 0.5) * size, (cell[1] + 0.5) * size
+                if bbox is not None and not (bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]):
+                    continue
+                sums = self._sums[cell]
+                samples = len(self._samples)
+                cells.append({
+                    "latitude": round(lat, 6),
+                    "longitude": round(lon, 6),
+                    "demand": round(sums[0] / samples, 2),
+                    "supply": round(sums[1] / samples, 2),
+                    "surge_multiplier": self._cell_surge(cell)[2],
+                })
+        return cells
+
+    def reset(self):
+        with self._lock:
+            self._reset_window()
+
+
+surge_meter = SurgeMeter()
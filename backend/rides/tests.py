@@ -1,3 +1,1466 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .bid_book import bid_book
+from .bid_windows import bid_scores, bid_windows
+from .consumers import DriverFeedConsumer
+from .dispatch import dispatcher, hungarian, match
+from .expiry import expiry_sweeper
+from .driver_stream import DriverStreamHub, driver_stream
+from .location_store import location_store
+from .models import DriverLocation, LocationFix, Ride, RideBid, RideEvent
+from .pooling import ride_pool
+from .quotes import DjangoCacheBackend, QuoteCache, quote_cache, sign_quote
+from .ride_index import open_rides
+from .roads import build_road_graph, road_graph
+from .routing import websocket_urlpatterns
+from .scheduler import ride_scheduler
+from .services import calculate_fare, calculate_fares, trip_fare
+from .spatial import GridIndex
+from .state_machine import TransitionError, transition, transition_many
+from .surge import surge_meter
+from .traces import trace_buffer
+from .traffic import build_traffic_model, traffic_bucket, traffic_model, traffic_time_zone
+
+User = get_user_model()
+
+# The in-process loops would tick against the test database behind the tests' backs
+background_loops_off = override_settings(RIDES_EXPIRY_INTERVAL=0, RIDES_SCHEDULE_TICK=0, RIDES_BID_WINDOW_TICK=0,
+                                         RIDES_DISPATCH_INTERVAL=0)
+
+
+def setUpModule():
+    background_loops_off.enable()
+
+
+def tearDownModule():
+    background_loops_off.disable()
+
+
+class GridIndexTests(APITestCase):
+    def test_nearest_sorted_and_bounded(self):
+        index = GridIndex(size=0.01)
+        index.upsert(1, 23.8103, 90.4125)
+        index.upsert(2, 23.8150, 90.4125)
+        index.upsert(3, 23.9000, 90.4125)  # ~10 km away
+        index.upsert(1, 23.8110, 90.4125)  # move within the index
+
+        nearest = index.nearest(23.8103, 90.4125, radius_km=2, limit=5)
+        self.assertEqual([key for _, key in nearest], [1, 2])
+
+        index.remove(1)
+        self.assertEqual([key for _, key in index.nearest(23.8103, 90.4125, 2)], [2])
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class DriverLocationViewTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+        self.far_driver = User.objects.create_user(username='driver2', password='pw', role='driver')
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+
+    def ping(self, user, lat, lon):
+        self.client.force_authenticate(user)
+        return self.client.post('/api/rides/drivers/', {'latitude': lat, 'longitude': lon}, format='json')
+
+    def test_ping_sets_grid_cell(self):
+        res = self.ping(self.driver, 23.8103, 90.4125)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(DriverLocation.objects.get(user=self.driver).grid_cell, '2381:9041')
+
+    def test_nearby_query(self):
+        self.ping(self.driver, 23.8103, 90.4125)
+        self.ping(self.far_driver, 23.9500, 90.4125)
+
+        self.client.force_authenticate(self.rider)
+        res = self.client.get('/api/rides/drivers/', {'lat': 23.8110, 'lon': 90.4125, 'radius_km': 5})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([d['username'] for d in res.data], ['driver1'])
+        self.assertIn('distance_km', res.data[0])
+
+        res = self.client.get('/api/rides/drivers/', {'lat': 'x', 'lon': 90.4})
+        self.assertEqual(res.status_code, 400)
+
+    def test_nearby_rejects_bad_search_area(self):
+        self.client.force_authenticate(self.rider)
+        for params in ({'lat': 'nan', 'lon': 90.4}, {'lat': 23.8, 'lon': 181},
+                       {'lat': 23.8, 'lon': 90.4, 'radius_km': 'inf'}, {'lat': 23.8, 'lon': 90.4, 'radius_km': 'nan'}):
+            self.assertEqual(self.client.get('/api/rides/drivers/', params).status_code, 400)
+
+        # Oversized radii are capped rather than scanning the whole grid
+        self.ping(self.driver, 23.8103, 90.4125)
+        self.client.force_authenticate(self.rider)
+        res = self.client.get('/api/rides/drivers/', {'lat': 23.8110, 'lon': 90.4125, 'radius_km': 1e9})
+        self.assertEqual([d['username'] for d in res.data], ['driver1'])
+
+    def test_bad_pings_are_rejected(self):
+        for lat, lon in (('nan', 90.4), (23.8, 'inf'), (91, 90.4), (23.8, -181)):
+            self.assertEqual(self.ping(self.driver, lat, lon).status_code, 400)
+        res = self.client.post('/api/rides/drivers/', {'latitude': 23.81, 'longitude': 90.41, 'vehicle_type': 'x' * 30},
+                               format='json')
+        self.assertEqual(res.status_code, 400)
+        res = self.client.post('/api/rides/drivers/batch/', {'fixes': [
+            {'latitude': 'nan', 'longitude': 90.41, 'timestamp': '2026-01-01T08:00:00Z'},
+        ]}, format='json')
+        self.assertEqual(res.status_code, 400)
+
+        # Nothing half-written, the feed still serializes
+        self.assertIsNone(location_store.get(self.driver.id))
+        self.client.force_authenticate(self.rider)
+        self.assertEqual(self.client.get('/api/rides/drivers/').status_code, 200)
+
+    def test_pings_are_written_behind(self):
+        with self.settings(RIDES_LOCATION_FLUSH_INTERVAL=60):
+            self.ping(self.driver, 23.8103, 90.4125)
+            self.ping(self.driver, 23.8104, 90.4126)
+
+            # Reads come from memory before the flush lands
+            self.client.force_authenticate(self.rider)
+            res = self.client.get('/api/rides/drivers/')
+            self.assertEqual(res.data[0]['latitude'], 23.8104)
+            self.assertFalse(DriverLocation.objects.exists())
+
+            location_store.stop()
+
+        location = DriverLocation.objects.get(user=self.driver)
+        self.assertEqual((location.latitude, location.grid_cell), (23.8104, '2381:9041'))
+        self.assertEqual(location_store.flush(), 0)
+
+    def test_delta_feed_and_etag(self):
+        self.ping(self.driver, 23.8103, 90.4125)
+        self.client.force_authenticate(self.rider)
+        res = self.client.get('/api/rides/drivers/', {'since': ''})
+        self.assertTrue(res.data['reset'])
+        cursor, etag = res.data['cursor'], res['ETag']
+
+        res = self.client.get('/api/rides/drivers/', {'since': cursor}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+
+        self.ping(self.far_driver, 23.9500, 90.4125)
+        self.client.force_authenticate(self.driver)
+        self.client.delete('/api/rides/drivers/')
+
+        self.client.force_authenticate(self.rider)
+        res = self.client.get('/api/rides/drivers/', {'since': cursor}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(res.data['reset'])
+        self.assertEqual([d['username'] for d in res.data['drivers']], ['driver2'])
+        self.assertEqual(res.data['removed'], ['driver1'])
+
+        res = self.client.get('/api/rides/drivers/', {'since': 'stale.1'})
+        self.assertTrue(res.data['reset'])
+
+        # Watermark mode is answered from the DB, never from the store cursor
+        res = self.client.get('/api/rides/drivers/', {'since': '2000-01-01T00:00:00Z'}, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('ETag', res)
+
+    def test_availability_follows_rides_and_ttl(self):
+        self.ping(self.driver, 23.8103, 90.4125)
+        self.ping(self.far_driver, 23.8110, 90.4125)
+        ride = Ride.objects.create(
+            passenger=self.rider, pickup_latitude=23.81, pickup_longitude=90.41, pickup_address='A',
+            dropoff_latitude=23.82, dropoff_longitude=90.42, dropoff_address='B',
+        )
+        self.client.force_authenticate(self.driver)
+        self.client.patch(f'/api/rides/{ride.id}/accept/')
+        self.assertEqual(DriverLocation.objects.get(user=self.driver).status, 'busy')
+
+        self.client.force_authenticate(self.rider)
+        res = self.client.get('/api/rides/drivers/', {'lat': 23.81, 'lon': 90.4125, 'status': 'online'})
+        self.assertEqual([d['username'] for d in res.data], ['driver2'])
+
+        with self.settings(RIDES_DRIVER_TTL=0):
+            self.assertEqual(location_store.sweep(), 2)
+        self.assertEqual(location_store.all(), [])
+        self.assertFalse(DriverLocation.objects.exclude(status='offline').exists())
+
+        # Coming back mid-ride is still busy
+        self.ping(self.driver, 23.8103, 90.4125)
+        self.assertEqual(location_store.get(self.driver.id)['status'], 'busy')
+
+
+class DriverStreamTests(APITestCase):
+    def entry(self, username, lat, lon):
+        return {'username': username, 'latitude': lat, 'longitude': lon,
+                'vehicle_type': 'car', 'status': 'online', 'updated_at': None,
+                'recorded_at': None, 'speed_kmh': 0.0, 'heading': None}
+
+    def test_route_only_reaches_covering_viewports(self):
+        hub = DriverStreamHub(size=0.01)
+        hub.subscribe('gulshan', (23.78, 90.40, 23.80, 90.42))
+        hub.subscribe('city', (23.0, 90.0, 24.5, 91.0))  # wide viewport, bbox-matched only
+        hub.subscribe('mirpur', (23.80, 90.35, 23.82, 90.37))
+
+        batches = hub.route(
+            [self.entry('d1', 23.79, 90.41), self.entry('d2', 23.81, 90.36)],
+            [self.entry('d3', 23.785, 90.405)],
+        )
+        self.assertEqual([d['username'] for d in batches['gulshan']['drivers']], ['d1'])
+        self.assertEqual(batches['gulshan']['removed'], ['d3'])
+        self.assertEqual([d['username'] for d in batches['mirpur']['drivers']], ['d2'])
+        self.assertEqual(len(batches['city']['drivers']), 2)
+
+        hub.unsubscribe('gulshan')
+        self.assertNotIn('gulshan', hub.route([self.entry('d1', 23.79, 90.41)], []))
+
+    def test_whole_world_and_bad_viewports(self):
+        # A world-sized box is wide, never enumerated cell by cell
+        hub = DriverStreamHub(size=0.01)
+        hub.subscribe('world', (-90, -180, 90, 180))
+        self.assertEqual(len(hub.route([self.entry('d1', 23.79, 90.41)], [])['world']['drivers']), 1)
+        index = GridIndex(size=0.01)
+        index.upsert('d1', 23.79, 90.41)
+        self.assertEqual(list(index.in_bbox((-90, -180, 90, 180))), ['d1'])
+
+        async def scenario():
+            communicator = WebsocketCommunicator(DriverFeedConsumer.as_asgi(), '/ws/drivers/')
+            await communicator.connect()
+            replies = []
+            for bbox in ([float('nan'), 90.40, 23.80, 90.42], [23.78, 90.40, 95, 90.42], [23.80, 90.40, 23.78, 90.42]):
+                await communicator.send_json_to({'action': 'subscribe', 'bbox': bbox})
+                replies.append((await communicator.receive_json_from())['type'])
+            await communicator.disconnect()
+            return replies
+
+        self.assertEqual(async_to_sync(scenario)(), ['error'] * 3)
+
+    @override_settings(RIDES_LOCATION_FLUSH_INTERVAL=60, RIDES_DRIVER_STREAM_TICK=0.01)
+    def test_subscriber_gets_snapshot_then_updates(self):
+        location_store.reset()
+        driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+        location_store.update(driver, 23.79, 90.41)
+
+        async def scenario():
+            communicator = WebsocketCommunicator(DriverFeedConsumer.as_asgi(), '/ws/drivers/')
+            await communicator.connect()
+            await communicator.send_json_to({'action': 'subscribe', 'bbox': [23.78, 90.40, 23.80, 90.42]})
+            snapshot = await communicator.receive_json_from()
+            location_store.update(driver, 23.791, 90.41)
+            update = await communicator.receive_json_from(timeout=2)
+            await communicator.disconnect()
+            return snapshot, update
+
+        snapshot, update = async_to_sync(scenario)()
+        location_store.reset()
+        location_store.stop()
+        self.assertEqual([d['username'] for d in snapshot['drivers']], ['driver1'])
+        self.assertEqual(update['type'], 'drivers')
+        self.assertEqual(update['drivers'][0]['latitude'], 23.791)
+        self.assertEqual(len(driver_stream), 0)
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class DriverLocationBatchTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+        self.client.force_authenticate(self.driver)
+
+    def test_newest_fix_is_live_rest_is_history(self):
+        fixes = [
+            {'latitude': 23.812, 'longitude': 90.412, 'timestamp': '2026-01-01T08:00:20Z'},
+            {'latitude': 23.810, 'longitude': 90.410, 'timestamp': '2026-01-01T08:00:00Z'},
+            {'latitude': 23.811, 'longitude': 90.411, 'timestamp': '2026-01-01T08:00:10Z'},
+        ]
+        res = self.client.post('/api/rides/drivers/batch/', {'fixes': fixes}, format='json')
+        self.assertEqual((res.data['accepted'], res.data['rejected']), (3, 0))
+        self.assertEqual(DriverLocation.objects.get(user=self.driver).latitude, 23.812)
+        self.assertEqual(
+            list(LocationFix.objects.order_by('recorded_at').values_list('latitude', flat=True)),
+            [23.810, 23.811],
+        )
+
+        # A retried burst overlapping what we already have only keeps the newer fixes
+        fixes = [
+            {'latitude': 23.811, 'longitude': 90.411, 'timestamp': '2026-01-01T08:00:10Z'},
+            {'latitude': 23.813, 'longitude': 90.413, 'timestamp': '2026-01-01T08:00:30Z'},
+        ]
+        res = self.client.post('/api/rides/drivers/batch/', {'fixes': fixes}, format='json')
+        self.assertEqual((res.data['accepted'], res.data['rejected']), (1, 1))
+        self.assertEqual(LocationFix.objects.count(), 2)
+
+        res = self.client.post('/api/rides/drivers/batch/', {'fixes': [{'latitude': 1}]}, format='json')
+        self.assertEqual(res.status_code, 400)
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class RideTraceTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.ride = Ride.objects.create(
+            passenger=self.rider, pickup_latitude=23.80, pickup_longitude=90.41, pickup_address='A',
+            dropoff_latitude=23.81, dropoff_longitude=90.41, dropoff_address='B',
+        )
+
+    def test_trace_is_appended_during_trip_and_simplified(self):
+        self.client.force_authenticate(self.driver)
+        self.client.patch(f'/api/rides/{self.ride.id}/accept/')
+        self.client.post('/api/rides/drivers/', {'latitude': 23.79, 'longitude': 90.41}, format='json')
+        self.client.post(f'/api/rides/{self.ride.id}/start_ride/')
+        # Straight line north, the middle points are redundant
+        for i in range(5):
+            self.client.post('/api/rides/drivers/', {'latitude': 23.80 + i * 0.002, 'longitude': 90.41}, format='json')
+        self.assertEqual(self.ride.trace.point_count, 5)
+
+        self.client.post(f'/api/rides/{self.ride.id}/complete_ride/')
+        self.client.force_authenticate(self.rider)
+        res = self.client.get(f'/api/rides/{self.ride.id}/trace/')
+        self.assertTrue(res.data['simplified'])
+        self.assertEqual([p[:2] for p in res.data['points']], [[23.80, 90.41], [23.808, 90.41]])
+
+        # A flush that picked up fixes before completion can't write the raw trace back
+        trace_buffer.append(self.ride.id, 23.81, 90.41, timezone.now())
+        self.assertEqual(trace_buffer.flush(), 0)
+        self.assertEqual(self.client.get(f'/api/rides/{self.ride.id}/trace/').data['points'], res.data['points'])
+
+    def test_odometer_fills_distance_and_fare_on_completion(self):
+        Ride.objects.filter(id=self.ride.id).update(vehicle_type='bike')
+        self.client.force_authenticate(self.driver)
+        self.client.patch(f'/api/rides/{self.ride.id}/accept/')
+        self.client.post(f'/api/rides/{self.ride.id}/start_ride/')
+        start = timezone.now() - timedelta(minutes=5)
+        fixes = []
+        for i in range(11):
+            # ~111 m north every 20 s, with 3 m of sideways jitter in between
+            fixes.append({'latitude': 23.80 + i * 0.001, 'longitude': 90.41,
+                          'timestamp': (start + timedelta(seconds=20 * i)).isoformat()})
+            fixes.append({'latitude': 23.80 + i * 0.001, 'longitude': 90.41003,
+                          'timestamp': (start + timedelta(seconds=20 * i + 10)).isoformat()})
+        fixes.append({'latitude': 25.0, 'longitude': 90.41,  # glitch
+                      'timestamp': (start + timedelta(seconds=230)).isoformat()})
+        fixes.append({'latitude': 23.8101, 'longitude': 90.41,
+                      'timestamp': (start + timedelta(seconds=240)).isoformat()})
+        self.client.post('/api/rides/drivers/batch/', {'fixes': fixes}, format='json')
+
+        self.client.post(f'/api/rides/{self.ride.id}/complete_ride/')
+        self.ride.refresh_from_db()
+        self.assertAlmostEqual(self.ride.distance_km, 1.12, places=2)
+        # Metered at the rates of the vehicle that was booked
+        self.assertEqual(self.ride.actual_fare, trip_fare(self.ride.distance_km, self.ride.duration_minutes, 'bike'))
+        self.assertLess(self.ride.actual_fare, trip_fare(self.ride.distance_km, self.ride.duration_minutes))
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class DeadReckoningTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+
+    def test_feed_carries_velocity_and_predicts(self):
+        start = timezone.now() - timedelta(seconds=30)
+        fixes = [
+            {'latitude': 23.800, 'longitude': 90.41, 'timestamp': start.isoformat()},
+            # 111 m due north in 20 s, ~20 km/h
+            {'latitude': 23.801, 'longitude': 90.41, 'timestamp': (start + timedelta(seconds=20)).isoformat()},
+        ]
+        self.client.force_authenticate(self.driver)
+        self.client.post('/api/rides/drivers/batch/', {'fixes': fixes}, format='json')
+
+        res = self.client.get('/api/rides/drivers/')
+        self.assertIn('X-Server-Time', res)
+        self.assertAlmostEqual(res.data[0]['speed_kmh'], 20.0, delta=0.1)
+        self.assertAlmostEqual(res.data[0]['heading'], 0.0, delta=0.1)
+
+        at = (start + timedelta(seconds=30)).isoformat()
+        res = self.client.get('/api/rides/drivers/', {'at': at})
+        self.assertAlmostEqual(res.data[0]['predicted_latitude'], 23.8015, places=4)
+        self.assertAlmostEqual(res.data[0]['predicted_longitude'], 90.41, places=5)
+
+    def test_next_update_in_follows_driver_state_and_load(self):
+        self.client.force_authenticate(self.driver)
+        res = self.client.post('/api/rides/drivers/', {'latitude': 23.80, 'longitude': 90.41}, format='json')
+        self.assertEqual(res.data['next_update_in'], 45)
+
+        with self.settings(RIDES_PING_CAPACITY=0.1):
+            res = self.client.post('/api/rides/drivers/', {'latitude': 23.80, 'longitude': 90.41}, format='json')
+        self.assertEqual(res.data['next_update_in'], 60)  # backed off, capped at half the TTL
+
+        location_store.begin_trip(self.driver.id, 1, timezone.now())
+        with self.settings(RIDES_PING_CAPACITY=0.1):
+            res = self.client.post('/api/rides/drivers/', {'latitude': 23.80, 'longitude': 90.41}, format='json')
+        self.assertEqual(res.data['next_update_in'], 5)
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class RideFeedTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+
+    def request_ride(self, lat, lon, fare):
+        ride = Ride.objects.create(
+            passenger=self.rider, pickup_address='A', dropoff_address='B',
+            pickup_latitude=lat, pickup_longitude=lon,
+            dropoff_latitude=lat + 0.02, dropoff_longitude=lon, estimated_fare=fare,
+        )
+        open_rides.add(ride)
+        return ride
+
+    def test_feed_filters_by_radius_and_ranks(self):
+        near = self.request_ride(23.8010, 90.4100, 100)     # ~110 m
+        pricier = self.request_ride(23.8050, 90.4100, 400)  # ~550 m, worth the detour
+        self.request_ride(23.9000, 90.4100, 1000)           # ~11 km, outside the radius
+        self.client.force_authenticate(self.driver)
+
+        res = self.client.get('/api/rides/feed/')
+        self.assertEqual(res.data, {'active': None, 'requests': []})  # no known location yet
+
+        self.client.post('/api/rides/drivers/', {'latitude': 23.80, 'longitude': 90.41}, format='json')
+        res = self.client.get('/api/rides/feed/', {'radius_km': 3})
+        self.assertEqual([r['id'] for r in res.data['requests']], [pricier.id, near.id])
+        self.assertAlmostEqual(res.data['requests'][1]['pickup_distance_km'], 0.111, delta=0.002)
+        self.assertIsNone(res.data['active'])
+
+        res = self.client.get('/api/rides/feed/', {'radius_km': 3, 'limit': 1})
+        self.assertEqual([r['id'] for r in res.data['requests']], [pricier.id])
+
+        for radius in ('inf', 'nan', -1):
+            self.assertEqual(self.client.get('/api/rides/feed/', {'radius_km': radius}).status_code, 400)
+        with self.settings(RIDES_DRIVER_FEED_MAX_RADIUS_KM=3):
+            res = self.client.get('/api/rides/feed/', {'radius_km': 1e9})
+        self.assertEqual([r['id'] for r in res.data['requests']], [pricier.id, near.id])
+
+    def test_accepted_rides_leave_the_feed(self):
+        ride = self.request_ride(23.8010, 90.4100, 100)
+        stale = self.request_ride(23.8020, 90.4100, 100)
+        Ride.objects.filter(id=stale.id).update(status='cancelled')  # changed behind the index's back
+        self.client.force_authenticate(self.driver)
+        self.client.post('/api/rides/drivers/', {'latitude': 23.80, 'longitude': 90.41}, format='json')
+
+        self.client.patch(f'/api/rides/{ride.id}/accept/')
+        res = self.client.get('/api/rides/feed/')
+        self.assertEqual(res.data['requests'], [])
+        self.assertEqual(res.data['active']['id'], ride.id)
+        self.assertEqual(len(open_rides), 0)
+
+        # Going offline mid-ride drops the requests, not the driver's own ride
+        self.client.delete('/api/rides/drivers/')
+        res = self.client.get('/api/rides/feed/')
+        self.assertEqual((res.data['active']['id'], res.data['requests']), (ride.id, []))
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0, RIDES_DISPATCH_MODE='batch')
+class DispatchTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.drivers = [User.objects.create_user(username=f'driver{i}', password='pw', role='driver') for i in range(3)]
+
+    def test_hungarian_beats_greedy_pairing(self):
+        # Greedy would give ride 0 driver 0 (cost 1) and leave ride 1 with cost 10
+        cost = [[1, 2], [2, 10]]
+        self.assertEqual(sorted(hungarian(cost)), [(0, 1), (1, 0)])
+        self.assertEqual(sorted(hungarian([[5, 1, 9]])), [(0, 1)])
+
+    def test_window_minimises_pickup_and_commits(self):
+        rides = [
+            Ride.objects.create(passenger=self.rider, pickup_address='A', dropoff_address='B',
+                                pickup_latitude=23.80, pickup_longitude=lon,
+                                dropoff_latitude=23.82, dropoff_longitude=lon)
+            for lon in (90.400, 90.410)
+        ]
+        # driver0 sits between the pickups, driver1 next to the second, driver2 is 20 km out
+        for driver, (lat, lon) in zip(self.drivers, [(23.80, 90.404), (23.80, 90.411), (23.98, 90.40)]):
+            location_store.update(driver, lat, lon)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = dispatcher.run_window()
+        self.assertEqual((stats['rides'], stats['drivers'], stats['matched']), (2, 3, 2))
+        rides = [Ride.objects.get(id=ride.id) for ride in rides]
+        self.assertEqual([(r.status, r.driver_id) for r in rides],
+                         [('accepted', self.drivers[0].id), ('accepted', self.drivers[1].id)])
+        self.assertEqual(location_store.get(self.drivers[0].id)['status'], 'busy')
+        self.assertEqual(location_store.get(self.drivers[2].id)['status'], 'online')
+        self.assertEqual(dispatcher.run_window()['matched'], 0)
+
+        # Drivers don't grab rides themselves in batch mode
+        late = Ride.objects.create(passenger=self.rider, pickup_address='A', dropoff_address='B',
+                                   pickup_latitude=23.98, pickup_longitude=90.40,
+                                   dropoff_latitude=23.99, dropoff_longitude=90.40)
+        self.client.force_authenticate(self.drivers[2])
+        res = self.client.patch(f'/api/rides/{late.id}/accept/')
+        self.assertEqual(res.status_code, 400)
+
+    def test_command_reads_drivers_from_the_database(self):
+        ride = Ride.objects.create(passenger=self.rider, pickup_address='A', dropoff_address='B',
+                                   pickup_latitude=23.80, pickup_longitude=90.40,
+                                   dropoff_latitude=23.82, dropoff_longitude=90.40)
+        # driver0 is closest but stopped pinging, the command's own store knows nobody
+        for driver, lon in zip(self.drivers[:2], (90.400, 90.405)):
+            DriverLocation.objects.create(user=driver, latitude=23.80, longitude=lon)
+        DriverLocation.objects.filter(user=self.drivers[0]).update(updated_at=timezone.now() - timedelta(hours=1))
+        location_store.reset()
+
+        call_command('dispatch', '--once', stdout=io.StringIO())
+        ride.refresh_from_db()
+        self.assertEqual((ride.status, ride.driver_id), ('accepted', self.drivers[1].id))
+        self.assertEqual(DriverLocation.objects.get(user=self.drivers[1]).status, 'busy')
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class RideAcceptanceTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+        self.rival = User.objects.create_user(username='driver2', password='pw', role='driver')
+
+    def request_ride(self):
+        return Ride.objects.create(
+            passenger=self.rider, pickup_address='A', dropoff_address='B',
+            pickup_latitude=23.80, pickup_longitude=90.41,
+            dropoff_latitude=23.82, dropoff_longitude=90.41,
+        )
+
+    def test_only_first_accept_wins(self):
+        ride = self.request_ride()
+        self.client.force_authenticate(self.driver)
+        self.assertEqual(self.client.patch(f'/api/rides/{ride.id}/accept/').status_code, 200)
+        self.client.force_authenticate(self.rival)
+        res = self.client.patch(f'/api/rides/{ride.id}/accept/')
+        self.assertEqual(res.status_code, 404)  # no longer visible to other drivers
+        ride.refresh_from_db()
+        self.assertEqual((ride.status, ride.driver_id), ('accepted', self.driver.id))
+
+    def test_non_numeric_pk_is_not_found(self):
+        self.client.force_authenticate(self.driver)
+        self.assertEqual(self.client.patch('/api/rides/abc/accept/').status_code, 404)
+        self.client.force_authenticate(self.rider)
+        self.assertEqual(self.client.post('/api/rides/abc/accept_bid/', {'bid_id': 1}).status_code, 404)
+        ride = self.request_ride()
+        self.assertEqual(self.client.post(f'/api/rides/{ride.id}/accept_bid/', {'bid_id': 'x'}).status_code, 400)
+
+    def test_driver_cannot_hold_two_rides(self):
+        first, second = self.request_ride(), self.request_ride()
+        self.client.force_authenticate(self.driver)
+        self.client.patch(f'/api/rides/{first.id}/accept/')
+        res = self.client.patch(f'/api/rides/{second.id}/accept/')
+        self.assertEqual(res.status_code, 400)
+        self.assertIn('already have an active ride', res.data['error'])
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'requested')
+
+        # The database enforces it for every writer, not just the view
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Ride.objects.filter(id=second.id).update(driver=self.driver, status='accepted')
+
+    def test_accept_bid_claims_ride_and_settles_bids(self):
+        ride = self.request_ride()
+        winning = RideBid.objects.create(ride=ride, driver=self.driver, amount=120)
+        losing = RideBid.objects.create(ride=ride, driver=self.rival, amount=150)
+        self.client.force_authenticate(self.rival)
+        res = self.client.post(f'/api/rides/{ride.id}/accept_bid/', {'bid_id': winning.id}, format='json')
+        self.assertEqual(res.status_code, 403)
+
+        self.client.force_authenticate(self.rider)
+        res = self.client.post(f'/api/rides/{ride.id}/accept_bid/', {'bid_id': winning.id}, format='json')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['driver'], 'driver1')
+        self.assertEqual(res.data['actual_fare'], '120.00')
+        self.assertEqual([b.status for b in RideBid.objects.order_by('id')], ['accepted', 'rejected'])
+
+        res = self.client.post(f'/api/rides/{ride.id}/accept_bid/', {'bid_id': losing.id}, format='json')
+        self.assertEqual(res.status_code, 400)
+
+        # A bid from a driver who got another ride meanwhile can't be taken
+        other = self.request_ride()
+        stale = RideBid.objects.create(ride=other, driver=self.driver, amount=100)
+        res = self.client.post(f'/api/rides/{other.id}/accept_bid/', {'bid_id': stale.id}, format='json')
+        self.assertEqual(res.status_code, 400)
+        other.refresh_from_db()
+        self.assertEqual(other.status, 'requested')
+
+
+class BidBookTests(APITestCase):
+    def setUp(self):
+        bid_book.reset()
+        open_rides.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.drivers = [User.objects.create_user(username=f'driver{i}', password='pw', role='driver') for i in range(3)]
+        self.ride = Ride.objects.create(
+            passenger=self.rider, pickup_address='A', dropoff_address='B',
+            pickup_latitude=23.80, pickup_longitude=90.41, dropoff_latitude=23.82, dropoff_longitude=90.41,
+        )
+
+    def place_bid(self, driver, amount):
+        self.client.force_authenticate(driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/rides/{self.ride.id}/bid/', {'amount': amount}, format='json')
+
+    def poll(self, since=None):
+        self.client.force_authenticate(self.rider)
+        return self.client.get(f'/api/rides/{self.ride.id}/bids/', {'since': since} if since else {})
+
+    @override_settings(RIDES_BID_BOOK_TOP_K=2)
+    def test_delta_poll_by_cursor(self):
+        RideBid.objects.create(ride=self.ride, driver=self.drivers[0], amount=150)  # before the book was loaded
+        first = self.poll()
+        self.assertEqual([b['amount'] for b in first.data['bids']], ['150.00'])
+        self.assertEqual(self.poll(first.data['cursor']).status_code, 304)
+        self.client.force_authenticate(self.rider)
+        etag = first['ETag']
+        self.assertEqual(self.client.get(f'/api/rides/{self.ride.id}/bids/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.place_bid(self.drivers[1], 120)
+        res = self.poll(first.data['cursor'])
+        self.assertEqual([(b['driver_name'], b['amount']) for b in res.data['bids']],
+                         [('driver1', '120.00'), ('driver0', '150.00')])
+        # Outside the top 2, the cursor doesn't move
+        self.place_bid(self.drivers[2], 200)
+        self.assertEqual(self.poll(res.data['cursor']).status_code, 304)
+        # Re-pricing reorders
+        self.place_bid(self.drivers[2], 100)
+        res = self.poll(res.data['cursor'])
+        self.assertEqual([b['driver_name'] for b in res.data['bids']], ['driver2', 'driver1'])
+        self.assertEqual(res.data['count'], 3)
+
+        self.client.force_authenticate(self.drivers[0])
+        self.assertEqual(self.client.get(f'/api/rides/{self.ride.id}/bids/').status_code, 404)
+
+        self.client.force_authenticate(self.rider)
+        self.client.post(f'/api/rides/{self.ride.id}/accept_bid/', {'bid_id': res.data['bids'][0]['id']}, format='json')
+        self.assertEqual(len(bid_book), 0)
+        res = self.poll(res.data['cursor'])
+        self.assertEqual(res.data['status'], 'accepted')
+        self.assertEqual(sorted(b['status'] for b in res.data['bids']), ['accepted', 'rejected', 'rejected'])
+
+    def test_book_only_takes_committed_bids_on_open_rides(self):
+        self.poll()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                bid_book.place(RideBid.objects.create(ride=self.ride, driver=self.drivers[0], amount=90))
+                transaction.set_rollback(True)
+        self.assertEqual(self.poll().data['bids'], [])
+
+        # A bid that commits after the ride was settled and its book closed
+        bid = RideBid.objects.create(ride=self.ride, driver=self.drivers[1], amount=95)
+        Ride.objects.filter(id=self.ride.id).update(status='cancelled')
+        bid_book.close([self.ride.id], 'cancelled')
+        with self.captureOnCommitCallbacks(execute=True):
+            bid_book.place(bid)
+        self.assertEqual(len(bid_book), 0)
+
+    def test_ride_detail_bids_in_constant_queries(self):
+        for i, driver in enumerate(self.drivers):
+            RideBid.objects.create(ride=self.ride, driver=driver, amount=100 + i)
+        self.client.force_authenticate(self.rider)
+        with self.assertNumQueries(3):  # the ride, its bids, their drivers
+            res = self.client.get(f'/api/rides/{self.ride.id}/')
+        self.assertEqual([b['driver_name'] for b in res.data['bids']], ['driver0', 'driver1', 'driver2'])
+
+    def test_passenger_gets_pushed_changes(self):
+        application = URLRouter(websocket_urlpatterns)
+        path = f'/ws/rides/{self.ride.id}/bids/?token='
+
+        async def scenario():
+            outsider = WebsocketCommunicator(application, path + str(AccessToken.for_user(self.drivers[0])))
+            refused, _ = await outsider.connect()
+
+            communicator = WebsocketCommunicator(application, path + str(AccessToken.for_user(self.rider)))
+            connected, _ = await communicator.connect()
+            snapshot = await communicator.receive_json_from()
+            await database_sync_to_async(self.place_bid)(self.drivers[0], 130)
+            update = await communicator.receive_json_from(timeout=2)
+            await database_sync_to_async(self.place_bid)(self.drivers[1], 110)
+            second = await communicator.receive_json_from(timeout=2)
+
+            self.client.force_authenticate(self.rider)
+            await database_sync_to_async(self.client.post)(
+                f'/api/rides/{self.ride.id}/accept_bid/', {'bid_id': second['bids'][0]['id']}, format='json')
+            closed = await communicator.receive_json_from(timeout=2)
+            await communicator.disconnect()
+            return refused, connected, snapshot, update, second, closed
+
+        refused, connected, snapshot, update, second, closed = async_to_sync(scenario)()
+        self.assertFalse(refused)
+        self.assertTrue(connected)
+        self.assertEqual((snapshot['type'], snapshot['bids']), ('snapshot', []))
+        self.assertEqual(update['type'], 'bids')
+        self.assertEqual([b['amount'] for b in update['bids']], ['130.00'])
+        self.assertEqual([b['driver_name'] for b in second['bids']], ['driver1', 'driver0'])
+        self.assertNotEqual(second['cursor'], update['cursor'])
+        self.assertEqual(closed, {'type': 'closed', 'status': 'accepted'})
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0, RIDES_BID_WINDOW_POLICY={'price': 1.0, 'rating': 0.0, 'pickup_km': 0.0})
+class BidWindowTests(APITestCase):
+    def setUp(self):
+        bid_windows.reset()
+        bid_book.reset()
+        open_rides.reset()
+        location_store.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.drivers = [User.objects.create_user(username=f'driver{i}', password='pw', role='driver', rating=5.0 - i)
+                        for i in range(3)]
+
+    def request_ride(self, closes_in, fare=100):
+        ride = Ride.objects.create(
+            passenger=self.rider, pickup_address='A', dropoff_address='B', estimated_fare=fare,
+            pickup_latitude=23.80, pickup_longitude=90.41, dropoff_latitude=23.82, dropoff_longitude=90.41,
+            bid_window_closes_at=timezone.now() + timedelta(seconds=closes_in),
+        )
+        open_rides.add(ride)
+        return ride
+
+    def bid(self, ride, driver, amount):
+        return RideBid.objects.create(ride=ride, driver=driver, amount=amount)
+
+    def settle(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return bid_windows.tick()
+
+    def test_booking_opens_a_window(self):
+        self.client.force_authenticate(self.rider)
+        route = {'pickup_latitude': 23.80, 'pickup_longitude': 90.41, 'dropoff_latitude': 23.82,
+                 'dropoff_longitude': 90.41, 'pickup_address': 'A', 'dropoff_address': 'B'}
+        res = self.client.post('/api/rides/', dict(route, bid_window_seconds=60), format='json')
+        self.assertEqual(res.status_code, 201)
+        closes_at = Ride.objects.get(id=res.data['id']).bid_window_closes_at
+        self.assertAlmostEqual((closes_at - timezone.now()).total_seconds(), 60, delta=5)
+        self.assertEqual(self.client.post('/api/rides/', dict(route, bid_window_seconds=5), format='json').status_code, 400)
+
+        # Nothing is due yet, and bids are taken until the window closes
+        self.assertEqual(self.settle(), 0)
+        Ride.objects.filter(id=res.data['id']).update(bid_window_closes_at=timezone.now())
+        self.client.force_authenticate(self.drivers[0])
+        res = self.client.post(f'/api/rides/{res.data["id"]}/bid/', {'amount': 90}, format='json')
+        self.assertEqual(res.status_code, 400)
+
+    def test_invalid_bids_cannot_win(self):
+        ride = self.request_ride(60)
+        for driver, amount in zip(self.drivers, ('-5', 'NaN', 'abc')):
+            self.client.force_authenticate(driver)
+            self.assertEqual(self.client.post(f'/api/rides/{ride.id}/bid/', {'amount': amount}, format='json').status_code,
+                             400)
+        self.client.force_authenticate(self.drivers[2])
+        self.client.post(f'/api/rides/{ride.id}/bid/', {'amount': 120}, format='json')
+
+        Ride.objects.filter(id=ride.id).update(bid_window_closes_at=timezone.now())
+        self.assertEqual(self.settle(), 1)
+        ride.refresh_from_db()
+        self.assertEqual((ride.driver_id, ride.actual_fare), (self.drivers[2].id, 120))
+
+    def test_closed_windows_settle_together(self):
+        first, second, quiet, open_ride = (self.request_ride(-30), self.request_ride(-10), self.request_ride(-5),
+                                           self.request_ride(60))
+        self.bid(first, self.drivers[0], 80)
+        self.bid(first, self.drivers[1], 90)
+        # driver0 is also cheapest here, but already won the earlier window
+        self.bid(second, self.drivers[0], 70)
+        runner_up = self.bid(second, self.drivers[2], 95)
+        self.bid(open_ride, self.drivers[1], 50)
+
+        self.assertEqual(self.settle(), 2)
+        rides = Ride.objects.in_bulk([first.id, second.id, quiet.id, open_ride.id])
+        self.assertEqual((rides[first.id].status, rides[first.id].driver_id, rides[first.id].actual_fare),
+                         ('accepted', self.drivers[0].id, 80))
+        self.assertEqual((rides[second.id].driver_id, rides[second.id].actual_fare), (self.drivers[2].id, 95))
+        self.assertEqual(rides[quiet.id].status, 'requested')  # no bids, left for a manual accept or expiry
+        self.assertEqual(rides[open_ride.id].status, 'requested')
+        self.assertEqual(
+            sorted(RideBid.objects.filter(ride__in=[first, second]).values_list('driver__username', 'status')),
+            [('driver0', 'accepted'), ('driver0', 'rejected'), ('driver1', 'rejected'), ('driver2', 'accepted')],
+        )
+        event = RideEvent.objects.get(ride=second, event='accept')
+        self.assertEqual(event.data, {'bid_id': runner_up.id, 'amount': '95.00', 'bid_window': True})
+        self.assertEqual(len(open_rides), 2)
+        self.assertEqual(len(bid_windows), 1)  # the window still open
+
+    def test_policy_weights(self):
+        ride = self.request_ride(-1)
+        self.bid(ride, self.drivers[2], 80)  # cheapest, 3 stars
+        self.bid(ride, self.drivers[0], 90)  # 5 stars
+        with override_settings(RIDES_BID_WINDOW_POLICY={'price': 1.0, 'rating': 1.0, 'pickup_km': 0.0}):
+            self.settle()
+        ride.refresh_from_db()
+        self.assertEqual(ride.driver_id, self.drivers[0].id)
+
+        # Nearby beats cheap when pickup distance weighs in, unknown positions count as far
+        scores = bid_scores([100, 90], [100, 100], [5, 5], np.array([0.5, np.nan]),
+                            weights={'price': 1.0, 'rating': 0.0, 'pickup_km': 1.0}, max_pickup_km=5.0)
+        self.assertLess(scores[0], scores[1])
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class RideStateMachineTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+
+    def test_transitions_are_logged_and_read_incrementally(self):
+        self.client.force_authenticate(self.rider)
+        ride_id = self.client.post('/api/rides/', {
+            'pickup_latitude': 23.80, 'pickup_longitude': 90.41, 'pickup_address': 'A',
+            'dropoff_latitude': 23.82, 'dropoff_longitude': 90.41, 'dropoff_address': 'B',
+        }, format='json').data['id']
+        self.client.force_authenticate(self.driver)
+        self.client.patch(f'/api/rides/{ride_id}/accept/')
+        res = self.client.post(f'/api/rides/{ride_id}/complete_ride/')
+        self.assertEqual(res.status_code, 400)  # not started yet
+        self.client.post(f'/api/rides/{ride_id}/start_ride/')
+        self.client.post(f'/api/rides/{ride_id}/complete_ride/')
+
+        res = self.client.get(f'/api/rides/{ride_id}/events/')
+        self.assertEqual([(e['event'], e['from_status'], e['to_status']) for e in res.data], [
+            ('request', '', 'requested'),
+            ('accept', 'requested', 'accepted'),
+            ('start', 'accepted', 'in_progress'),
+            ('complete', 'in_progress', 'completed'),
+        ])
+        self.assertEqual(res.data[1]['actor'], 'driver1')
+
+        res = self.client.get(f'/api/rides/{ride_id}/events/', {'after': res.data[1]['id']})
+        self.assertEqual([e['event'] for e in res.data], ['start', 'complete'])
+
+    def test_transition_is_compare_and_set(self):
+        ride = Ride.objects.create(passenger=self.rider, driver=self.driver, status='accepted',
+                                   pickup_address='A', dropoff_address='B', pickup_latitude=23.80,
+                                   pickup_longitude=90.41, dropoff_latitude=23.82, dropoff_longitude=90.41)
+        stale = Ride.objects.get(id=ride.id)
+        transition(ride, 'start', actor=self.driver)
+        self.assertEqual(ride.status, 'in_progress')
+        with self.assertRaises(TransitionError):
+            transition(stale, 'start')  # read as accepted, already moved on
+        with self.assertRaises(TransitionError):
+            transition(ride, 'accept')  # not a source status for accept
+        self.assertEqual(RideEvent.objects.filter(ride=ride).count(), 1)
+
+        event = RideEvent.objects.get(ride=ride)
+        event.to_status = 'completed'
+        with self.assertRaises(ValueError):
+            event.save()
+
+    def test_bulk_transition_rechecks_status(self):
+        rides = [Ride.objects.create(passenger=self.rider, pickup_address='A', dropoff_address='B',
+                                     pickup_latitude=23.80, pickup_longitude=90.41,
+                                     dropoff_latitude=23.82, dropoff_longitude=90.41) for _ in range(2)]
+        # Both read as requested, one was accepted before the UPDATE ran
+        queryset = mock.Mock()
+        queryset.select_for_update.return_value.filter.return_value.order_by.return_value \
+            .values_list.return_value = [(ride.id, 'requested', None) for ride in rides]
+        Ride.objects.filter(id=rides[1].id).update(status='accepted', driver=self.driver)
+
+        rows = transition_many(queryset, 'expire', 10)
+        self.assertEqual([row[0] for row in rows], [rides[0].id])
+        self.assertEqual(Ride.objects.get(id=rides[1].id).status, 'accepted')
+        self.assertFalse(RideEvent.objects.filter(ride=rides[1]).exists())
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0, RIDES_REQUEST_TIMEOUT=600, RIDES_ABANDON_TIMEOUT=1800,
+                   RIDES_EXPIRY_CHUNK=2)
+class ExpirySweepTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.drivers = [User.objects.create_user(username=f'driver{i}', password='pw', role='driver') for i in range(2)]
+
+    def ride(self, age_s, status='requested', driver=None):
+        ride = Ride.objects.create(passenger=self.rider, driver=driver, status=status,
+                                   pickup_address='A', dropoff_address='B', pickup_latitude=23.80,
+                                   pickup_longitude=90.41, dropoff_latitude=23.82, dropoff_longitude=90.41)
+        at = timezone.now() - timedelta(seconds=age_s)
+        Ride.objects.filter(id=ride.id).update(created_at=at, updated_at=at)
+        return ride
+
+    def test_sweep_expires_old_requests_in_chunks(self):
+        stale = [self.ride(700) for _ in range(5)]
+        fresh = self.ride(60)
+        RideBid.objects.create(ride=stale[0], driver=self.drivers[0], amount=100)
+
+        stats = expiry_sweeper.sweep()
+        self.assertEqual((stats['expired'], stats['abandoned']), (5, 0))
+        self.assertIn('ms', stats)
+        self.assertEqual(Ride.objects.filter(status='cancelled').count(), 5)
+        self.assertEqual(Ride.objects.get(id=fresh.id).status, 'requested')
+        self.assertEqual(RideBid.objects.get().status, 'rejected')
+        self.assertEqual(RideEvent.objects.filter(event='expire').count(), 5)
+        self.assertEqual(expiry_sweeper.sweep()['expired'], 0)
+
+    def test_sweep_cancels_rides_whose_driver_went_silent(self):
+        silent = self.ride(2000, status='in_progress', driver=self.drivers[0])
+        pinging = self.ride(2000, status='accepted', driver=self.drivers[1])
+        location_store.update(self.drivers[1], 23.80, 90.41)  # writes through, fresh updated_at
+
+        stats = expiry_sweeper.sweep()
+        self.assertEqual(stats['abandoned'], 1)
+        self.assertEqual(Ride.objects.get(id=silent.id).status, 'cancelled')
+        self.assertEqual(Ride.objects.get(id=pinging.id).status, 'accepted')
+        event = RideEvent.objects.get(ride=silent)
+        self.assertEqual((event.event, event.from_status), ('abandon', 'in_progress'))
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0, RIDES_SCHEDULE_LEAD_TIME=900, RIDES_SCHEDULE_HORIZON=3600)
+class ScheduledRideTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        ride_scheduler.reset()
+        ride_pool.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+
+    def book(self, pickup_at):
+        self.client.force_authenticate(self.rider)
+        return self.client.post('/api/rides/', {
+            'pickup_latitude': 23.80, 'pickup_longitude': 90.41, 'pickup_address': 'A',
+            'dropoff_latitude': 23.82, 'dropoff_longitude': 90.41, 'dropoff_address': 'B',
+            'scheduled_for': pickup_at.isoformat(),
+        }, format='json')
+
+    def test_booking_is_released_at_lead_time(self):
+        now = timezone.now()
+        soon = self.book(now + timedelta(minutes=30)).data
+        tomorrow = self.book(now + timedelta(days=1)).data
+        self.assertEqual((soon['status'], tomorrow['status']), ('scheduled', 'scheduled'))
+        self.assertEqual(len(open_rides), 0)
+        self.assertEqual(self.book(now - timedelta(minutes=1)).status_code, 400)
+
+        # Ticks are driven by hand, the scheduler thread is off in tests
+        self.assertEqual(ride_scheduler.tick(now), 0)
+        self.assertEqual(len(ride_scheduler), 1)  # tomorrow's booking isn't loaded yet
+        self.assertEqual(ride_scheduler.tick(now + timedelta(minutes=16)), 1)
+        self.assertEqual(Ride.objects.get(id=soon['id']).status, 'requested')
+        self.assertEqual(len(open_rides), 1)
+        self.assertEqual(ride_pool.candidates((23.80, 90.41), (23.82, 90.41)), {soon['id']})
+
+        # After a restart only the near window is reloaded
+        ride_scheduler.reset()
+        self.assertEqual(ride_scheduler.tick(now + timedelta(hours=23)), 0)
+        self.assertEqual(len(ride_scheduler), 1)
+        self.assertEqual(ride_scheduler.tick(now + timedelta(hours=23, minutes=46)), 1)
+        self.assertEqual(Ride.objects.get(id=tomorrow['id']).status, 'requested')
+
+    def test_booking_inside_lead_time_opens_immediately(self):
+        ride = self.book(timezone.now() + timedelta(minutes=5)).data
+        self.assertEqual(ride['status'], 'requested')
+        self.assertEqual(len(open_rides), 1)
+        # The booking view doesn't start a scheduler with RIDES_SCHEDULE_TICK = 0
+        self.assertNotIn('ride-scheduler', [thread.name for thread in threading.enumerate()])
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0, RIDES_POOL_CORRIDOR_KM=0.5, RIDES_POOL_MAX_DETOUR=0.4,
+                   RIDES_POOL_DISCOUNT=0.3)
+class RidePoolingTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        ride_pool.reset()
+        self.host_rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.rider = User.objects.create_user(username='rider2', password='pw', role='rider')
+        self.driver = User.objects.create_user(username='driver1', password='pw', role='driver')
+
+    def request(self, user, pickup, dropoff, **extra):
+        self.client.force_authenticate(user)
+        return self.client.post('/api/rides/', {
+            'pickup_latitude': pickup[0], 'pickup_longitude': pickup[1], 'pickup_address': 'A',
+            'dropoff_latitude': dropoff[0], 'dropoff_longitude': dropoff[1], 'dropoff_address': 'B', **extra,
+        }, format='json')
+
+    def estimate(self, pickup, dropoff):
+        return self.client.post('/api/rides/estimate/', {
+            'pickup_latitude': pickup[0], 'pickup_longitude': pickup[1],
+            'dropoff_latitude': dropoff[0], 'dropoff_longitude': dropoff[1],
+        }, format='json').data
+
+    def test_corridor_candidates(self):
+        # Host runs ~10 km due north; a trip inside that corridor matches, a crossing one doesn't
+        host = self.request(self.host_rider, (23.70, 90.40), (23.79, 90.40)).data
+        self.assertEqual(ride_pool.candidates((23.72, 90.401), (23.76, 90.399)), {host['id']})
+        self.assertEqual(ride_pool.candidates((23.75, 90.35), (23.75, 90.45)), set())
+
+        self.client.force_authenticate(self.rider)
+        offers = self.estimate((23.72, 90.401), (23.76, 90.399))['pool_offers']
+        self.assertEqual([o['ride_id'] for o in offers], [host['id']])
+        self.assertLess(offers[0]['detour'], 0.4)
+        # Going the other way would double back past the host's dropoff
+        self.assertEqual(self.estimate((23.76, 90.40), (23.72, 90.40))['pool_offers'], [])
+
+    def test_join_accept_and_capacity(self):
+        host = self.request(self.host_rider, (23.70, 90.40), (23.79, 90.40)).data
+        joined = self.request(self.rider, (23.72, 90.401), (23.76, 90.399), pool_with=host['id'])
+        self.assertEqual(joined.status_code, 201)
+        self.assertEqual(joined.data['pooled_with'], host['id'])
+        self.assertLess(float(joined.data['estimated_fare']), float(host['estimated_fare']))
+        self.assertEqual(len(open_rides), 1)  # the rider travels with the host, not on its own
+
+        # The host is full now
+        third = User.objects.create_user(username='rider3', password='pw', role='rider')
+        res = self.request(third, (23.72, 90.40), (23.76, 90.40), pool_with=host['id'])
+        self.assertEqual(res.status_code, 400)
+
+        self.client.force_authenticate(self.driver)
+        self.assertEqual(self.client.patch(f"/api/rides/{joined.data['id']}/accept/").status_code, 400)
+        self.assertEqual(self.client.patch(f"/api/rides/{host['id']}/accept/").status_code, 200)
+        rides = {r.id: r for r in Ride.objects.all()}
+        self.assertEqual((rides[joined.data['id']].status, rides[joined.data['id']].driver_id),
+                         ('accepted', self.driver.id))
+
+    def test_pooled_rides_take_no_bids(self):
+        host = self.request(self.host_rider, (23.70, 90.40), (23.79, 90.40)).data
+        joined = self.request(self.rider, (23.72, 90.401), (23.76, 90.399), pool_with=host['id']).data
+        self.client.force_authenticate(self.driver)
+        res = self.client.post(f"/api/rides/{joined['id']}/bid/", {'amount': '80.00'}, format='json')
+        self.assertEqual(res.status_code, 400)
+
+        # A bid left over from before the ride joined the pool can't be accepted either
+        stale = RideBid.objects.create(ride_id=joined['id'], driver=self.driver, amount=80)
+        self.client.force_authenticate(self.rider)
+        res = self.client.post(f"/api/rides/{joined['id']}/accept_bid/", {'bid_id': stale.id}, format='json')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(Ride.objects.get(id=joined['id']).driver_id, None)
+
+    def test_shared_trip_keeps_both_traces_and_the_driver_busy(self):
+        host = self.request(self.host_rider, (23.70, 90.40), (23.79, 90.40)).data
+        joined = self.request(self.rider, (23.72, 90.401), (23.76, 90.399), pool_with=host['id']).data
+        self.client.force_authenticate(self.driver)
+        self.client.post('/api/rides/drivers/', {'latitude': 23.70, 'longitude': 90.40}, format='json')
+        self.client.patch(f"/api/rides/{host['id']}/accept/")
+        self.client.post(f"/api/rides/{host['id']}/start_ride/")
+        self.client.post('/api/rides/drivers/', {'latitude': 23.72, 'longitude': 90.401}, format='json')
+        self.client.post(f"/api/rides/{joined['id']}/start_ride/")
+        self.client.post('/api/rides/drivers/', {'latitude': 23.76, 'longitude': 90.399}, format='json')
+
+        # Dropping the rider off leaves the host on board
+        self.assertEqual(self.client.post(f"/api/rides/{joined['id']}/complete_ride/").status_code, 200)
+        self.assertEqual(location_store.get(self.driver.id)['status'], 'busy')
+        self.client.post('/api/rides/drivers/', {'latitude': 23.79, 'longitude': 90.40}, format='json')
+        traces = {r.id: r.trace.point_count for r in Ride.objects.select_related('trace')}
+        self.assertEqual((traces[host['id']], traces[joined['id']]), (3, 1))
+
+        self.client.post(f"/api/rides/{host['id']}/complete_ride/")
+        self.assertEqual(location_store.get(self.driver.id)['status'], 'online')
+
+
+class BatchEstimateTests(APITestCase):
+    def setUp(self):
+        surge_meter.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.client.force_authenticate(self.rider)
+
+    def test_matches_calculate_fare_in_input_order(self):
+        trips = [
+            {'pickup_latitude': 23.70, 'pickup_longitude': 90.40, 'dropoff_latitude': 23.79, 'dropoff_longitude': 90.40},
+            {'pickup_latitude': 23.75, 'pickup_longitude': 90.35, 'dropoff_latitude': 23.75, 'dropoff_longitude': 90.36},
+            {'pickup_latitude': 23.80, 'pickup_longitude': 90.41, 'dropoff_latitude': 23.80, 'dropoff_longitude': 90.41},
+        ]
+        res = self.client.post('/api/rides/estimate/batch/', {'trips': trips, 'vehicle_types': ['bike', 'car']},
+                               format='json')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['vehicle_types'], ['bike', 'car'])
+        self.assertEqual(len(res.data['results']), 3)
+        for trip, result in zip(trips, res.data['results']):
+            self.assertEqual(list(result['fares']), ['bike', 'car'])
+            for vehicle_type in ('bike', 'car'):
+                single = calculate_fare(*trip.values(), vehicle_type)
+                self.assertAlmostEqual(result['fares'][vehicle_type], float(single['estimated_fare']), places=2)
+            self.assertEqual(result['duration_minutes'], single['duration_minutes'])
+            self.assertAlmostEqual(result['distance_km'], single['distance_km'], places=2)
+            self.assertEqual(result['traffic_factor'], single['traffic_factor'])
+        self.assertLess(res.data['results'][1]['fares']['bike'], res.data['results'][1]['fares']['car'])
+
+    def test_defaults_and_validation(self):
+        trip = {'pickup_latitude': 23.70, 'pickup_longitude': 90.40, 'dropoff_latitude': 23.79, 'dropoff_longitude': 90.40}
+        res = self.client.post('/api/rides/estimate/batch/', {'trips': [trip]}, format='json')
+        self.assertEqual(set(res.data['results'][0]['fares']), {'car', 'bike', 'rickshaw'})
+        self.assertEqual(self.client.post('/api/rides/estimate/batch/', {'trips': []}, format='json').data['results'], [])
+
+        for body in ({'trips': [trip], 'vehicle_types': ['boat']}, {'trips': [dict(trip, pickup_latitude='x')]},
+                     {'trips': [{'pickup_latitude': 23.7}]}, {'trips': 'nope'}, {'trips': [trip], 'vehicle_types': [['car']]}):
+            self.assertEqual(self.client.post('/api/rides/estimate/batch/', body, format='json').status_code, 400)
+        for latitude in ('inf', '1e400', 'nan', 95):
+            res = self.client.post('/api/rides/estimate/', dict(trip, pickup_latitude=latitude), format='json')
+            self.assertEqual(res.status_code, 400)
+        for bad in ({'pickup_latitude': 95}, {'dropoff_latitude': -90.5}, {'pickup_longitude': 181},
+                    {'dropoff_longitude': -200}, {'dropoff_longitude': 'nan'}, {'pickup_latitude': '1e400'}):
+            res = self.client.post('/api/rides/estimate/batch/', {'trips': [trip, dict(trip, **bad)]}, format='json')
+            self.assertEqual(res.status_code, 400)
+
+
+class QuoteCacheTests(APITestCase):
+    def setUp(self):
+        quote_cache.reset()
+        surge_meter.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.client.force_authenticate(self.rider)
+
+    def test_nearby_coordinates_share_a_quote(self):
+        now = timezone.now().replace(minute=0)
+        first = quote_cache.quote(23.7801, 90.4101, 23.7937, 90.4066, now=now)
+        # ~20 m away, same grid cells
+        second = quote_cache.quote(23.78012, 90.41018, 23.79365, 90.40655, now=now)
+        self.assertEqual(first, second)
+        quote_cache.quote(23.7801, 90.4101, 23.7937, 90.4066, 'bike', now=now)
+        self.assertEqual(quote_cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'expirations': 0, 'size': 2})
+
+        # The next traffic bucket is quoted afresh
+        quote_cache.quote(23.7801, 90.4101, 23.7937, 90.4066, now=now + timedelta(hours=1))
+        self.assertEqual(quote_cache.stats()['misses'], 3)
+
+    def test_lru_eviction_and_expiry(self):
+        now = timezone.now().replace(minute=0)
+        with override_settings(RIDES_QUOTE_CACHE_SIZE=2):
+            quote_cache.quote(23.70, 90.40, 23.75, 90.40, now=now)
+            quote_cache.quote(23.71, 90.40, 23.75, 90.40, now=now)
+            quote_cache.quote(23.70, 90.40, 23.75, 90.40, now=now)  # refreshes the first route
+            quote_cache.quote(23.72, 90.40, 23.75, 90.40, now=now)  # evicts the second
+            quote_cache.quote(23.70, 90.40, 23.75, 90.40, now=now)
+            self.assertEqual(quote_cache.stats(), {'hits': 2, 'misses': 3, 'evictions': 1, 'expirations': 0, 'size': 2})
+
+        quote_cache.backend.set('stale', {}, 0)
+        self.assertIsNone(quote_cache.backend.get('stale'))
+        self.assertEqual(quote_cache.stats()['expirations'], 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'quotes'}})
+    def test_django_cache_backend(self):
+        cache = QuoteCache(backend=DjangoCacheBackend())
+        first = cache.quote(23.70, 90.40, 23.75, 90.40)
+        # Another process on the same cache
+        other = QuoteCache(backend=DjangoCacheBackend())
+        self.assertEqual(other.quote(23.70, 90.40, 23.75, 90.40), first)
+        self.assertEqual((cache.misses, other.hits), (1, 1))
+
+    def test_estimate_uses_the_cache(self):
+        body = {'pickup_latitude': 23.70, 'pickup_longitude': 90.40, 'dropoff_latitude': 23.75, 'dropoff_longitude': 90.40}
+        fares = {self.client.post('/api/rides/estimate/', body, format='json').data['estimated_fare'] for _ in range(5)}
+        self.assertEqual(len(fares), 1)
+        self.assertEqual((quote_cache.hits, quote_cache.misses), (4, 1))
+
+        self.assertEqual(self.client.get('/api/rides/estimate/cache/').status_code, 403)
+        staff = User.objects.create_user(username='ops', password='pw', role='rider', is_staff=True)
+        self.client.force_authenticate(staff)
+        self.assertEqual(self.client.get('/api/rides/estimate/cache/').data['hits'], 4)
+
+
+class QuoteTokenTests(APITestCase):
+    def setUp(self):
+        quote_cache.reset()
+        open_rides.reset()
+        surge_meter.reset()
+        ride_pool.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.client.force_authenticate(self.rider)
+        self.route = {'pickup_latitude': 23.70, 'pickup_longitude': 90.40,
+                      'dropoff_latitude': 23.75, 'dropoff_longitude': 90.40}
+
+    def request_ride(self, **extra):
+        return self.client.post('/api/rides/', {**self.route, 'pickup_address': 'A', 'dropoff_address': 'B', **extra},
+                                format='json')
+
+    def forged_quote(self, user, fare='1.00'):
+        quote = {'estimated_fare': fare, 'distance_km': 5.56, 'duration_minutes': 16, 'traffic_factor': 1.0,
+                 'surge_multiplier': 1.0}
+        return sign_quote(quote, user, tuple(self.route.values()))[0]
+
+    def test_ride_is_booked_at_the_quoted_fare(self):
+        estimate = self.client.post('/api/rides/estimate/', self.route, format='json').data
+        self.assertIn('quote_expires_at', estimate)
+        quote_cache.reset()  # the booking must not need the cache
+        with mock.patch('rides.quotes.calculate_fare') as calculate_fare:
+            ride = self.request_ride(quote_token=estimate['quote_token']).data
+            calculate_fare.assert_not_called()
+        self.assertEqual(ride['estimated_fare'], str(estimate['estimated_fare']))
+        self.assertEqual(ride['duration_minutes'], estimate['duration_minutes'])
+
+        # A token is only good for the passenger, route and vehicle it was quoted for
+        other = User.objects.create_user(username='rider2', password='pw', role='rider')
+        self.assertEqual(self.request_ride(quote_token=self.forged_quote(other)).status_code, 400)
+        res = self.request_ride(quote_token=self.forged_quote(self.rider), dropoff_latitude=23.80)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.request_ride(quote_token=estimate['quote_token'], vehicle_type='bike').status_code, 400)
+
+    def test_other_vehicles_book_their_own_quote(self):
+        estimate = self.client.post('/api/rides/estimate/', {**self.route, 'vehicle_type': 'bike'}, format='json').data
+        ride = self.request_ride(quote_token=estimate['quote_token'], vehicle_type='bike').data
+        self.assertEqual(ride['estimated_fare'], str(estimate['estimated_fare']))
+        self.assertEqual(ride['vehicle_type'], 'bike')
+        # Untokened bookings are priced for their vehicle too
+        car = self.request_ride().data['estimated_fare']
+        self.assertEqual(self.request_ride(vehicle_type='bike').data['estimated_fare'], ride['estimated_fare'])
+        self.assertNotEqual(car, ride['estimated_fare'])
+
+    def test_invalid_or_expired_tokens_are_refused(self):
+        token = self.forged_quote(self.rider)
+        for bad in ('garbage', token[:-2] + 'xx'):
+            self.assertEqual(self.request_ride(quote_token=bad).status_code, 400)
+        with override_settings(RIDES_QUOTE_TOKEN_TTL=-1):
+            self.assertEqual(self.request_ride(quote_token=token).status_code, 400)
+        self.assertEqual(self.request_ride(quote_token=token).data['estimated_fare'], '1.00')
+        self.assertEqual(Ride.objects.count(), 1)
+
+
+@override_settings(RIDES_LOCATION_FLUSH_INTERVAL=0)
+class SurgeTests(APITestCase):
+    def setUp(self):
+        location_store.reset()
+        open_rides.reset()
+        ride_pool.reset()
+        quote_cache.reset()
+        surge_meter.reset()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+        self.client.force_authenticate(self.rider)
+        self.route = {'pickup_latitude': 23.805, 'pickup_longitude': 90.415,
+                      'dropoff_latitude': 23.85, 'dropoff_longitude': 90.415}
+
+    def request_rides(self, count, lat=23.805, lon=90.415):
+        for _ in range(count):
+            open_rides.add(Ride.objects.create(
+                passenger=self.rider, pickup_address='A', dropoff_address='B', pickup_latitude=lat,
+                pickup_longitude=lon, dropoff_latitude=lat + 0.02, dropoff_longitude=lon, estimated_fare=100,
+            ))
+
+    def go_online(self, count, lat=23.805, lon=90.415):
+        for _ in range(count):
+            driver = User.objects.create_user(username=f'driver{User.objects.count()}', password='pw', role='driver')
+            location_store.update(driver, lat, lon)
+
+    def test_multiplier_follows_demand_over_supply(self):
+        self.go_online(2)
+        self.request_rides(2)
+        surge_meter.sample()
+        self.assertEqual(surge_meter.multiplier(23.805, 90.415), 1.0)  # too few requests to surge
+
+        self.request_rides(6)  # 8 requests for 2 drivers
+        surge_meter.reset()
+        surge_meter.sample()
+        self.assertEqual(surge_meter.multiplier(23.805, 90.415), 2.5)
+        self.assertEqual(surge_meter.multiplier(23.812, 90.409), 2.5)  # neighbouring cell
+        self.assertEqual(surge_meter.multiplier(23.90, 90.415), 1.0)
+
+        self.go_online(4, lat=23.815)  # 8 requests for 6 drivers around the cell
+        surge_meter.reset()
+        surge_meter.sample()
+        self.assertEqual(surge_meter.multiplier(23.805, 90.415), 1.2)
+
+    def test_window_averages_and_slides(self):
+        now = time.monotonic()
+        self.request_rides(8)
+        surge_meter.sample(now)
+        self.assertEqual(surge_meter.multiplier(23.805, 90.415), 2.5)
+        for ride_id in list(Ride.objects.values_list('id', flat=True)):
+            open_rides.remove(ride_id)
+        surge_meter.sample(now + 10)  # averages 4 requests, 0 drivers
+        self.assertEqual(surge_meter.multiplier(23.805, 90.415), 2.5)
+        with override_settings(RIDES_SURGE_WINDOW=20):
+            surge_meter.sample(now + 25)  # the first snapshot leaves the window
+        self.assertEqual(surge_meter.multiplier(23.805, 90.415), 1.0)
+        self.assertEqual(surge_meter.heatmap(), [])
+
+    def test_estimate_and_booking_carry_the_surge(self):
+        base = self.client.post('/api/rides/estimate/', self.route, format='json').data
+        self.assertEqual(base['surge_multiplier'], 1.0)
+        self.go_online(2)
+        self.request_rides(6)  # 6 requests for 2 drivers: 1 + 0.5 * (3 - 1)
+        surge_meter.reset()
+
+        estimate = self.client.post('/api/rides/estimate/', self.route, format='json').data
+        self.assertEqual(estimate['surge_multiplier'], 2.0)
+        self.assertEqual(estimate['estimated_fare'], base['estimated_fare'] * 2)
+        self.assertEqual(quote_cache.misses, 1)  # surge isn't part of the cached quote
+
+        batch = self.client.post('/api/rides/estimate/batch/', {'trips': [self.route], 'vehicle_types': ['car']},
+                                 format='json').data['results'][0]
+        self.assertEqual(batch['surge_multiplier'], 2.0)
+        self.assertAlmostEqual(batch['fares']['car'], float(estimate['estimated_fare']), places=2)
+
+        ride = self.client.post('/api/rides/', {**self.route, 'pickup_address': 'A', 'dropoff_address': 'B',
+                                                'quote_token': estimate['quote_token']}, format='json').data
+        self.assertEqual(ride['estimated_fare'], str(estimate['estimated_fare']))
+        self.assertEqual(Ride.objects.get(id=ride['id']).surge_multiplier, 2.0)
+
+    def test_heatmap_endpoint(self):
+        self.go_online(1, lat=23.705)
+        self.request_rides(3)
+        res = self.client.get('/api/rides/surge/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((res.data['cell_degrees'], res.data['window_s']), (0.01, 300))
+        cells = {(cell['latitude'], cell['longitude']): cell for cell in res.data['cells']}
+        self.assertEqual(cells[(23.805, 90.415)]['demand'], 3)
+        self.assertEqual(cells[(23.805, 90.415)]['surge_multiplier'], 2.0)
+        self.assertEqual(cells[(23.705, 90.415)]['supply'], 1)
+
+        res = self.client.get('/api/rides/surge/', {'south': 23.75, 'west': 90.3, 'north': 23.9, 'east': 90.5})
+        self.assertEqual([cell['latitude'] for cell in res.data['cells']], [23.805])
+        self.assertEqual(self.client.get('/api/rides/surge/', {'south': 23.75}).status_code, 400)
+
+
+class TrafficModelTests(APITestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'traffic.npz')
+        self.settings = override_settings(RIDES_TRAFFIC_MODEL_PATH=self.path)
+        self.settings.enable()
+        traffic_model.reload()
+        self.rider = User.objects.create_user(username='rider1', password='pw', role='rider')
+
+    def tearDown(self):
+        self.settings.disable()
+        traffic_model.reload()
+        self.dir.cleanup()
+
+    def at(self, weekday, hour):
+        # A city time on the given weekday() of a fixed week
+        monday = datetime(2026, 3, 2, tzinfo=traffic_time_zone())
+        return monday + timedelta(days=weekday, hours=hour)
+
+    def test_default_profile_is_deterministic(self):
+        route = (23.70, 90.40, 23.75, 90.40)
+        rush = calculate_fare(*route, when=self.at(6, 8))  # Sunday morning
+        self.assertEqual(rush, calculate_fare(*route, when=self.at(6, 8) + timedelta(minutes=40)))
+        self.assertEqual((rush['traffic_factor'], rush['traffic_status']), (1.5, 'Heavy'))
+        weekend = calculate_fare(*route, when=self.at(4, 8))  # Friday morning
+        self.assertEqual((weekend['traffic_factor'], weekend['traffic_status']), (1.0, 'Normal'))
+
+    @override_settings(RIDES_TRAFFIC_TIME_ZONE='Asia/Dhaka')
+    def test_rush_hour_is_counted_in_city_time(self):
+        # Monday 08:30 in Dhaka is 02:30 UTC, the server's TIME_ZONE
+        route = (23.70, 90.40, 23.75, 90.40)
+        morning = datetime(2026, 3, 2, 2, 30, tzinfo=dt_timezone.utc)
+        self.assertEqual(traffic_bucket(morning), (8, 1800))
+        self.assertEqual(calculate_fare(*route, when=morning)['traffic_factor'], 1.5)
+        self.assertEqual(calculate_fare(*route, when=morning + timedelta(hours=6))['traffic_factor'], 1.0)
+
+    def test_build_from_completed_rides(self):
+        started = self.at(0, 9)
+        # 5.56 km in 33 minutes is twice the free-flow time
+        for _ in range(10):
+            Ride.objects.create(passenger=self.rider, status='completed', duration_minutes=33,
+                                pickup_latitude=23.70, pickup_longitude=90.40, pickup_address='A',
+                                dropoff_latitude=23.75, dropoff_longitude=90.40, dropoff_address='B')
+        Ride.objects.update(updated_at=started + timedelta(minutes=33))
+        self.assertEqual(build_traffic_model(self.path, now=started + timedelta(days=1)), 10)
+
+        traffic_model.reload()
+        bucket = started.weekday() * 24 + started.hour
+        self.assertAlmostEqual(traffic_model.factor(23.70, 90.40, bucket), 2.0, places=1)
+        # Unmeasured cells follow the city at that hour, unmeasured hours the default profile
+        self.assertAlmostEqual(traffic_model.factor(23.85, 90.45, bucket), 2.0, places=1)
+        self.assertEqual(traffic_model.factor(23.70, 90.40, bucket + 4), 1.0)
+        self.assertAlmostEqual(calculate_fare(23.70, 90.40, 23.75, 90.40, when=started)['traffic_factor'], 2.0, places=1)
+
+
+def grid_osm(ways):
+    # A 3 x 3 grid of nodes 0.01 degrees apart, node (r, c) has id r * 3 + c + 1, plus a far-off road
+    nodes = ''.join(f'<node id="{r * 3 + c + 1}" lat="{23.70 + r * 0.01}" lon="{90.40 + c * 0.01}"/>'
+                    for r in range(3) for c in range(3))
+    nodes += '<node id="100" lat="23.90" lon="90.60"/><node id="101" lat="23.90" lon="90.61"/>'
+    ways = list(ways) + [([(100,), (101,)], {})]
+    body = ''
+    for i, (cells, tags) in enumerate(ways):
+        refs = ''.join(f'<nd ref="{cell[0] if len(cell) == 1 else cell[0] * 3 + cell[1] + 1}"/>' for cell in cells)
+        body += f'<way id="{i + 1}">{refs}<tag k="highway" v="residential"/>' + \
+            ''.join(f'<tag k="{k}" v="{v}"/>' for k, v in tags.items()) + '</way>'
+    return f'<?xml version="1.0"?><osm version="0.6">{nodes}{body}</osm>'
+
+
+class RoutingTests(APITestCase):
+    def setUp(self):
+        # Roads round the edge of the grid, the west side one-way northwards
+        self.dir = tempfile.TemporaryDirectory()
+        osm_path = os.path.join(self.dir.name, 'grid.osm')
+        with open(osm_path, 'w') as f:
+            f.write(grid_osm([
+                ([(0, 0), (0, 1), (0, 2)], {}),
+                ([(0, 2), (1, 2), (2, 2)], {}),
+                ([(2, 0), (2, 1), (2, 2)], {}),
+                ([(0, 0), (1, 0), (2, 0)], {'oneway': 'yes'}),
+            ]))
+        path = os.path.join(self.dir.name, 'graph.npz')
+        self.assertEqual(build_road_graph(osm_path, path), (8, 14))  # the far-off road is dropped
+        self.settings = override_settings(RIDES_ROAD_GRAPH_PATH=path)
+        self.settings.enable()
+        road_graph.reload()
+
+    def tearDown(self):
+        self.settings.disable()
+        road_graph.reload()
+        self.dir.cleanup()
+
+    def point(self, r, c):
+        return 23.70 + r * 0.01, 90.40 + c * 0.01
+
+    def test_routes_follow_roads_and_one_ways(self):
+        km, _ = road_graph.route(*self.point(0, 0), *self.point(2, 2))
+        self.assertAlmostEqual(km, 2 * 1.11 + 2 * 1.02, delta=0.05)
+        north, _ = road_graph.route(*self.point(0, 0), *self.point(2, 0))
+        south, _ = road_graph.route(*self.point(2, 0), *self.point(0, 0))
+        self.assertAlmostEqual(north, 2 * 1.11, delta=0.05)
+        self.assertAlmostEqual(south, 2 * 1.11 + 4 * 1.02, delta=0.05)  # the long way round
+        self.assertIsNone(road_graph.route(23.90, 90.60, *self.point(0, 0)))
+
+    def test_duplicate_nodes_without_landmarks(self):
+        # OSM ways can repeat a position, giving zero-length, zero-time edges
+        osm_path = os.path.join(self.dir.name, 'dup.osm')
+        with open(osm_path, 'w') as f:
+            f.write(grid_osm([
+                ([(0, 0), (102,), (0, 1), (0, 2)], {}),
+                ([(0, 2), (1, 2), (2, 2)], {}),
+                ([(2, 0), (2, 1), (2, 2)], {}),
+                ([(0, 0), (1, 0), (2, 0)], {'oneway': 'yes'}),
+            ]).replace('<node id="100"', '<node id="102" lat="23.7" lon="90.4"/><node id="100"'))
+        path = os.path.join(self.dir.name, 'dup.npz')
+        build_road_graph(osm_path, path, landmarks=0)
+        with override_settings(RIDES_ROAD_GRAPH_PATH=path):
+            road_graph.reload()
+            for (r1, c1), (r2, c2) in (((0, 0), (2, 2)), ((2, 0), (0, 0)), ((0, 1), (2, 0))):
+                _, minutes = road_graph.matrix([self.point(r1, c1)], [self.point(r2, c2)], weight='time')
+                self.assertAlmostEqual(road_graph.route(*self.point(r1, c1), *self.point(r2, c2))[1], minutes[0, 0],
+                                       places=4)
+            # The straight-line A* bound stays a number
+            self.assertGreater(road_graph._max_speed, 0)
+
+    def test_fares_use_road_distance_with_fallback(self):
+        routed = calculate_fare(*self.point(0, 0), *self.point(2, 2))
+        self.assertAlmostEqual(routed['distance_km'], 4.26, delta=0.05)
+        off_network = calculate_fare(23.90, 90.60, 23.92, 90.62)
+        self.assertAlmostEqual(off_network['distance_km'], 3.01, delta=0.01)  # straight line
+
+        # Batches route per trip too, off-network trips fall back on their own
+        fares = calculate_fares(*zip((*self.point(0, 0), *self.point(2, 2)), (23.90, 90.60, 23.92, 90.62)))
+        self.assertEqual(fares['distance_km'].tolist(), [routed['distance_km'], off_network['distance_km']])
+        self.assertEqual(fares['estimated_fare'][:, 0].tolist(),
+                         [float(routed['estimated_fare']), float(off_network['estimated_fare'])])
+
+    def test_matrix_and_dispatch(self):
+        km, minutes = road_graph.matrix([self.point(0, 0), (23.90, 90.60)], [self.point(2, 2), self.point(2, 0)])
+        self.assertAlmostEqual(km[0, 0], 4.26, delta=0.05)
+        self.assertAlmostEqual(km[0, 1], 2.22, delta=0.05)
+        self.assertTrue(np.isnan(km[1]).all())
+        self.assertTrue((minutes[0] > 0).all())
+        km, _ = road_graph.matrix([self.point(0, 0)], [self.point(2, 2), self.point(2, 0)], max_km=3)
+        self.assertEqual(km[0, 0], np.inf)
+
+        # Driver 1 is closer as the crow flies, but the one-way street sends it round the block
+        pairs = match([(1, *self.point(0, 0))], [(1, *self.point(1, 0)), (2, *self.point(0, 2))], max_km=5)
+        self.assertEqual([(ride, driver) for ride, driver, _ in pairs], [(1, 2)])
+        pairs = match([(1, *self.point(0, 0))], [(1, *self.point(1, 0)), (2, *self.point(0, 2))], max_km=5,
+                      road_max_cells=0)
+        self.assertEqual([(ride, driver) for ride, driver, _ in pairs], [(1, 1)])
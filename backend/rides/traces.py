@@ -0,0 +1,148 @@
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+
+from .models import RideTrace
+from .polyline import PRECISION, encode_points, simplify
+from .services import haversine_distance
+
+TRACE_FIELDS = ['encoded', 'point_count', 'last_lat_e5', 'last_lon_e5', 'last_t', 'distance_km']
+
+
+class TripOdometer:
+    """
+    Running distance of a trip, fed one fix at a time.
+
+    Steps shorter than RIDES_ODOMETER_MIN_STEP_M are GPS jitter and don't
+    move the anchor, so slow real movement still adds up. Steps faster than
+    RIDES_ODOMETER_MAX_SPEED_KMH are glitches and are dropped.
+    """
+
+    def __init__(self, started_at, distance_km=0.0, anchor=None):
+        self.started_at = started_at
+        self.distance_km = distance_km
+        self.anchor = anchor  # (lat, lon, recorded_at) of the last counted fix
+
+    def add(self, lat, lon, recorded_at):
+        if self.anchor is None:
+            self.anchor = (lat, lon, recorded_at)
+            return
+        anchor_lat, anchor_lon, anchor_at = self.anchor
+        step_km = haversine_distance(anchor_lat, anchor_lon, lat, lon)
+        if step_km * 1000 < getattr(settings, 'RIDES_ODOMETER_MIN_STEP_M', 10):
+            return
+        hours = (recorded_at - anchor_at).total_seconds() / 3600
+        if hours <= 0 or step_km / hours > getattr(settings, 'RIDES_ODOMETER_MAX_SPEED_KMH', 80):
+            return
+        self.distance_km += step_km
+        self.anchor = (lat, lon, recorded_at)
+
+
+class TraceBuffer:
+    """
+    In-trip fixes waiting to be appended to their RideTrace, plus each
+    trip's odometer.
+
+    Flushed together with the location store, so a ride's trace and running
+    distance cost one bulk_update per flush window instead of a write per ping.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held across every RideTrace read-modify-write, so a flush in flight
+        # can't write a raw trace back over a simplified one
+        self._write_lock = threading.Lock()
+        self._pending = {}  # ride_id -> [(lat, lon, recorded_at)]
+        self._odometers = {}  # ride_id -> TripOdometer
+
+    def start(self, ride_id, started_at):
+        with self._lock:
+            self._odometers[ride_id] = TripOdometer(started_at)
+
+    def restore(self, ride_ids):
+        # Rebuilds odometers of in-progress rides from their traces after a restart
+        traces = RideTrace.objects.filter(ride_id__in=ride_ids)
+        with self._lock:
+            for trace in traces:
+                anchor = None
+                if trace.point_count:
+                    anchor = (trace.last_lat_e5 / PRECISION, trace.last_lon_e5 / PRECISION,
+                              trace.started_at + timedelta(seconds=trace.last_t))
+                self._odometers[trace.ride_id] = TripOdometer(trace.started_at, trace.distance_km, anchor)
+
+    def append(self, ride_id, lat, lon, recorded_at):
+        with self._lock:
+            self._pending.setdefault(ride_id, []).append((lat, lon, recorded_at))
+            odometer = self._odometers.get(ride_id)
+            if odometer is not None:
+                odometer.add(lat, lon, recorded_at)
+
+    def finish(self, ride_id):
+        # Writes the ride's remaining fixes, returns its odometer
+        self.flush([ride_id])
+        with self._lock:
+            return self._odometers.pop(ride_id, None)
+
+    def discard(self, ride_id):
+        with self._lock:
+            self._pending.pop(ride_id, None)
+
+    def flush(self, ride_ids=None):
+        # Appends pending fixes to their traces, returns how many points were written
+        with self._lock:
+            if ride_ids is None:
+                pending, self._pending = self._pending, {}
+            else:
+                pending = {ride_id: self._pending.pop(ride_id) for ride_id in ride_ids if ride_id in self._pending}
+        if not pending:
+            return 0
+        with self._write_lock:
+            return self._write(pending)
+
+    def _write(self, pending):
+        # Finished traces are left alone, late fixes for them are dropped
+        traces = list(RideTrace.objects.filter(ride_id__in=pending, simplified=False)
+                      .only('id', 'ride_id', 'started_at', *TRACE_FIELDS))
+        written = 0
+        for trace in traces:
+            points = []
+            for lat, lon, recorded_at in sorted(pending[trace.ride_id], key=lambda p: p[2]):
+                t = (recorded_at - trace.started_at).total_seconds()
+                if trace.point_count and t < trace.last_t:
+                    continue  # older than what the trace already has
+                points.append((lat, lon, max(t, 0)))
+            chunk, (trace.last_lat_e5, trace.last_lon_e5, trace.last_t) = encode_points(
+                points, (trace.last_lat_e5, trace.last_lon_e5, trace.last_t)
+            )
+            trace.encoded += chunk
+            trace.point_count += len(points)
+            odometer = self._odometers.get(trace.ride_id)
+            if odometer is not None:
+                trace.distance_km = odometer.distance_km
+            written += len(points)
+        RideTrace.objects.bulk_update(traces, TRACE_FIELDS)
+        return written
+
+
+def finalize_trace(ride_id):
+    # Douglas-Peucker downsampling once the ride is over
+    with trace_buffer._write_lock:
+        return _simplify_trace(ride_id)
+
+
+def _simplify_trace(ride_id):
+    trace = RideTrace.objects.filter(ride_id=ride_id).first()
+    if trace is None or trace.simplified:
+        return trace
+    tolerance = getattr(settings, 'RIDES_TRACE_SIMPLIFY_TOLERANCE_M', 5.0)
+    points = simplify(list(trace.points()), tolerance)
+    trace.encoded, (trace.last_lat_e5, trace.last_lon_e5, trace.last_t) = encode_points(points)
+    trace.point_count = len(points)
+    trace.simplified = True
+    # distance_km keeps the odometer reading from the raw fixes
+    trace.save(update_fields=TRACE_FIELDS + ['simplified'])
+    return trace
+
+
+trace_buffer = TraceBuffer()
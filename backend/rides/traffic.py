@@ -0,0 +1,185 @@
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+HOURS_PER_WEEK = 7 * 24
+BASE_SPEED_KMH = 20  # free-flow city speed off the road graph, traffic factor 1.0
+HEAVY_TRAFFIC_THRESHOLD = 1.3
+# Factors are stored as uint8 codes, factor = FACTOR_MIN + code * FACTOR_STEP
+FACTOR_MIN = 0.5
+FACTOR_STEP = 0.01
+FACTOR_MAX = FACTOR_MIN + 255 * FACTOR_STEP
+
+_current_bucket = (None, 0.0)  # (bucket, epoch seconds it ends at), saves localtime() per quote
+
+
+def traffic_time_zone():
+    # Rush hours are the city's, not the server's TIME_ZONE
+    return ZoneInfo(getattr(settings, 'RIDES_TRAFFIC_TIME_ZONE', settings.TIME_ZONE))
+
+
+def traffic_bucket(when=None):
+    # Traffic period a time falls in (hour of the week, city time) and seconds until it ends
+    global _current_bucket
+    if when is None:
+        now = time.time()
+        bucket, ends_at = _current_bucket
+        if now < ends_at:
+            return bucket, ends_at - now
+        bucket, ttl = traffic_bucket(timezone.now())
+        _current_bucket = (bucket, now + ttl)
+        return bucket, ttl
+    when = timezone.localtime(when, traffic_time_zone())
+    elapsed = when.minute * 60 + when.second + when.microsecond / 1e6
+    return when.weekday() * 24 + when.hour, 3600 - elapsed
+
+
+def traffic_status(factor):
+    return "Heavy" if factor >= HEAVY_TRAFFIC_THRESHOLD else "Normal"
+
+
+def default_profile():
+    # City-wide factor per hour of the week before any rides are measured:
+    # Sunday-Thursday rush hours are heavy, the Friday-Saturday weekend isn't
+    profile = np.ones(HOURS_PER_WEEK, dtype=np.float32)
+    for day in (6, 0, 1, 2, 3):  # weekday() numbering, Sunday is 6
+        for hour in (8, 9, 17, 18, 19):
+            profile[day * 24 + hour] = 1.5
+    return profile
+
+
+def encode_factors(factors):
+    return np.clip(np.rint((factors - FACTOR_MIN) / FACTOR_STEP), 0, 255).astype(np.uint8)
+
+
+class TrafficModel:
+    """
+    Traffic factor per zone cell and hour of the week, as one
+    (168, rows, cols) array.
+
+    Loaded once from RIDES_TRAFFIC_MODEL_PATH, written offline by the
+    `build_traffic_model` command. The file carries its own grid, and
+    lookups outside it use the nearest edge cell. Without a file every
+    cell gets default_profile(). A lookup is a few arithmetic ops and one
+    array index.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._table = None
+
+    @property
+    def path(self):
+        return getattr(settings, 'RIDES_TRAFFIC_MODEL_PATH', None)
+
+    def _ensure_loaded(self):
+        if self._table is not None:
+            return
+        with self._lock:
+            if self._table is not None:
+                return
+            path = self.path
+            if path and os.path.exists(path):
+                with np.load(path) as data:
+                    codes = data['factors']
+                    self._lat0, self._lon0 = (float(v) for v in data['origin'])
+                    self._cell = float(data['cell'])
+                table = (FACTOR_MIN + codes.astype(np.float32) * FACTOR_STEP).astype(np.float32)
+            else:
+                self._lat0, self._lon0, self._cell = 0.0, 0.0, 180.0
+                table = default_profile()[:, None, None]
+            self._rows, self._cols = table.shape[1] - 1, table.shape[2] - 1
+            # Everything factor() needs in one tuple, indexing the flat memoryview
+            # is cheaper than a numpy scalar read
+            self._lookup = (self._lat0, self._lon0, 1 / self._cell, self._rows, self._cols,
+                            table.shape[1] * table.shape[2], table.shape[2], memoryview(table.reshape(-1)))
+            self._table = table
+
+    def factor(self, lat, lon, bucket):
+        if self._table is None:
+            self._ensure_loaded()
+        lat0, lon0, per_degree, rows, cols, bucket_stride, row_stride, flat = self._lookup
+        row = int((lat - lat0) * per_degree)
+        row = 0 if row < 0 else rows if row > rows else row
+        col = int((lon - lon0) * per_degree)
+        col = 0 if col < 0 else cols if col > cols else col
+        return flat[bucket * bucket_stride + row * row_stride + col]
+
+    def factors(self, lat, lon, bucket):
+        # Vectorized factor() over arrays of coordinates, bucket may be a scalar or an array
+        self._ensure_loaded()
+        rows = np.clip(((np.asarray(lat) - self._lat0) / self._cell).astype(int), 0, self._rows)
+        cols = np.clip(((np.asarray(lon) - self._lon0) / self._cell).astype(int), 0, self._cols)
+        return self._table[bucket, rows, cols].astype(float)
+
+    def reload(self):
+        with self._lock:
+            self._table = None
+
+
+traffic_model = TrafficModel()
+
+
+def build_traffic_model(path, days=56, min_samples=5, now=None):
+    """
+    Fits the traffic table from completed rides of the last `days` days and
+    writes it to `path`. A ride's factor is its measured duration over its
+    free-flow duration (services.trip_distances), credited to its
+    pickup and dropoff cells in the hour it started. Each cell is smoothed
+    towards the city-wide factor of that hour with `min_samples` pseudo
+    rides, hours with fewer rides than that city-wide fall back to
+    default_profile(). Returns the number of rides used.
+    """
+    from .models import Ride
+    from .services import trip_distances
+
+    lat0, lon0, lat1, lon1 = getattr(settings, 'RIDES_TRAFFIC_BOUNDS', (23.60, 90.20, 24.00, 90.60))
+    cell = getattr(settings, 'RIDES_TRAFFIC_ZONE_DEGREES', 0.01)
+    rows, cols = int(np.ceil((lat1 - lat0) / cell)), int(np.ceil((lon1 - lon0) / cell))
+
+    since = (now or timezone.now()) - timedelta(days=days)
+    rides = list(Ride.objects.filter(status='completed', updated_at__gte=since, duration_minutes__gt=0).values_list(
+        'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude', 'duration_minutes',
+        'updated_at',
+    ).iterator())
+
+    sums = np.zeros((HOURS_PER_WEEK, rows, cols))
+    counts = np.zeros((HOURS_PER_WEEK, rows, cols))
+    if rides:
+        plat, plon, dlat, dlon, minutes = (np.array(column, dtype=float) for column in list(zip(*rides))[:5])
+        buckets = np.array([traffic_bucket(ended_at - timedelta(minutes=duration))[0]
+                            for *_, duration, ended_at in rides])
+        km, free_flow_minutes = trip_distances(plat, plon, dlat, dlon)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factors = minutes / free_flow_minutes
+        # Very short hops and GPS nonsense say nothing about traffic
+        ok = (km >= 0.5) & (factors >= FACTOR_MIN) & (factors <= FACTOR_MAX)
+        for lat, lon in ((plat, plon), (dlat, dlon)):
+            index = (buckets[ok], np.clip(((lat[ok] - lat0) / cell).astype(int), 0, rows - 1),
+                     np.clip(((lon[ok] - lon0) / cell).astype(int), 0, cols - 1))
+            np.add.at(sums, index, factors[ok])
+            np.add.at(counts, index, 1)
+        used = int(ok.sum())
+    else:
+        used = 0
+
+    city_counts = counts.sum(axis=(1, 2))
+    profile = np.where(city_counts >= min_samples, sums.sum(axis=(1, 2)) / np.maximum(city_counts, 1),
+                       default_profile())
+    table = (sums + min_samples * profile[:, None, None]) / (counts + min_samples)
+
+    # Written next to the target and renamed, so a running loader never sees half a file
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez_compressed(f, factors=encode_factors(table), origin=np.array([lat0, lon0]), cell=np.array(cell))
+    os.replace(tmp, path)
+    return used
@@ -1,11 +1,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DriverLocationView, RideViewSet
+from .views import DriverLocationBatchView, DriverLocationView, RideViewSet
 
 router = DefaultRouter()
 router.register(r'', RideViewSet, basename='ride')
 
 urlpatterns = [
     path('drivers/', DriverLocationView.as_view(), name='driver-locations'),
+    path('drivers/batch/', DriverLocationBatchView.as_view(), name='driver-locations-batch'),
     path('', include(router.urls)),
 ]
@@ -1,9 +1,64 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+import math
+
+import numpy as np
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import generics, permissions, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from .models import DriverLocation, Ride, Message, RideBid
-from .serializers import DriverLocationSerializer, RideSerializer, MessageSerializer, RideBidSerializer
-from .services import calculate_fare
+from .models import DriverLocation, LocationFix, Ride, RideEvent, RideTrace, Message, RideBid
+from .serializers import (
+    DriverLocationSerializer, DriverSnapshotSerializer, RideSerializer, RideEventSerializer, MessageSerializer,
+    RideBidSerializer,
+)
+from .services import VEHICLE_RATES, calculate_fares, trip_fare
+from .bid_book import bid_book
+from .bid_windows import bid_windows
+from .dispatch import dispatcher
+from .expiry import expiry_sweeper
+from .location_store import ACTIVE_RIDE_STATUSES, location_store
+from .pooling import board_pool_riders, ride_pool
+from .quotes import quote_cache, read_quote, sign_quote
+from .ride_index import open_rides
+from .scheduler import ride_scheduler
+from .spatial import grid_cell_size, valid_coordinates
+from .state_machine import TransitionError, transition
+from .surge import surge_meter
+from .traces import finalize_trace
+from .traffic import traffic_status
+
+DEFAULT_NEARBY_RADIUS_KM = 3.0
+DEFAULT_NEARBY_LIMIT = 20
+MAX_NEARBY_RADIUS_KM = 50.0
+MAX_NEARBY_LIMIT = 200
+MAX_BATCH_FIXES = 120
+MAX_CLOCK_SKEW = timedelta(minutes=1)
+MAX_FEED_LIMIT = 50
+MAX_EVENTS_PAGE = 200
+MAX_BATCH_ESTIMATES = 1000
+TRIP_FIELDS = ('pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude')
+TRIP_COORDINATE_LIMITS = np.array([90.0, 180.0, 90.0, 180.0])
+CENT = Decimal('0.01')
+MAX_BID_AMOUNT = Decimal('99999999.99')  # RideBid.amount is 10 digits, 2 decimals
+DRIVER_VEHICLE_TYPES = {value for value, _ in DriverLocation._meta.get_field('vehicle_type').choices}
+
+def parse_fix_time(value):
+    # ISO 8601 string or epoch seconds
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+    parsed = parse_datetime(str(value))
+    if parsed is None:
+        raise ValueError("Invalid timestamp")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
 
 class DriverLocationView(generics.ListCreateAPIView):
     queryset = DriverLocation.objects.all()
@@ -12,7 +67,118 @@ class DriverLocationView(generics.ListCreateAPIView):
 
     def get_queryset(self):
         # Return all locations
-        return DriverLocation.objects.all()
+        return DriverLocation.objects.select_related('user')
+
+    def list(self, request, *args, **kwargs):
+        # Served from the in-memory location store, not the DriverLocation table.
+        # The ETag is the store cursor, so an unchanged feed is a 304 with no serialization.
+        # Except the updated_at watermark mode, which reads the DB the cursor doesn't track.
+        params = request.query_params
+        from_db = 'since' in params and not ('lat' in params or 'lon' in params) \
+            and self.watermark(params.get('since')) is not None
+        etag = None if from_db else f'"{location_store.cursor}"'
+        if etag and etag in request.headers.get('If-None-Match', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        if 'lat' in params or 'lon' in params:
+            response = self.nearby(params)
+        elif 'since' in params:
+            response = self.delta(params.get('since'))
+        elif 'at' in params:
+            response = self.predicted(params.get('at'))
+        else:
+            response = Response(DriverSnapshotSerializer(location_store.all(), many=True).data)
+
+        if etag and response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        # Clients extrapolate from recorded_at/speed_kmh/heading against this clock
+        response['X-Server-Time'] = timezone.now().isoformat()
+        return response
+
+    def predicted(self, at):
+        # Every driver with its dead-reckoned position at `at` (ISO or epoch seconds)
+        try:
+            at = parse_fix_time(float(at) if at.replace('.', '', 1).isdigit() else at)
+        except (TypeError, ValueError, OverflowError, OSError):
+            return Response({"error": "Invalid timestamp"}, status=status.HTTP_400_BAD_REQUEST)
+        results = []
+        for entry in location_store.all():
+            data = DriverSnapshotSerializer(entry).data
+            data['predicted_latitude'], data['predicted_longitude'] = location_store.predict(entry, at)
+            results.append(data)
+        return Response(results)
+
+    def delta(self, since):
+        # Drivers that changed or went offline since the cursor. Unknown or expired
+        # cursors (e.g. after a restart) get a full snapshot with reset=True.
+        cursor = location_store.cursor
+        changes = location_store.changes_since(since) if since else None
+        if changes is not None:
+            changed, removed = changes
+            return Response({
+                "cursor": cursor,
+                "server_time": timezone.now(),
+                "reset": False,
+                "drivers": DriverSnapshotSerializer(changed, many=True).data,
+                "removed": [entry['username'] for entry in removed],
+            })
+
+        watermark = self.watermark(since)
+        if watermark is not None:
+            # Plain updated_at watermark, answered from the DB through the updated_at
+            # index. Lags the live feed by up to one store flush window.
+            locations = self.get_queryset().filter(updated_at__gt=watermark).order_by('updated_at')
+            return Response({
+                "cursor": cursor,
+                "server_time": timezone.now(),
+                "reset": False,
+                "drivers": DriverLocationSerializer(locations, many=True).data,
+                "removed": [],
+            })
+
+        return Response({
+            "cursor": cursor,
+            "server_time": timezone.now(),
+            "reset": True,
+            "drivers": DriverSnapshotSerializer(location_store.all(), many=True).data,
+            "removed": [],
+        })
+
+    @staticmethod
+    def watermark(since):
+        # `since` as an updated_at datetime, None when it's a cursor
+        try:
+            watermark = parse_datetime(since) if since else None
+        except ValueError:
+            return None
+        if watermark is not None and timezone.is_naive(watermark):
+            watermark = timezone.make_aware(watermark)
+        return watermark
+
+    def nearby(self, params):
+        # Nearby mode: k nearest drivers within radius_km, closest first.
+        # status=online restricts it to free drivers.
+        try:
+            lat = float(params.get('lat'))
+            lon = float(params.get('lon'))
+            radius_km = float(params.get('radius_km', DEFAULT_NEARBY_RADIUS_KM))
+            limit = min(int(params.get('limit', DEFAULT_NEARBY_LIMIT)), MAX_NEARBY_LIMIT)
+            available_only = params.get('status') == 'online'
+        except (TypeError, ValueError):
+            return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
+        if not valid_coordinates(lat, lon):
+            return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
+        if not (math.isfinite(radius_km) and radius_km > 0) or limit <= 0:
+            return Response({"error": "radius_km and limit must be positive"}, status=status.HTTP_400_BAD_REQUEST)
+        # The cells searched grow with the square of the radius
+        radius_km = min(radius_km, MAX_NEARBY_RADIUS_KM)
+
+        results = []
+        for distance, entry in location_store.nearest(lat, lon, radius_km, limit, available_only):
+            data = DriverSnapshotSerializer(entry).data
+            data['distance_km'] = round(distance, 3)
+            results.append(data)
+        return Response(results)
 
     def post(self, request, *args, **kwargs):
         # Update or create location for the logged-in user
@@ -21,30 +187,117 @@ class DriverLocationView(generics.ListCreateAPIView):
              return Response({"error": "Only drivers can update location"}, status=status.HTTP_403_FORBIDDEN)
              
         data = request.data
-        location, created = DriverLocation.objects.update_or_create(
-            user=user,
-            defaults={
-                'latitude': data.get('latitude'),
-                'longitude': data.get('longitude'),
-                'vehicle_type': data.get('vehicle_type', 'car')
-            }
-        )
-        return Response(DriverLocationSerializer(location).data, status=status.HTTP_200_OK)
+        try:
+            latitude = float(data.get('latitude'))
+            longitude = float(data.get('longitude'))
+        except (TypeError, ValueError):
+            return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
+        if not valid_coordinates(latitude, longitude):
+            return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
+        vehicle_type = data.get('vehicle_type', 'car')
+        if vehicle_type not in DRIVER_VEHICLE_TYPES:
+            return Response({"error": "Invalid vehicle_type"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Buffered in memory, written to DriverLocation by the store's periodic flush
+        entry = location_store.update(user, latitude, longitude, vehicle_type)
+        dispatcher.ensure_running()
+        expiry_sweeper.ensure_running()
+        ride_scheduler.ensure_running()
+        response_data = DriverSnapshotSerializer(entry).data
+        # Server-driven ping cadence, backs off idle drivers under load
+        response_data['next_update_in'] = location_store.next_update_in(entry)
+        return Response(response_data, status=status.HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        # Driver goes offline and drops off the map
+        user = request.user
+        if user.role != 'driver':
+             return Response({"error": "Only drivers can update location"}, status=status.HTTP_403_FORBIDDEN)
+
+        location_store.set_status(user.id, 'offline')
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class DriverLocationBatchView(generics.GenericAPIView):
+    # Buffered pings from a driver that was offline for a while:
+    # {"vehicle_type": "...", "fixes": [{"latitude", "longitude", "timestamp"}, ...]}
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        user = request.user
+        if user.role != 'driver':
+             return Response({"error": "Only drivers can update location"}, status=status.HTTP_403_FORBIDDEN)
+
+        raw_fixes = request.data.get('fixes')
+        if not isinstance(raw_fixes, list) or not raw_fixes:
+            return Response({"error": "fixes must be a non-empty list"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(raw_fixes) > MAX_BATCH_FIXES:
+            return Response({"error": f"At most {MAX_BATCH_FIXES} fixes per batch"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            fixes = sorted(
+                (parse_fix_time(fix['timestamp']), float(fix['latitude']), float(fix['longitude']))
+                for fix in raw_fixes
+            )
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            return Response({"error": "Invalid fix"}, status=status.HTTP_400_BAD_REQUEST)
+        if not all(valid_coordinates(lat, lon) for _, lat, lon in fixes):
+            return Response({"error": "Invalid fix"}, status=status.HTTP_400_BAD_REQUEST)
+        vehicle_type = request.data.get('vehicle_type', 'car')
+        if vehicle_type not in DRIVER_VEHICLE_TYPES:
+            return Response({"error": "Invalid vehicle_type"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Out-of-order check against the live position in memory, no DB read.
+        # Fixes at or before the last one we have, duplicates and future fixes are dropped.
+        previous = location_store.get(user.id)
+        watermark = previous['recorded_at'] if previous else None
+        latest_allowed = timezone.now() + MAX_CLOCK_SKEW
+        accepted = []
+        for fix in fixes:
+            if (watermark is None or fix[0] > watermark) and fix[0] <= latest_allowed:
+                accepted.append(fix)
+                watermark = fix[0]
+        if not accepted:
+            return Response({"accepted": 0, "rejected": len(fixes), "location": None})
+
+        *history, (recorded_at, latitude, longitude) = accepted
+        for ts, lat, lon in history:
+            location_store.trip_point(user.id, lat, lon, ts)
+        with transaction.atomic():
+            LocationFix.objects.bulk_create([
+                LocationFix(user=user, latitude=lat, longitude=lon, recorded_at=ts)
+                for ts, lat, lon in history
+            ])
+            entry = location_store.update(
+                user, latitude, longitude, vehicle_type, recorded_at=recorded_at,
+                previous_fix=(history[-1][1], history[-1][2], history[-1][0]) if history else None,
+            )
+
+        return Response({
+            "accepted": len(accepted),
+            "rejected": len(fixes) - len(accepted),
+            "location": DriverSnapshotSerializer(entry).data,
+            "next_update_in": location_store.next_update_in(entry),
+        })
 
 class RideViewSet(viewsets.ModelViewSet):
     queryset = Ride.objects.all()
     serializer_class = RideSerializer
     permission_classes = [permissions.IsAuthenticated]
+    # Some actions hand the raw pk to transition(), a non-numeric one 404s in routing
+    lookup_value_regex = r'\d+'
 
     def get_queryset(self):
         user = self.request.user
         if user.role == 'driver':
             # Drivers see available requests or rides they effectively own (accepted/in-progress)
             # Drivers see available requests OR rides they have accepted/started
-            return Ride.objects.filter(status='requested') | Ride.objects.filter(driver=user, status__in=['accepted', 'in_progress'])
+            rides = Ride.objects.filter(status='requested') | Ride.objects.filter(driver=user, status__in=['accepted', 'in_progress'])
         else:
             # Passengers only see their own rides
-            return Ride.objects.filter(passenger=user)
+            rides = Ride.objects.filter(passenger=user)
+        if self.action in ('list', 'retrieve'):
+            # Nested bids name their drivers, one query for all of them
+            rides = rides.select_related('passenger', 'driver').prefetch_related('bids__driver')
+        return rides
 
     def perform_create(self, serializer):
         # Calculate fare before saving
@@ -54,15 +307,112 @@ class RideViewSet(viewsets.ModelViewSet):
         dropoff_lat = float(data.get('dropoff_latitude'))
         dropoff_lon = float(data.get('dropoff_longitude'))
         
-        fare_details = calculate_fare(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
-        
+        route = (pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+        vehicle_type = data.get('vehicle_type', 'car')
+        if not isinstance(vehicle_type, str) or vehicle_type not in VEHICLE_RATES:
+            raise ValidationError({"vehicle_type": "Unknown vehicle type"})
+        # The fare the passenger was quoted. A token that doesn't match the booking
+        # is refused rather than silently re-priced; without one the fare is quoted now.
+        token = data.get('quote_token')
+        if token:
+            fare_details = read_quote(token, self.request.user, route, vehicle_type)
+            if fare_details is None:
+                raise ValidationError({"quote_token": "Quote expired or doesn't match this ride, get a new estimate"})
+        else:
+            fare_details = quote_cache.quote(*route, vehicle_type)
+
+        # Bookings further out than the lead time wait in the scheduler
+        scheduled_for = serializer.validated_data.get('scheduled_for')
+        scheduled = scheduled_for is not None and scheduled_for - ride_scheduler.lead_time > timezone.now()
+
+        extra = {'status': 'scheduled' if scheduled else 'requested'}
+        bid_window_seconds = serializer.validated_data.get('bid_window_seconds')
+        if bid_window_seconds:
+            # Scheduled bookings take bids from when they are released
+            opens_at = scheduled_for - ride_scheduler.lead_time if scheduled else timezone.now()
+            extra['bid_window_closes_at'] = opens_at + timedelta(seconds=bid_window_seconds)
+        pool_with = data.get('pool_with')
+        if pool_with:
+            # Joining another ride: re-checked against the host as it is now
+            if scheduled or bid_window_seconds:
+                raise ValidationError({"pool_with": "Scheduled rides and bid windows can't be pooled"})
+            try:
+                host_id = int(pool_with)
+            except (TypeError, ValueError):
+                raise ValidationError({"pool_with": "Invalid ride"})
+            offers = ride_pool.offers((pickup_lat, pickup_lon), (dropoff_lat, dropoff_lon),
+                                      fare_details['estimated_fare'], ride_ids=[host_id], passenger=self.request.user)
+            if not offers:
+                raise ValidationError({"pool_with": "That ride can't take you any more"})
+            host = Ride.objects.get(id=host_id)
+            extra.update(pooled_with=host, driver=host.driver,
+                         status='requested' if host.status == 'requested' else 'accepted')
+            fare_details['estimated_fare'] = offers[0]['shared_fare']
+
         serializer.save(
             passenger=self.request.user,
+            vehicle_type=vehicle_type,
             estimated_fare=fare_details['estimated_fare'],
             distance_km=fare_details['distance_km'],
             duration_minutes=fare_details['duration_minutes'],
-            traffic_factor=fare_details['traffic_factor']
+            traffic_factor=fare_details['traffic_factor'],
+            surge_multiplier=fare_details['surge_multiplier'],
+            **extra
         )
+        ride = serializer.instance
+        RideEvent.objects.create(ride=ride, event='request', to_status=ride.status, actor=self.request.user,
+                                 data={'pooled_with': ride.pooled_with_id} if ride.pooled_with_id else {})
+        if scheduled:
+            ride_scheduler.add(ride)
+        elif ride.pooled_with_id is None:
+            open_rides.add(ride)
+            ride_pool.add(ride)
+        if ride.bid_window_closes_at is not None:
+            bid_windows.add(ride)
+            bid_windows.ensure_running()
+        dispatcher.ensure_running()
+        expiry_sweeper.ensure_running()
+        ride_scheduler.ensure_running()
+
+    @action(detail=False, methods=['get'])
+    def feed(self, request):
+        # Open requests near the driver's last known position, best first,
+        # plus the driver's own active ride.
+        user = request.user
+        if user.role != 'driver':
+            return Response({"error": "Only drivers have a ride feed"}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            radius_km = float(request.query_params.get('radius_km', getattr(settings, 'RIDES_DRIVER_FEED_RADIUS_KM', 5.0)))
+            limit = min(int(request.query_params.get('limit', DEFAULT_NEARBY_LIMIT)), MAX_FEED_LIMIT)
+        except ValueError:
+            return Response({"error": "Invalid radius_km or limit"}, status=status.HTTP_400_BAD_REQUEST)
+        if not (math.isfinite(radius_km) and radius_km > 0) or limit <= 0:
+            return Response({"error": "radius_km and limit must be positive"}, status=status.HTTP_400_BAD_REQUEST)
+        radius_km = min(radius_km, getattr(settings, 'RIDES_DRIVER_FEED_MAX_RADIUS_KM', 20.0))
+
+        # With pooling a driver can hold several rides, the host ride comes first
+        active = Ride.objects.filter(driver=user, status__in=['accepted', 'in_progress']) \
+            .order_by(F('pooled_with').asc(nulls_first=True), 'updated_at').first()
+        active = RideSerializer(active).data if active else None
+        entry = location_store.get(user.id)
+        if entry is None:
+            # Offline or not pinged yet: no requests, but the driver still sees their own ride
+            return Response({"active": active, "requests": []})
+
+        ranked = open_rides.ranked(entry['latitude'], entry['longitude'], radius_km, limit)
+        rides = Ride.objects.filter(id__in=[ride_id for _, _, ride_id in ranked], status='requested') \
+            .select_related('passenger', 'driver').prefetch_related('bids__driver').in_bulk()
+        requests = []
+        for _, pickup_km, ride_id in ranked:
+            ride = rides.get(ride_id)
+            if ride is None:
+                open_rides.remove(ride_id)  # taken or cancelled elsewhere
+                continue
+            data = RideSerializer(ride).data
+            data['pickup_distance_km'] = round(pickup_km, 3)
+            requests.append(data)
+
+        return Response({"active": active, "requests": requests})
 
     @action(detail=False, methods=['post'])
     def estimate(self, request):
@@ -72,32 +422,118 @@ class RideViewSet(viewsets.ModelViewSet):
             pickup_lon = float(data.get('pickup_longitude'))
             dropoff_lat = float(data.get('dropoff_latitude'))
             dropoff_lon = float(data.get('dropoff_longitude'))
+            if not (valid_coordinates(pickup_lat, pickup_lon) and valid_coordinates(dropoff_lat, dropoff_lon)):
+                return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
+            vehicle_type = data.get('vehicle_type', 'car')
+            if not isinstance(vehicle_type, str) or vehicle_type not in VEHICLE_RATES:
+                return Response({"error": "Unknown vehicle type"}, status=status.HTTP_400_BAD_REQUEST)
             
-            fare_details = calculate_fare(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+            route = (pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+            fare_details = quote_cache.quote(*route, vehicle_type)
+            fare_details['quote_token'], fare_details['quote_expires_at'] = sign_quote(
+                fare_details, request.user, route, vehicle_type
+            )
+            # Rides going the same way that could take this passenger for less
+            fare_details['pool_offers'] = ride_pool.offers(
+                (pickup_lat, pickup_lon), (dropoff_lat, dropoff_lon), fare_details['estimated_fare'],
+                passenger=request.user,
+            )
             return Response(fare_details)
         except (TypeError, ValueError):
             return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['get'], url_path='estimate/cache')
+    def estimate_cache(self, request):
+        # Quote cache counters of this process, for staff
+        if not request.user.is_staff:
+            return Response({"error": "Staff only"}, status=status.HTTP_403_FORBIDDEN)
+        return Response(quote_cache.stats())
+
+    @action(detail=False, methods=['post'], url_path='estimate/batch')
+    def estimate_batch(self, request):
+        # {"trips": [{pickup/dropoff coordinates}, ...], "vehicle_types": [...]}, all types by default.
+        # Every trip is priced for every vehicle type in one vectorized pass, results in trip order.
+        trips = request.data.get('trips')
+        vehicle_types = request.data.get('vehicle_types') or list(VEHICLE_RATES)
+        if not isinstance(trips, list) or len(trips) > MAX_BATCH_ESTIMATES:
+            return Response({"error": f"trips must be a list of at most {MAX_BATCH_ESTIMATES}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(vehicle_types, list) \
+                or any(not isinstance(v, str) or v not in VEHICLE_RATES for v in vehicle_types):
+            return Response({"error": "Unknown vehicle type"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            coords = np.array([[trip[field] for field in TRIP_FIELDS] for trip in trips], dtype=float).reshape(-1, 4)
+        except (KeyError, TypeError, ValueError):
+            return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
+        # valid_coordinates() over the whole batch, NaN fails the comparison too
+        if not (np.abs(coords) <= TRIP_COORDINATE_LIMITS).all():
+            return Response({"error": "Invalid coordinates"}, status=status.HTTP_400_BAD_REQUEST)
+
+        fares = calculate_fares(*coords.T, vehicle_types=vehicle_types,
+                                surge_multiplier=surge_meter.multipliers(coords[:, 0], coords[:, 1]))
+        results = [
+            {
+                "distance_km": distance_km,
+                "duration_minutes": duration_minutes,
+                "traffic_factor": traffic_factor,
+                "traffic_status": traffic_status(traffic_factor),
+                "surge_multiplier": surge_multiplier,
+                "fares": dict(zip(vehicle_types, row)),
+            }
+            for distance_km, duration_minutes, traffic_factor, surge_multiplier, row in zip(
+                fares['distance_km'].tolist(), fares['duration_minutes'].tolist(),
+                fares['traffic_factor'].tolist(), fares['surge_multiplier'].tolist(),
+                fares['estimated_fare'].tolist(),
+            )
+        ]
+        return Response({"vehicle_types": vehicle_types, "results": results})
+
+    @action(detail=False, methods=['get'])
+    def surge(self, request):
+        # Demand, supply and surge per grid cell over the surge window,
+        # optionally limited to a south/west/north/east box
+        bounds = [request.query_params.get(key) for key in ('south', 'west', 'north', 'east')]
+        bbox = None
+        if any(bound is not None for bound in bounds):
+            try:
+                bbox = [float(bound) for bound in bounds]
+            except (TypeError, ValueError):
+                return Response({"error": "south, west, north and east must all be numbers"},
+                                status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            "cell_degrees": grid_cell_size(),
+            "window_s": surge_meter.window,
+            "cells": surge_meter.heatmap(bbox),
+        })
+
     @action(detail=True, methods=['patch'])
     def accept(self, request, pk=None):
-        ride = self.get_object()
         user = request.user
-        
+
         if user.role != 'driver':
             return Response({"error": "Only drivers can accept rides"}, status=status.HTTP_403_FORBIDDEN)
-            
-        if ride.status != 'requested':
-            return Response({"error": "Ride is not available"}, status=status.HTTP_400_BAD_REQUEST)
-            
-        # Check if driver already has an active ride
-        active_rides = Ride.objects.filter(driver=user, status__in=['accepted', 'in_progress'])
-        if active_rides.exists():
+
+        if dispatcher.enabled:
+            return Response({"error": "Rides are assigned by dispatch"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Claimed with one conditional UPDATE: the status filter picks the single
+        # winner among racing drivers, the one-active-ride constraint rejects a
+        # driver who already holds a ride.
+        try:
+            with transaction.atomic():
+                # Pool riders come along with their host, they aren't taken on their own
+                transition(pk, 'accept', actor=user, where={'pooled_with__isnull': True}, driver=user)
+                board_pool_riders([(int(pk), user.id)])
+        except IntegrityError:
             return Response({"error": "You already have an active ride"}, status=status.HTTP_400_BAD_REQUEST)
+        except TransitionError:
+            self.get_object()  # 404 for unknown rides
+            return Response({"error": "Ride is not available"}, status=status.HTTP_400_BAD_REQUEST)
 
-        ride.driver = user
-        ride.status = 'accepted'
-        ride.save()
-        
+        open_rides.remove(int(pk))
+        bid_book.close([int(pk)], 'accepted')
+        location_store.set_status(user.id, 'busy')
+        ride = Ride.objects.select_related('passenger', 'driver').get(pk=pk)
         return Response(RideSerializer(ride).data)
 
     @action(detail=True, methods=['post'])
@@ -108,48 +544,85 @@ class RideViewSet(viewsets.ModelViewSet):
         if user.role != 'driver':
             return Response({"error": "Only drivers can bid"}, status=status.HTTP_403_FORBIDDEN)
         
-        if ride.status != 'requested':
+        # Pooled riders travel on their host's ride, which is the one drivers bid on
+        if ride.status != 'requested' or ride.pooled_with_id is not None:
             return Response({"error": "Ride is not available for bidding"}, status=status.HTTP_400_BAD_REQUEST)
+        if ride.bid_window_closes_at is not None and ride.bid_window_closes_at <= timezone.now():
+            return Response({"error": "Bidding has closed for this ride"}, status=status.HTTP_400_BAD_REQUEST)
             
         amount = request.data.get('amount')
-        if not amount:
+        if amount in (None, ''):
              return Response({"error": "Amount is required"}, status=status.HTTP_400_BAD_REQUEST)
+        # Positive and finite, a negative bid would top every bid window
+        try:
+            amount = Decimal(str(amount)).quantize(CENT)
+        except InvalidOperation:
+            return Response({"error": "Amount must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        if not amount.is_finite() or not 0 < amount <= MAX_BID_AMOUNT:
+            return Response({"error": "Amount must be positive"}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            bid, created = RideBid.objects.update_or_create(
+                ride=ride,
+                driver=user,
+                defaults={'amount': amount, 'status': 'pending'}
+            )
+            bid_book.place(bid)
 
-        bid, created = RideBid.objects.update_or_create(
-            ride=ride,
-            driver=user,
-            defaults={'amount': amount, 'status': 'pending'}
-        )
-        
         return Response(RideBidSerializer(bid).data, status=status.HTTP_201_CREATED)
 
+    @action(detail=True, methods=['get'])
+    def bids(self, request, pk=None):
+        # Cheapest pending bids on the passenger's requested ride, from the bid book.
+        # The cursor is also the ETag: ?since=<cursor> or If-None-Match with the
+        # current one is a 304 with no body. Settled rides get their bids from the DB.
+        ride = generics.get_object_or_404(Ride.objects.only('id', 'status'), pk=pk, passenger=request.user)
+        if ride.status != 'requested':
+            bid_book.close([ride.id], ride.status)  # settled behind this process's back
+            bids = RideBidSerializer(RideBid.objects.filter(ride=ride).select_related('driver'), many=True).data
+            return Response({"cursor": None, "status": ride.status, "bids": bids, "count": len(bids)})
+
+        cursor, bids, count = bid_book.snapshot(ride.id)
+        etag = f'"{cursor}"'
+        if request.query_params.get('since') == cursor or etag in request.headers.get('If-None-Match', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response({"cursor": cursor, "status": ride.status, "bids": bids, "count": count},
+                        headers={'ETag': etag})
+
     @action(detail=True, methods=['post'])
     def accept_bid(self, request, pk=None):
-        ride = self.get_object()
         user = request.user
-
-        if ride.passenger != user:
-            return Response({"error": "Only the passenger can accept bids"}, status=status.HTTP_403_FORBIDDEN)
-            
-        bid_id = request.data.get('bid_id')
         try:
-            bid = RideBid.objects.get(id=bid_id, ride=ride)
-        except RideBid.DoesNotExist:
+            bid_id = int(request.data.get('bid_id'))
+        except (TypeError, ValueError):
+            return Response({"error": "Invalid bid_id"}, status=status.HTTP_400_BAD_REQUEST)
+        bid = RideBid.objects.filter(id=bid_id, ride_id=pk).first()
+        if bid is None:
+            self.get_object()  # 404 for rides the user can't see
             return Response({"error": "Bid not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Update Ride
-        ride.driver = bid.driver
-        ride.status = 'accepted'
-        ride.actual_fare = bid.amount
-        ride.save()
-
-        # Update Bids
-        bid.status = 'accepted'
-        bid.save()
-        
-        # Reject other bids (optional, but good practice)
-        RideBid.objects.filter(ride=ride).exclude(id=bid.id).update(status='rejected')
+        # Same single-statement claim as accept, conditioned on the passenger
+        try:
+            with transaction.atomic():
+                transition(pk, 'accept', actor=user, where={'passenger': user, 'pooled_with__isnull': True},
+                           data={'bid_id': bid.id, 'amount': bid.amount},
+                           driver_id=bid.driver_id, actual_fare=bid.amount)
+                board_pool_riders([(int(pk), bid.driver_id)])
+                RideBid.objects.filter(ride_id=pk).update(status=Case(
+                    When(id=bid.id, then=Value('accepted')), default=Value('rejected')
+                ))
+        except IntegrityError:
+            return Response({"error": "Driver already has an active ride"}, status=status.HTTP_400_BAD_REQUEST)
+        except TransitionError:
+            ride = self.get_object()
+            if ride.passenger_id != user.id:
+                return Response({"error": "Only the passenger can accept bids"}, status=status.HTTP_403_FORBIDDEN)
+            return Response({"error": "Ride is not available"}, status=status.HTTP_400_BAD_REQUEST)
 
+        open_rides.remove(int(pk))
+        bid_book.close([int(pk)], 'accepted')
+        location_store.set_status(bid.driver_id, 'busy')
+        ride = Ride.objects.select_related('passenger', 'driver').get(pk=pk)
         return Response(RideSerializer(ride).data)
 
     @action(detail=True, methods=['post'])
@@ -163,11 +636,13 @@ class RideViewSet(viewsets.ModelViewSet):
         if ride.driver != user:
              return Response({"error": "You are not the driver for this ride"}, status=status.HTTP_403_FORBIDDEN)
              
-        if ride.status != 'accepted':
+        try:
+            transition(ride, 'start', actor=user)
+        except TransitionError:
             return Response({"error": "Ride must be accepted before starting"}, status=status.HTTP_400_BAD_REQUEST)
-            
-        ride.status = 'in_progress'
-        ride.save()
+
+        trace, _ = RideTrace.objects.get_or_create(ride=ride, defaults={'started_at': timezone.now()})
+        location_store.begin_trip(user.id, ride.id, trace.started_at)
         
         return Response(RideSerializer(ride).data)
 
@@ -184,12 +659,65 @@ class RideViewSet(viewsets.ModelViewSet):
              
         if ride.status != 'in_progress':
             return Response({"error": "Ride must be in progress before completing"}, status=status.HTTP_400_BAD_REQUEST)
-            
-        ride.status = 'completed'
-        ride.save()
+
+        # Distance comes from the running odometer, no need to re-read the trace
+        odometer = location_store.end_trip(user.id, ride.id)
+        trace = finalize_trace(ride.id)
+        changes = {}
+        if odometer is not None and odometer.anchor is not None:
+            changes['distance_km'] = round(odometer.distance_km, 2)
+            changes['duration_minutes'] = int((timezone.now() - odometer.started_at).total_seconds() // 60)
+            if ride.actual_fare is None:
+                # Bid price wins when there was one
+                changes['actual_fare'] = trip_fare(changes['distance_km'], changes['duration_minutes'], ride.vehicle_type)
+        elif trace is not None and trace.point_count:
+            changes['distance_km'] = round(trace.distance_km, 2)
+            changes['duration_minutes'] = int((timezone.now() - trace.started_at).total_seconds() // 60)
+
+        try:
+            transition(ride, 'complete', actor=user, data=changes, **changes)
+        except TransitionError:
+            return Response({"error": "Ride must be in progress before completing"}, status=status.HTTP_400_BAD_REQUEST)
+        # A pooling driver stays busy while another passenger is still on board
+        if not Ride.objects.filter(driver=user, status__in=ACTIVE_RIDE_STATUSES).exists():
+            location_store.set_status(user.id, 'online')
         
         return Response(RideSerializer(ride).data)
 
+    @action(detail=True, methods=['get'])
+    def events(self, request, pk=None):
+        # Transitions after ?after=<event id>, oldest first, so clients can poll incrementally.
+        # Participants only, and drivers keep access after the ride is over.
+        user = request.user
+        ride = generics.get_object_or_404(Ride, Q(passenger=user) | Q(driver=user), pk=pk)
+
+        try:
+            after = int(request.query_params.get('after', 0))
+        except ValueError:
+            return Response({"error": "Invalid after"}, status=status.HTTP_400_BAD_REQUEST)
+        events = RideEvent.objects.filter(ride=ride, id__gt=after).select_related('actor')[:MAX_EVENTS_PAGE]
+        return Response(RideEventSerializer(events, many=True).data)
+
+    @action(detail=True, methods=['get'])
+    def trace(self, request, pk=None):
+        ride = self.get_object()
+        user = request.user
+
+        if user != ride.passenger and user != ride.driver:
+            return Response({"error": "Not a participant"}, status=status.HTTP_403_FORBIDDEN)
+
+        trace = RideTrace.objects.filter(ride=ride).first()
+        if trace is None:
+            return Response({"error": "No trace for this ride"}, status=status.HTTP_404_NOT_FOUND)
+
+        # Points are [lat, lon, seconds since started_at]
+        return Response({
+            "started_at": trace.started_at,
+            "point_count": trace.point_count,
+            "simplified": trace.simplified,
+            "points": [list(point) for point in trace.points()],
+        })
+
     @action(detail=True, methods=['get', 'post'])
     def messages(self, request, pk=None):
         ride = self.get_object()
@@ -0,0 +1,84 @@
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_URL = "http://127.0.0.1:8000/api"
+DRIVERS = 32
+ROUNDS = 10
+
+RIDE_DATA = {
+    "pickup_latitude": 23.81, "pickup_longitude": 90.41, "pickup_address": "Stress Pickup",
+    "dropoff_latitude": 23.82, "dropoff_longitude": 90.42, "dropoff_address": "Stress Dropoff"
+}
+
+
+def get_token(username, password, role):
+    requests.post(f"{BASE_URL}/users/register/", json={
+        "username": username, "password": password, "email": f"{username}@example.com", "role": role
+    })
+    res = requests.post(f"{BASE_URL}/token/", data={"username": username, "password": password})
+    if res.status_code == 200:
+        return {"Authorization": f"Bearer {res.json()['access']}"}
+    print(f"Failed to get token for {username}: {res.text}")
+    sys.exit(1)
+
+
+def race(calls):
+    # Fires every call at once, returns their status codes
+    barrier = threading.Barrier(len(calls))
+
+    def fire(call):
+        barrier.wait()
+        return call().status_code
+
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        return list(pool.map(fire, calls))
+
+
+def release(headers, ride_id):
+    requests.post(f"{BASE_URL}/rides/{ride_id}/start_ride/", headers=headers)
+    requests.post(f"{BASE_URL}/rides/{ride_id}/complete_ride/", headers=headers)
+
+
+def verify_concurrent_accept():
+    print("--- Verifying concurrent ride acceptance ---")
+    suffix = int(time.time())
+    pax = get_token(f"stress_pax_{suffix}", "password123", "rider")
+    drivers = [get_token(f"stress_driver_{suffix}_{i}", "password123", "driver") for i in range(DRIVERS)]
+    failures = 0
+
+    print(f"\n[1] {DRIVERS} drivers accepting the same ride, {ROUNDS} rounds...")
+    for round_no in range(ROUNDS):
+        ride_id = requests.post(f"{BASE_URL}/rides/", json=RIDE_DATA, headers=pax).json()['id']
+        codes = race([
+            lambda h=h: requests.patch(f"{BASE_URL}/rides/{ride_id}/accept/", headers=h) for h in drivers
+        ])
+        winners = [h for h, code in zip(drivers, codes) if code == 200]
+        ok = len(winners) == 1
+        failures += not ok
+        print(f"  round {round_no + 1}: {codes.count(200)} accepted, {len(codes) - codes.count(200)} rejected"
+              f"{'' if ok else '  <-- FAILURE'}")
+        for h in winners:
+            release(h, ride_id)
+
+    print(f"\n[2] One driver accepting {DRIVERS} different rides at once...")
+    ride_ids = [requests.post(f"{BASE_URL}/rides/", json=RIDE_DATA, headers=pax).json()['id'] for _ in range(DRIVERS)]
+    codes = race([
+        lambda r=r: requests.patch(f"{BASE_URL}/rides/{r}/accept/", headers=drivers[0]) for r in ride_ids
+    ])
+    ok = codes.count(200) == 1
+    failures += not ok
+    print(f"  {codes.count(200)} accepted, {len(codes) - codes.count(200)} rejected{'' if ok else '  <-- FAILURE'}")
+    for ride_id, code in zip(ride_ids, codes):
+        if code == 200:
+            release(drivers[0], ride_id)
+
+    print(f"\n--- {'SUCCESS' if not failures else f'{failures} FAILURES'} ---")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    verify_concurrent_accept()
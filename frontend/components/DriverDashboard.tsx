@@ -17,15 +17,10 @@ export default function DriverDashboard() {
 
     const fetchRides = async () => {
         try {
-            const res = await api.get("/rides/");
-            const allRides = res.data;
-
-            // Separate active ride from requests
-            const active = allRides.find((r: any) => r.status === 'accepted' || r.status === 'in_progress');
-            const requests = allRides.filter((r: any) => r.status === 'requested');
-
-            setActiveRide(active || null);
-            setRequestedRides(requests);
+            // Nearby requests, ranked server-side, plus our own active ride
+            const res = await api.get("/rides/feed/");
+            setActiveRide(res.data.active);
+            setRequestedRides(res.data.requests);
 
         } catch (err) {
             console.error("Failed to fetch rides", err);
@@ -76,9 +71,15 @@ export default function DriverDashboard() {
     };
 
     useEffect(() => {
-        let interval: NodeJS.Timeout;
+        let timeout: NodeJS.Timeout;
+        let cancelled = false;
 
         if (isOnline) {
+            // The server tells us when to ping next (next_update_in), default 5s
+            const scheduleNext = (seconds?: number) => {
+                if (!cancelled) timeout = setTimeout(updateLocation, (seconds || 5) * 1000);
+            };
+
             const updateLocation = () => {
                 if (simulateLocation) {
                     // Simulate random movement around Dhaka
@@ -89,26 +90,30 @@ export default function DriverDashboard() {
                         latitude: lat,
                         longitude: lng,
                         vehicle_type: "car",
-                    }).then(() => {
+                    }).then((res) => {
                         setStatusMessage("Location updated (Simulated).");
+                        scheduleNext(res.data.next_update_in);
                     }).catch(err => {
                         console.error("Failed to update simulated location", err);
                         setStatusMessage("Failed to update location.");
+                        scheduleNext();
                     });
                 } else if (navigator.geolocation) {
                     navigator.geolocation.getCurrentPosition(
                         async (position) => {
                             const { latitude, longitude } = position.coords;
                             try {
-                                await api.post("/rides/drivers/", {
+                                const res = await api.post("/rides/drivers/", {
                                     latitude,
                                     longitude,
                                     vehicle_type: "car", // Hardcoded for now, could be from user profile
                                 });
                                 statusMessage === "Location updated." || setStatusMessage("Location updated.");
+                                scheduleNext(res.data.next_update_in);
                             } catch (error) {
                                 console.error("Failed to update location", error);
                                 setStatusMessage("Failed to update location.");
+                                scheduleNext();
                             }
                         },
                         (error) => {
@@ -118,6 +123,7 @@ export default function DriverDashboard() {
                             else if (error.code === 2) msg = "Location unavailable. GPS off?";
                             else if (error.code === 3) msg = "Location timed out.";
                             setStatusMessage(msg);
+                            scheduleNext();
                         },
                         { enableHighAccuracy: false, timeout: 20000 }
                     );
@@ -127,11 +133,11 @@ export default function DriverDashboard() {
             };
 
             updateLocation(); // Immediate update
-            interval = setInterval(updateLocation, 5000); // Poll every 5s
         }
 
         return () => {
-            if (interval) clearInterval(interval);
+            cancelled = true;
+            if (timeout) clearTimeout(timeout);
         };
     }, [isOnline, simulateLocation]);
 
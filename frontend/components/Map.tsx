@@ -1,6 +1,6 @@
 "use client";
 
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
 import { MapContainer, TileLayer, Marker, Popup } from "react-leaflet";
 import "leaflet/dist/leaflet.css";
 import L from "leaflet";
@@ -46,15 +46,23 @@ function RecenterMap({ location }: { location: [number, number] }) {
 
 export default function Map() {
     const [drivers, setDrivers] = useState<DriverLocation[]>([]);
+    const driversRef = useRef<Record<string, DriverLocation>>({});
+    const cursorRef = useRef("");
     const [userLocation, setUserLocation] = useState<[number, number] | null>(null);
     const [locationError, setLocationError] = useState<string | null>(null);
 
     useEffect(() => {
-        // Fetch Drivers
+        // Fetch Drivers (delta feed: only drivers that moved or went offline since the last cursor)
         const fetchDrivers = async () => {
             try {
-                const res = await api.get("/rides/drivers/");
-                setDrivers(res.data);
+                const res = await api.get("/rides/drivers/", { params: { since: cursorRef.current } });
+                const { cursor, reset, drivers: changed, removed } = res.data;
+                const next = reset ? {} : { ...driversRef.current };
+                changed.forEach((d: DriverLocation) => { next[d.username] = d; });
+                removed.forEach((username: string) => { delete next[username]; });
+                driversRef.current = next;
+                cursorRef.current = cursor;
+                setDrivers(Object.values(next));
             } catch (err) {
                 console.error("Failed to fetch drivers", err);
             }
@@ -136,9 +144,9 @@ export default function Map() {
                 )}
 
                 {/* Driver Markers */}
-                {drivers.map((driver, idx) => (
+                {drivers.map((driver) => (
                     <Marker
-                        key={idx}
+                        key={driver.username}
                         position={[driver.latitude, driver.longitude]}
                         icon={driver.vehicle_type === 'bike' ? bikeIcon : carIcon}
                     >
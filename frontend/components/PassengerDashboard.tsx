@@ -1,6 +1,6 @@
 "use client";
 
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import dynamic from "next/dynamic";
 import api from "../lib/api";
 import ChatWindow from "./ChatWindow";
@@ -11,9 +11,12 @@ const Map = dynamic(() => import("./Map"), { ssr: false });
 export default function PassengerDashboard() {
     const [pickup, setPickup] = useState("");
     const [dropoff, setDropoff] = useState("");
-    const [status, setStatus] = useState<"idle" | "estimating" | "estimated" | "requesting" | "requested" | "accepted" | "in_progress">("idle");
+    const [pickupTime, setPickupTime] = useState("");
+    const [status, setStatus] = useState<"idle" | "estimating" | "estimated" | "requesting" | "scheduled" | "requested" | "accepted" | "in_progress">("idle");
     const [currentRide, setCurrentRide] = useState<any>(null);
     const [estimate, setEstimate] = useState<any>(null);
+    const [bids, setBids] = useState<any[]>([]);
+    const bidCursorRef = useRef<string | null>(null);
 
     const checkRideStatus = async (rideId: number) => {
         try {
@@ -35,7 +38,7 @@ export default function PassengerDashboard() {
                 const res = await api.get("/rides/");
                 // Find the most recent active ride
                 // Passengers only see their own rides, so filtering by status is enough
-                const active = res.data.find((r: any) => ['requested', 'accepted', 'in_progress'].includes(r.status));
+                const active = res.data.find((r: any) => ['scheduled', 'requested', 'accepted', 'in_progress'].includes(r.status));
 
                 if (active) {
                     setCurrentRide(active);
@@ -52,8 +55,8 @@ export default function PassengerDashboard() {
     useEffect(() => {
         let interval: NodeJS.Timeout;
 
-        // Poll if we have a ride that is not completed
-        if (currentRide && ['requested', 'accepted', 'in_progress'].includes(status)) {
+        // Poll if we have a ride that is not completed (bids come from the bid feed below)
+        if (currentRide && ['scheduled', 'accepted', 'in_progress'].includes(status)) {
             interval = setInterval(() => {
                 checkRideStatus(currentRide.id);
             }, 3000); // Poll every 3s for faster updates
@@ -62,6 +65,56 @@ export default function PassengerDashboard() {
         return () => clearInterval(interval);
     }, [status, currentRide]);
 
+    // Live bids while the ride is requested: pushed over a WebSocket, with a
+    // cursor poll (304 until the top bids change) if the socket drops
+    useEffect(() => {
+        if (!currentRide || status !== 'requested') return;
+        const rideId = currentRide.id;
+        let interval: NodeJS.Timeout | undefined;
+        let closed = false;
+
+        const pollBids = async () => {
+            try {
+                const res = await api.get(`/rides/${rideId}/bids/`, {
+                    params: bidCursorRef.current ? { since: bidCursorRef.current } : {},
+                    validateStatus: (code) => code === 200 || code === 304,
+                });
+                if (res.status === 304) return;
+                bidCursorRef.current = res.data.cursor;
+                setBids(res.data.bids);
+                if (res.data.status !== 'requested') checkRideStatus(rideId);
+            } catch (err) {
+                console.error("Failed to fetch bids", err);
+            }
+        };
+
+        const token = localStorage.getItem('access_token');
+        const socket = new WebSocket(`ws://localhost:8000/ws/rides/${rideId}/bids/?token=${token}`);
+        socket.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+            if (message.type === 'closed') {
+                closed = true;
+                checkRideStatus(rideId);
+                return;
+            }
+            bidCursorRef.current = message.cursor;
+            setBids(message.bids);
+        };
+        socket.onclose = () => {
+            if (!closed && !interval) {
+                pollBids();
+                interval = setInterval(pollBids, 3000);
+            }
+        };
+
+        return () => {
+            closed = true;
+            socket.close();
+            clearInterval(interval);
+            bidCursorRef.current = null;
+        };
+    }, [status, currentRide?.id]);
+
     const handleGetEstimate = async () => {
         if (!pickup || !dropoff) return;
         setStatus("estimating");
@@ -94,10 +147,14 @@ export default function PassengerDashboard() {
                 pickup_latitude: 23.8103,
                 pickup_longitude: 90.4125,
                 dropoff_latitude: 23.8103 + 0.01,
-                dropoff_longitude: 90.4125 + 0.01
+                dropoff_longitude: 90.4125 + 0.01,
+                // Optional advance booking
+                scheduled_for: pickupTime ? new Date(pickupTime).toISOString() : null,
+                // Books the fare shown in the estimate while the quote is valid
+                quote_token: estimate?.quote_token
             });
             setCurrentRide(res.data);
-            setStatus("requested");
+            setStatus(res.data.status);
         } catch (error) {
             console.error("Failed to request ride", error);
             setStatus("idle");
@@ -156,6 +213,14 @@ export default function PassengerDashboard() {
                                     />
                                 </div>
 
+                                <input
+                                    type="datetime-local"
+                                    value={pickupTime}
+                                    onChange={(e) => setPickupTime(e.target.value)}
+                                    title="Pickup time (leave empty for now)"
+                                    className="block w-full px-3 py-3 border-none rounded-lg bg-gray-100 text-gray-900 focus:outline-none focus:ring-2 focus:ring-black"
+                                />
+
                                 {/* Estimate View */}
                                 {status === 'estimated' && estimate && (
                                     <div className="p-4 bg-gray-50 rounded-lg border border-gray-200">
@@ -204,16 +269,26 @@ export default function PassengerDashboard() {
                         </div>
                     )}
 
+                    {status === 'scheduled' && (
+                        <div className="p-6 bg-gray-50 border border-gray-200 rounded-xl">
+                            <h3 className="text-xl font-bold mb-2">Ride booked</h3>
+                            <p className="text-gray-600">
+                                Pickup at {currentRide?.scheduled_for && new Date(currentRide.scheduled_for).toLocaleString()}.
+                                Drivers will see your request shortly before then.
+                            </p>
+                        </div>
+                    )}
+
                     {status === 'requested' && (
                         <div className="p-6 bg-yellow-50 border border-yellow-200 rounded-xl">
                             <h3 className="text-xl font-bold mb-2">Looking for drivers...</h3>
                             <p className="text-gray-600 mb-4">Drivers will place bids for your ride.</p>
 
                             {/* Bids List */}
-                            {currentRide?.bids && currentRide.bids.length > 0 ? (
+                            {bids.length > 0 ? (
                                 <div className="space-y-3">
                                     <h4 className="font-semibold text-black">Offers:</h4>
-                                    {currentRide.bids.filter((b: any) => b.status === 'pending').map((bid: any) => (
+                                    {bids.map((bid: any) => (
                                         <div key={bid.id} className="flex justify-between items-center p-3 bg-white rounded shadow-sm border border-gray-200">
                                             <div>
                                                 <p className="font-bold text-lg text-black">BDT {bid.amount}</p>